@@ -9,7 +9,30 @@ import pandas as pd
 import numpy as np
 import sqlite3 as lite
 import re
+import os
+import sys
+import io
+import json
 import time
+import hashlib
+import inspect
+import shutil
+import tempfile
+import glob
+import queue
+import tarfile
+import threading
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+try:
+    import resource
+except ImportError:
+    #(not on windows; profiler then leaves out memory use)
+    resource = None
 
 #TODO: Separate out prj_desc_detail table into MCDReferal and EnvironmentalReview tables
 #maybe make prj_desc, land_use, and dwelling into many-to-many relationships
@@ -34,6 +57,15 @@ LOCATION_GEOM = "the_geom"
 LOCATION_ADDRESS = "address"
 LOCATION_SHAPE_LENGTH = "shape_length"
 LOCATION_SHAPE_AREA = "shape_area"
+#parsed from the_geom, in the same degrees (x is longitude, y latitude). See location_bounds().
+LOCATION_CENTROID_X = "centroid_x"
+LOCATION_CENTROID_Y = "centroid_y"
+LOCATION_MIN_X = "min_x"
+LOCATION_MAX_X = "max_x"
+LOCATION_MIN_Y = "min_y"
+LOCATION_MAX_Y = "max_y"
+#R*Tree virtual table over the bounding boxes, keyed by location id. See create_spatial_index().
+LOCATION_RTREE = "location_rtree"
 
 PRJ_DESC_PK = "id"
 PRJ_DESC_FK = "record"
@@ -89,635 +121,1934 @@ RECORD_DAY_OPENED = "day_opened"
 RECORD_YEAR_CLOSED = "year_closed"
 RECORD_MONTH_CLOSED = "month_closed"
 RECORD_DAY_CLOSED = "day_closed"
+RECORD_DATE_OPENED = "date_opened" #ISO date, YYYY-MM-DD
+RECORD_DATE_CLOSED = "date_closed"
+RECORD_DAY_NUMBER_OPENED = "day_number_opened" #days since 1970-01-01, for range filters and date differences
+RECORD_DAY_NUMBER_CLOSED = "day_number_closed"
+RECORD_SOURCE_HASH = "source_hash" #hash of the source row, used by update() to find changed records
 
 RECORD_REL_PK = "id"
 RECORD_REL_PARENT = "parent"
 RECORD_REL_CHILD = "child"
 
+#the column names are hard-coded because if the planning department adds a new column somewhere I don't want this to break.
+PRJ_DESC_COLS = ["CHANGE_OF_USE", "ADDITIONS", "NEW_CONSTRUCTION", "LEG_ZONE_CHANGE", "DEMOLITION", "LOT_LINE_ADJUST", "FACADE_ALT", "ROW_IMPROVE", "OTHER_PRJ_DESC", "SPECIAL_NEEDS", "SENIOR", "AFFORDABLE_UNITS", "STUDENT", "INCLUSIONARY", "STATE_DENSITY_BONUS", "ADU", "FORMULA_RETAIL", "MCD", "TOBACCO", "FINANCIAL", "MASSAGE", "OTHER_NON_RES"]
+HEARING_DATE_COLS = ["BOS_1ST_READ","BOS_2ND_READ","COM_HEARING","MAYORAL_SIGN","TRANSMIT_DATE_BOS","COM_HEARING_DATE_BOS"]
+#columns added by ymd()
+YMD_COLS = ['year_opened','month_opened','day_opened','year_closed','month_closed','day_closed',
+            'day_number_opened','day_number_closed']
+#columns whose dates ymd() rewrites as ISO dates
+DATE_COLS = ['date_opened','date_closed'] + HEARING_DATE_COLS
+#month abbreviations of dates like 31-JAN-18, see parse_dates()
+MONTH_NAMES = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+#a wide-to-long conversion, see unpivot(): each of the types has a wide column prefix + type + suffix
+#for every long column in suffixes {long column: suffix}
+melt = namedtuple('melt', ['prefix', 'types', 'suffixes'])
+#the column names are hard-coded because if the planning department adds a new column somewhere I don't want this to break.
+LAND_USE_MELT = melt('LAND_USE_', ["RC", "RESIDENTIAL", "CIE", "PDR", "OFFICE", "MEDICAL", "VISITOR", "PARKING_SPACES"],
+                     {LAND_USE_EXIST:'_EXIST', LAND_USE_PROP:'_PROP', LAND_USE_NET:'_NET'})
+#OTHER is renamed after the feature named in PRJ_FEATURE_OTHER
+PRJ_FEATURE_MELT = melt('PRJ_FEATURE_', ["AFFORDABLE", "HOTEL_ROOMS", "MARKET_RATE", "BUILD", "STORIES", "PARKING", "LOADING", "BIKE",
+                                         "CAR_SHARE", "USABLE", "PUBLIC", "ART", "ROOF", "SOLAR", "LIVING", "OTHER"],
+                        {PRJ_FEATURE_EXIST:'_EXIST', PRJ_FEATURE_PROP:'_PROP', PRJ_FEATURE_NET:'_NET'})
+DWELLING_MELT = melt('RESIDENTIAL_', ["STUDIO", "1BR", "2BR", "3BR", "GH_ROOMS", "GH_BEDS", "SRO", "MICRO"],
+                     {DWELLING_EXIST:'_EXIST', DWELLING_PROP:'_PROP', DWELLING_NET:'_NET'})
+#adus also go in the dwelling table, and their area in adu_area
+ADU_MELT = melt('RESIDENTIAL_', ["ADU_STUDIO", "ADU_1BR", "ADU_2BR", "ADU_3BR"],
+                {DWELLING_EXIST:'_EXIST', DWELLING_PROP:'_PROP', DWELLING_NET:'_NET', ADU_AREA:'_AREA'})
+#checkboxes, which have a row where they are checked
+PRJ_DESC_MELT = melt('', PRJ_DESC_COLS, {})
+#project descriptions with a value, which goes in prj_desc_detail
+PRJ_DESC_DETAIL_MELT = melt('', ["MCD_REFERRAL", "ENVIRONMENTAL_REVIEW_TYPE"], {PRJ_DESC_DETAIL:''})
+HEARING_DATE_MELT = melt('', HEARING_DATE_COLS, {HEARING_DATE:''})
+
+#the field catalogue that comes with the PPTS export, used by read_source() to decide what to load and how
+FIELD_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'planning-department-records', 'DataSF_PPTS_Fields.csv')
+#columns that are in the export but missing from the field catalogue
+EXTRA_SOURCE_COLS = ['the_geom', 'Shape_Length', 'Shape_Area', 'PRJ_FEATURE_STORIES_EXIST']
+#catalogue columns that nothing reads, so they are never loaded
+UNUSED_SOURCE_COLS = ['record_type_4level', 'parent']
+#low cardinality text columns, loaded as categoricals
+CATEGORY_COLS = ['record_status', 'module', 'record_type', 'record_type_category', 'record_type_group',
+                 'record_type_subtype', 'record_type_type', 'MCD_REFERRAL', 'ENVIRONMENTAL_REVIEW_TYPE', 'DEMOLITION']
+#checkbox columns, which are either "CHECKED" or empty. read_source() turns them into booleans.
+#(DEMOLITION is a checkbox in name only, it holds Yes/No)
+CHECKBOX_COLS = [col for col in PRJ_DESC_COLS if col != 'DEMOLITION']
+#prefixes of the columns that end up in integer columns of the database (unit, room and space counts).
+#these are read as float32, which holds whole numbers exactly up to 16 million and still allows missing values.
+#the other numeric columns (square footage, areas, cost) stay float64.
+COUNT_COL_PREFIXES = ('PRJ_FEATURE_', 'RESIDENTIAL_')
+
+#limits of the source columns in the Django models, checked by validate_source()
+#decimal_places and max_digits are those of the DecimalField, and desired_precision is the number of significant
+#digits desired in the smallest value. max_length is that of the CharField, and choices the number of distinct values.
+decimal_field = namedtuple('decimal_field', ['desired_precision', 'decimal_places', 'max_digits'])
+char_field = namedtuple('char_field', ['max_length'])
+choice_field = namedtuple('choice_field', ['choices'])
+MODEL_LIMITS = {'Shape_Length':decimal_field(3, 8, 15), 'Shape_Area':decimal_field(3, 15, 15), 'address':char_field(250),
+                'planner_id':char_field(100), 'planner_name':char_field(100), 'planner_email':char_field(100),
+                'planner_phone':char_field(100),
+                #note that some of these get additional processing later
+                'record_type_category':char_field(100), 'record_type':char_field(100),
+                'record_type_subtype':char_field(100), 'record_type_type':char_field(100),
+                'MCD_REFERRAL':choice_field(7), 'ENVIRONMENTAL_REVIEW_TYPE':choice_field(21),
+                'PRJ_FEATURE_OTHER':char_field(250)}
+#all the land use, project feature and dwelling numbers
+MODEL_LIMITS.update({spec.prefix + col_type + suffix: decimal_field(2, 2, 15)
+                     for spec in (LAND_USE_MELT, PRJ_FEATURE_MELT, DWELLING_MELT, ADU_MELT)
+                     for col_type in spec.types for suffix in spec.suffixes.values()})
+#rows at a time read by column_stats()
+VALIDATE_CHUNKSIZE = 100000
+#column_stats() stops counting the distinct values of a column past this many
+DISTINCT_LIMIT = 100000
+
+#bytes the decompression thread of archive_stream hands to the csv reader at a time, and blocks it keeps ready
+ARCHIVE_BLOCK = 1024**2
+ARCHIVE_QUEUE = 8
+
+#default size limit of a stage_cache, in bytes
+CACHE_SIZE = 2*1024**3
+#bump this when the layout of cache entries changes
+CACHE_VERSION = 1
+#number of lines of a cProfile or tracemalloc profile that profiler keeps
+PROFILE_LINES = 25
+
 # creates a new database
 # to execute this from bash, please use db_create.py
-def create(source, destination):
-    data = pd.read_csv(source)
-    data, record_type, record_rel, location, planner, prj_desc, prj_desc_detail,land_use, prj_feature, dwelling, adu_area, hearing_date = prepare_data(data)
+# if chunksize is given, the source is streamed in chunks of that many rows (see create_streaming)
+# if serial is True, the stages of prepare_data run one at a time instead of in parallel
+# output is 'sqlite', 'parquet' (destination is then a directory of parquet files, see write_parquet),
+# or 'both' (the parquet files go in parquet_directory(destination))
+# if cache is a directory, the source and the results of each stage are kept there (see stage_cache),
+# and reused by later runs as long as their inputs haven't changed. cache_size limits its size in bytes.
+# metrics is an optional profiler, which gets the measurements of every step
+# if validate is True, the source is first checked against the Django models (see validate_source),
+# and a ValueError lists the problems before anything is built
+def create(source, destination, chunksize=None, serial=False, output='sqlite', cache=None, cache_size=CACHE_SIZE,
+           metrics=None, validate=False):
+    if output not in ('sqlite', 'parquet', 'both'):
+        raise ValueError('unknown output %s' % output)
+    if metrics is None:
+        metrics = profiler()
+    if validate:
+        with metrics.measure('validate', source):
+            problems = validate_source(source)
+        if problems:
+            raise ValueError('%s does not fit the database models:\n%s' % (source, '\n'.join(problems)))
+    if chunksize:
+        if output != 'sqlite':
+            raise ValueError('streaming only writes sqlite databases')
+        create_streaming(source, destination, chunksize, metrics=metrics)
+        return
+    with metrics.measure('read', source) as entry:
+        if cache is not None:
+            cache = stage_cache(cache, cache_size)
+            data = cache.source(source)
+        else:
+            data = read_source(source)
+        data['source_hash'] = source_hash(data)
+        entry['rows_out'] = len(data)
+    data, record_type, record_rel, location, planner, prj_desc, prj_desc_detail,land_use, prj_feature, dwelling, adu_area, hearing_date = prepare_data(data, serial=serial, cache=cache, metrics=metrics)
+    
+    if output in ('sqlite', 'both'):
+        print('Generating SQL file')
+        init_sql_database(destination, data, record_type, record_rel, location, planner, prj_desc,
+                          prj_desc_detail, land_use, prj_feature, dwelling, adu_area, hearing_date, metrics=metrics)
+    if output in ('parquet', 'both'):
+        print('Generating parquet files')
+        write_parquet(destination if output == 'parquet' else parquet_directory(destination),
+                      data, record_type, record_rel, location, planner, prj_desc,
+                      prj_desc_detail, land_use, prj_feature, dwelling, adu_area, hearing_date, metrics=metrics)
+
+#where create() puts the parquet files when writing both formats: 2018Q4.db -> 2018Q4_parquet
+def parquet_directory(destination):
+    return os.path.splitext(destination)[0] + '_parquet'
+
+#reads the PPTS export with the column types of source_schema(), loading only the columns that are used
+#source is a csv file, or the prefix of a split tar.gz archive of one (see source_file)
+#fields is the field catalogue (by default the one next to source, or else FIELD_SOURCE)
+#if chunksize is given, returns an iterator over dataframes of that many rows
+#differences between the export and the catalogue are reported before anything is read,
+#and a ValueError is raised if a column we need is missing
+def read_source(source, fields=None, chunksize=None, columns=None):
+    if fields is None:
+        fields = field_source(source)
+    schema = source_schema(fields)
+    with source_file(source) as f:
+        header = list(pd.read_csv(f, nrows=0).columns)
+    
+    missing = [col for col in schema if col not in header]
+    if missing:
+        raise ValueError('%s is missing columns: %s' % (source, ', '.join(missing)))
+    #pandas renames repeated columns to col.1, col.2 etc
+    unknown = [col for col in header if col not in schema and col not in UNUSED_SOURCE_COLS
+               and re.sub('\\.\\d+$', '', col) not in schema]
+    if unknown:
+        print('Warning in read_source(): columns not in the field catalogue will not be loaded: %s' % ', '.join(unknown))
+    #only load some of the columns
+    if columns is not None:
+        schema = {col: col_type for col, col_type in schema.items() if col in columns}
+    
+    #checkboxes are read as categories, and converted afterwards because they have missing values
+    dtype = {col: ('category' if col in CHECKBOX_COLS else col_type) for col, col_type in schema.items() if col_type is not None}
+    if chunksize:
+        return read_chunks(source, schema, dtype, chunksize)
+    with source_file(source) as f:
+        return typed_source(pd.read_csv(f, usecols=list(schema), dtype=dtype), schema)
+
+#the chunks of read_source(), which keeps source open until the last one is read
+def read_chunks(source, schema, dtype, chunksize):
+    with source_file(source) as f:
+        for data in pd.read_csv(f, usecols=list(schema), dtype=dtype, chunksize=chunksize):
+            yield typed_source(data, schema)
+
+#the parts of the split archive whose names start with prefix, in order
+#compress.sh makes them with: tar cz FILE | split -b 25MiB - PREFIX, which names them PREFIXaa, PREFIXab...
+def archive_parts(prefix):
+    return sorted(glob.glob(glob.escape(prefix) + '*'))
+
+#True if source is the prefix of a split archive rather than a file
+def is_archive(source):
+    return not os.path.exists(source) and len(archive_parts(source)) > 0
+
+#True if source is a file or the prefix of a split archive
+def source_exists(source):
+    return os.path.exists(source) or is_archive(source)
+
+#size and modification time of source, or of all the parts of its archive, to tell when it has changed
+def source_stat(source):
+    if not is_archive(source):
+        stat = os.stat(source)
+        return stat.st_size, stat.st_mtime_ns
+    stats = [os.stat(part) for part in archive_parts(source)]
+    return sum(stat.st_size for stat in stats), max(stat.st_mtime_ns for stat in stats)
+
+#opens source for pd.read_csv(). A file is given to pandas as it is, and a split archive is decompressed
+#as it is read, without writing the csv to disk (see archive_stream)
+@contextmanager
+def source_file(source):
+    if not is_archive(source):
+        yield source
+        return
+    f = io.BufferedReader(archive_stream(source), ARCHIVE_BLOCK)
+    try:
+        yield f
+    finally:
+        f.close()
+
+#the parts of a split archive, read one after the other as if they were one file
+class joined_parts(io.RawIOBase):
+    def __init__(self, parts):
+        self.parts = list(parts)
+        self.current = None
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        while True:
+            if self.current is None:
+                if not self.parts:
+                    return 0
+                self.current = open(self.parts.pop(0), 'rb')
+            n = self.current.readinto(buffer)
+            if n:
+                return n
+            self.current.close()
+            self.current = None
+    
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+        super().close()
+
+#the first file (or the file named member) of the split tar.gz archive prefix, as a readable stream
+#a background thread decompresses the archive ARCHIVE_BLOCK bytes at a time, and keeps up to ARCHIVE_QUEUE blocks
+#ready, so that decompressing (which releases the GIL) overlaps with parsing the csv
+class archive_stream(io.RawIOBase):
+    def __init__(self, prefix, member=None):
+        self.stopped = threading.Event()
+        self.thread = None
+        parts = archive_parts(prefix)
+        if not parts:
+            raise ValueError('there is no archive %s*' % prefix)
+        self.prefix = prefix
+        self.blocks = queue.Queue(ARCHIVE_QUEUE)
+        self.pending = memoryview(b'')
+        self.finished = False
+        self.thread = threading.Thread(target=self.decompress, args=(parts, member), daemon=True)
+        self.thread.start()
+    
+    def readable(self):
+        return True
+    
+    #runs in the thread: puts blocks of the file in the queue, then b'' at the end, or the exception if it fails
+    def decompress(self, parts, member):
+        try:
+            with joined_parts(parts) as joined, tarfile.open(fileobj=joined, mode='r|gz') as tar:
+                for info in tar:
+                    if info.isfile() and (member is None or info.name == member):
+                        break
+                else:
+                    raise ValueError('%s* has no file %s' % (self.prefix, member or ''))
+                f = tar.extractfile(info)
+                while not self.stopped.is_set():
+                    block = f.read(ARCHIVE_BLOCK)
+                    if not block:
+                        break
+                    self.put(block)
+            self.put(b'')
+        except Exception as e:
+            self.put(e)
+    
+    #waits for room in the queue, unless the stream is closed in the meantime
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+    
+    def readinto(self, buffer):
+        while not len(self.pending):
+            if self.finished:
+                return 0
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                self.finished = True
+                raise block
+            if not block:
+                self.finished = True
+                return 0
+            self.pending = memoryview(block)
+        n = min(len(buffer), len(self.pending))
+        buffer[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+    
+    #stops the thread, even if the file wasn't read to the end
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        super().close()
+
+#the field catalogue next to source, or else FIELD_SOURCE
+def field_source(source):
+    fields = os.path.join(os.path.dirname(os.path.abspath(source)), 'DataSF_PPTS_Fields.csv')
+    return fields if os.path.exists(fields) else FIELD_SOURCE
+
+#finishes the conversion of a dataframe read by read_source()
+def typed_source(data, schema):
+    for col in CHECKBOX_COLS:
+        if col in schema:
+            data[col] = (data[col] == 'CHECKED').astype(bool)
+    #keep the column order of the catalogue, whatever order the export is in
+    return data[list(schema)]
+
+#the columns to load from the export, as {column: dtype}, built from the field catalogue in fields
+#a dtype of None leaves it to pandas
+def source_schema(fields):
+    names = list(pd.read_csv(fields)['Field'])
+    schema = {}
+    for col in names + EXTRA_SOURCE_COLS:
+        if col in schema or col in UNUSED_SOURCE_COLS:
+            continue
+        if col in CATEGORY_COLS:
+            schema[col] = 'category'
+        elif col in CHECKBOX_COLS:
+            schema[col] = bool
+        elif col.startswith(COUNT_COL_PREFIXES) and col.endswith(('_EXIST', '_PROP', '_NET')):
+            schema[col] = 'float32'
+        elif col.endswith(('_EXIST', '_PROP', '_NET', '_AREA')) or col in ('constructcost', 'Shape_Length', 'Shape_Area'):
+            schema[col] = 'float64'
+        else:
+            schema[col] = None
+    return schema
+
+#checks source against the limits of the Django models (see MODEL_LIMITS) in one pass over the columns that have limits
+#returns a list of problems, which is empty if everything fits
+def validate_source(source, fields=None, limits=MODEL_LIMITS, chunksize=VALIDATE_CHUNKSIZE):
+    return limit_problems(column_stats(source, fields, chunksize, columns=list(limits)), limits)
+
+#statistics of every column of source (or only of columns), read chunksize rows at a time: the number of missing values,
+#the smallest and largest positive value (numeric columns), the length of the longest string (text columns), and the
+#number of distinct values (NaN past DISTINCT_LIMIT). Checkbox columns are already booleans, so they have no missing values.
+def column_stats(source, fields=None, chunksize=VALIDATE_CHUNKSIZE, columns=None):
+    stats = {}
+    distinct = {}
+    for data in read_source(source, fields, chunksize=chunksize, columns=columns):
+        for col in data.columns:
+            col_stats = stats.setdefault(col, {'null_count':0, 'min_positive':np.nan, 'max_positive':np.nan,
+                                               'max_length':np.nan, 'distinct':np.nan})
+            col_stats['null_count'] += int(data[col].isna().sum())
+            #everything else only depends on which values there are, and there are far fewer of those than rows
+            uniques = pd.Series(np.asarray(data[col].dropna().unique()))
+            if len(uniques) == 0:
+                continue
+            if uniques.dtype.kind in 'iuf':
+                positive = uniques[uniques > 0]
+                if len(positive):
+                    col_stats['min_positive'] = np.fmin(col_stats['min_positive'], positive.min())
+                    col_stats['max_positive'] = np.fmax(col_stats['max_positive'], positive.max())
+            elif uniques.dtype.kind == 'O' or isinstance(uniques.dtype, pd.StringDtype):
+                col_stats['max_length'] = np.fmax(col_stats['max_length'], uniques.astype(str).str.len().max())
+
+            if distinct.get(col, set()) is not None:
+                seen = distinct.setdefault(col, set())
+                seen.update(pd.util.hash_pandas_object(uniques, index=False).to_numpy().tolist())
+                if len(seen) > DISTINCT_LIMIT:
+                    distinct[col] = None
+
+    for col, seen in distinct.items():
+        if seen is not None:
+            stats[col]['distinct'] = len(seen)
+    return pd.DataFrame.from_dict(stats, orient='index')
+
+#the columns of stats (see column_stats) that don't fit limits, as a list of messages
+def limit_problems(stats, limits=MODEL_LIMITS):
+    problems = []
+    for col, limit in limits.items():
+        if col not in stats.index:
+            problems.append('%s is not in the source' % col)
+            continue
+        col_stats = stats.loc[col]
+        if isinstance(limit, decimal_field):
+            if pd.isna(col_stats['min_positive']):
+                continue
+            if not col_stats['min_positive'] > 10**(-limit.decimal_places - limit.desired_precision + 1):
+                problems.append('not enough decimal places used to model %s (smallest value %g)'
+                                % (col, col_stats['min_positive']))
+            if not col_stats['max_positive'] < 10**(limit.max_digits - limit.decimal_places):
+                problems.append('not enough digits used to model %s (largest value %g)' % (col, col_stats['max_positive']))
+        elif isinstance(limit, char_field):
+            if col_stats['max_length'] >= limit.max_length:
+                problems.append('not enough space allocated for string length of %s (%d characters, max_length %d)'
+                                % (col, col_stats['max_length'], limit.max_length))
+        elif isinstance(limit, choice_field):
+            if col_stats['distinct'] != limit.choices:
+                problems.append('%s has new unique values (%s distinct values, expected %d)'
+                                % (col, col_stats['distinct'], limit.choices))
+    return problems
+
+# creates a new database, reading the source chunksize rows at a time
+# each chunk goes through the per-record stages and is appended to the database right away,
+# so memory use depends on the chunk size and the number of distinct locations/planners, not on the size of the export.
+# location, planner and record_type ids are kept consistent across chunks, and are written at the end.
+def create_streaming(source, destination, chunksize, metrics=None):
+    if metrics is None:
+        metrics = profiler()
+    location = location_dimension()
+    planner = planner_dimension()
+    record_types = None
+    #number of rows written so far to each table whose ids are generated from the dataframe index
+    counts = dict.fromkeys(['record','prj_desc','land_use','prj_feature','dwelling','hearing_date'], 0)
+    
+    con = build_connection(destination)
+    try:
+        create_tables(con)
+        #children are resolved at the end, once every record_id is in the database
+        con.execute('create temp table record_rel_staging(row integer, child_record_id text)')
+        
+        for i, data in enumerate(read_source(source, chunksize=chunksize)):
+            with metrics.measure('chunk', i, len(data)) as entry:
+                #the stages find rows by position, so work with a fresh index and shift ids afterwards
+                data = data.reset_index(drop=True)
+                data['source_hash'] = source_hash(data)
+                offset = counts['record']
+            
+                rows = record_type_rows(data)
+                rows.index += offset
+                record_types = rows if record_types is None else record_type_rows(pd.concat([record_types, rows]))
+            
+                children = data['children'].dropna().astype(str).str.split(',').explode()
+                con.executemany('insert into record_rel_staging values (?,?)',
+                                zip((children.index + offset).tolist(), children.tolist()))
+            
+                data['location_id'] = location.add(data)
+                data['planner_id_int'] = planner.add(data)
+            
+                prj_desc, prj_desc_detail = prj_desc_table(data)
+                land_use = land_use_table(data)
+                data = fix_prj_features(data)
+                prj_feature = prj_feature_table(data)
+                dwelling, adu_area = dwelling_table(data)
+                data = ymd(data)
+                hearing_date = hearing_date_table(data)
+                data['constructcost'] = data['constructcost'].fillna(value=0)
+            
+                #move row-based ids and foreign keys from chunk positions to positions in the whole export
+                prj_desc_detail[PRJ_DESC_DETAIL_PK] += counts['prj_desc']
+                adu_area[ADU_PK] += counts['dwelling']
+                tables = {'record':data, 'prj_desc':prj_desc, 'land_use':land_use, 'prj_feature':prj_feature,
+                          'dwelling':dwelling, 'hearing_date':hearing_date}
+                for name, table in tables.items():
+                    table.index += counts[name]
+                    if name != 'record':
+                        #all of these use "record" as the name of their foreign key column
+                        table['record'] += offset
+                    counts[name] += len(table)
+            
+                append_tables(con, data=data, prj_desc=prj_desc, prj_desc_detail=prj_desc_detail, land_use=land_use,
+                              prj_feature=prj_feature, dwelling=dwelling, adu_area=adu_area, hearing_date=hearing_date)
+                con.commit()
+                entry['rows_out'] = sum(len(table) for table in tables.values())
+        
+        print('Generating dimension tables')
+        record_type = record_type_table(record_types.reset_index(drop=True))
+        append_tables(con, record_type=record_type, location=location.table(), planner=planner.table(), metrics=metrics)
+        #records were written with their original category, now replace it with the standardized one
+        renamed = record_type[record_type['original_type'] != record_type[RECORD_TYPE]]
+        con.executemany('update record set %s = ? where %s = ?' % (RECORD_FK_TYPE, RECORD_FK_TYPE),
+                        zip(renamed[RECORD_TYPE], renamed['original_type']))
+        
+        with metrics.measure('table', 'record_rel'):
+            record_rel_from_staging(con)
+        create_indexes(con, metrics=metrics)
+        create_spatial_index(con, metrics=metrics)
+        refresh_summaries(con, metrics=metrics)
+        update_search_index(con, metrics=metrics)
+        with metrics.measure('analyze', 'database'):
+            con.execute('analyze')
+            con.commit()
+        finish_build(con)
+    finally:
+        con.close()
+
+# updates an existing database (made by create()) from a newer export of the same records
+# records are matched on record_id, and only new, changed and deleted records are touched.
+# ids of unchanged records, locations and planners stay the same.
+# to execute this from bash, please use db_create.py --update
+def update(destination, source, metrics=None):
+    if metrics is None:
+        metrics = profiler()
+    with metrics.measure('read', source) as entry:
+        data = read_source(source)
+        data['source_hash'] = source_hash(data)
+        entry['rows_out'] = len(data)
+    if data['record_id'].duplicated().any():
+        print('Warning in update(): only the first of each duplicated record_id is used')
+        data = data.drop_duplicates('record_id').reset_index(drop=True)
+    
+    con = lite.connect(destination)
+    try:
+        #the deletes below look up every child table by record
+        create_indexes(con)
+        cur = con.cursor()
+        try:
+            existing = pd.read_sql('select %s, %s, %s, %s from record' % (RECORD_PK, RECORD_ID, RECORD_SOURCE_HASH, RECORD_DAY_NUMBER_OPENED), con)
+        except pd.io.sql.DatabaseError:
+            raise ValueError('%s has no %s column, please rebuild it with create()' % (destination, RECORD_SOURCE_HASH))
+        try:
+            pd.read_sql('select %s from location limit 0' % LOCATION_CENTROID_X, con)
+        except pd.io.sql.DatabaseError:
+            raise ValueError('%s has no %s column, please rebuild it with create()' % (destination, LOCATION_CENTROID_X))
+        
+        #sort records into new, changed, unchanged and deleted
+        matched = existing.drop_duplicates(RECORD_ID).set_index(RECORD_ID).reindex(data['record_id'])
+        is_new = matched[RECORD_PK].isna().values
+        changed = ~is_new & (matched[RECORD_SOURCE_HASH].values != data['source_hash'].values)
+        affected = is_new | changed
+        deleted = existing.loc[~existing[RECORD_ID].isin(data['record_id']), RECORD_PK].values
+        print('%s new, %s changed, %s deleted records' % (is_new.sum(), changed.sum(), len(deleted)))
+        
+        #changed records keep their id, new ones are numbered after the last one
+        record_ids = matched[RECORD_PK].values.copy()
+        record_ids[is_new] = next_id(cur, 'record', RECORD_PK) + np.arange(is_new.sum())
+        record_ids = record_ids.astype(np.int64)
+        
+        with metrics.measure('delete', 'records', int(len(deleted) + changed.sum())):
+            delete_records(cur, np.concatenate([record_ids[changed], deleted]), deleted)
+        
+        with metrics.measure('stage', 'prepare_update', int(affected.sum())):
+            data, record_type, record_rel, location, planner, prj_desc, prj_desc_detail, land_use, prj_feature, dwelling, adu_area, hearing_date = prepare_update(cur, data, is_new, affected, record_ids)
+        append_tables(con, data, record_type, record_rel, location, planner, prj_desc,
+                      prj_desc_detail, land_use, prj_feature, dwelling, adu_area, hearing_date, metrics=metrics)
+        create_spatial_index(con, metrics=metrics)
+        #the quarters the changed and deleted records were in, and those the new and changed ones are in now
+        removed = existing[RECORD_PK].isin(np.concatenate([record_ids[changed], deleted])).values
+        refresh_summaries(con, np.concatenate([existing.loc[removed, RECORD_DAY_NUMBER_OPENED].astype(float).values,
+                                               data['day_number_opened'].astype(float).values]), metrics=metrics)
+        update_search_index(con, np.concatenate([record_ids[affected], deleted]), metrics=metrics)
+        con.commit()
+    finally:
+        con.close()
+
+#runs the stages of prepare_data() on the affected records only, and numbers the results so they can be appended to the database
+#is_new and affected flag the new and the new or changed rows of data, and record_ids holds the record table id of every row
+def prepare_update(cur, data, is_new, affected, record_ids):
+    subset = data.loc[affected].reset_index(drop=True)
+    subset_ids = record_ids[affected]
+    
+    #only record types that aren't in the database yet are written
+    record_type = record_type_table(subset)
+    subset = clean_record_type(subset, record_type)
+    known = [row[0] for row in cur.execute('select %s from record_type' % RECORD_TYPE)]
+    record_type = record_type[~record_type[RECORD_TYPE].isin(known)]
+    
+    #children of the affected records, plus any new children of unchanged records
+    children = data['children'].dropna().astype(str).str.split(',').explode()
+    new_record_ids = data.loc[is_new, 'record_id']
+    children = children[affected[children.index.values] | children.isin(new_record_ids).values]
+    parents = children.map(pd.Series(record_ids, index=data['record_id'].values))
+    resolved = parents.notna().values
+    if not resolved.all():
+        print('Warning in record_rel_table(): %d children do not match any record_id' % (~resolved).sum())
+    record_rel = pd.DataFrame({RECORD_REL_CHILD:record_ids[children.index[resolved]],
+                               RECORD_REL_PARENT:parents[resolved].astype(np.int64).values})
+    
+    subset['location_id'], location = update_dimension(cur, 'location', location_dimension(), subset)
+    subset['planner_id_int'], planner = update_dimension(cur, 'planner', planner_dimension(), subset)
+    
+    prj_desc, prj_desc_detail = prj_desc_table(subset)
+    land_use = land_use_table(subset)
+    subset = fix_prj_features(subset)
+    prj_feature = prj_feature_table(subset)
+    dwelling, adu_area = dwelling_table(subset)
+    subset = ymd(subset)
+    hearing_date = hearing_date_table(subset)
+    subset['constructcost'] = subset['constructcost'].fillna(value=0)
+    
+    #replace row positions with record ids, and continue the ids of each table
+    subset.index = subset_ids
+    prj_desc_detail[PRJ_DESC_DETAIL_PK] += next_id(cur, 'prj_desc', PRJ_DESC_PK)
+    adu_area[ADU_PK] += next_id(cur, 'dwelling', DWELLING_PK)
+    tables = {'record_rel':(record_rel, RECORD_REL_PK), 'prj_desc':(prj_desc, PRJ_DESC_PK),
+              'land_use':(land_use, LAND_USE_PK), 'prj_feature':(prj_feature, PRJ_FEATURE_PK),
+              'dwelling':(dwelling, DWELLING_PK), 'hearing_date':(hearing_date, HEARING_PK)}
+    for name, (table, pk) in tables.items():
+        table.index += next_id(cur, name, pk)
+        if name != 'record_rel':
+            table['record'] = subset_ids[table['record'].values.astype(int)]
+    
+    return subset, record_type, record_rel, location, planner, prj_desc, prj_desc_detail, land_use, prj_feature, dwelling, adu_area, hearing_date
+
+#the next free id of a table, for tables whose ids are numbered from 0
+def next_id(cur, table, pk):
+    last = cur.execute('select max(%s) from %s' % (pk, table)).fetchone()[0]
+    return 0 if last is None else last + 1
+
+#deletes records, and everything derived from them, from the database
+#rows of record_rel that point to a record are only deleted if it is in removed (i.e. it will not come back)
+def delete_records(cur, ids, removed):
+    cur.execute('create temp table stale(id integer primary key)')
+    cur.executemany('insert into stale values (?)', [(int(i),) for i in ids])
+    cur.execute('create temp table removed(id integer primary key)')
+    cur.executemany('insert into removed values (?)', [(int(i),) for i in removed])
+    
+    cur.execute('delete from adu_area where %s in (select %s from dwelling where %s in temp.stale)' % (ADU_PK, DWELLING_PK, DWELLING_FK))
+    cur.execute('delete from prj_desc_detail where %s in (select %s from prj_desc where %s in temp.stale)' % (PRJ_DESC_DETAIL_PK, PRJ_DESC_PK, PRJ_DESC_FK))
+    for table, fk in [('dwelling',DWELLING_FK), ('prj_desc',PRJ_DESC_FK), ('land_use',LAND_USE_FK),
+                      ('prj_feature',PRJ_FEATURE_FK), ('hearing_date',HEARING_FK)]:
+        cur.execute('delete from %s where %s in temp.stale' % (table, fk))
+    #the child column holds the record whose children field produced the row
+    cur.execute('delete from record_rel where %s in temp.stale or %s in temp.removed' % (RECORD_REL_CHILD, RECORD_REL_PARENT))
+    cur.execute('delete from record where %s in temp.stale' % RECORD_PK)
+    
+    cur.execute('drop table temp.stale')
+    cur.execute('drop table temp.removed')
+
+#adds the keys of data to a dimension table that is already in the database
+#new keys are returned as a dimension table to be appended, and missing attributes of existing keys are filled in place
+#dimension rows are never deleted, so ids stay valid for anyone holding on to them
+def update_dimension(cur, name, dim, data):
+    attributes = list(dim.attributes.keys())
+    existing = pd.read_sql('select %s, %s from %s order by %s' % (dim.pk, dim.key_name, name, dim.pk), cur.connection)
+    if not (existing[dim.pk].values == np.arange(len(existing))).all():
+        raise ValueError('ids of the %s table are not numbered 0, 1, 2...' % name)
+    dim.seed(existing[dim.key_name].values)
     
-    comp_timer = timer()
-    print('Generating SQL file')
-    init_sql_database(destination, data, record_type, record_rel, location, planner, prj_desc,
-                      prj_desc_detail, land_use, prj_feature, dwelling, adu_area, hearing_date)
-    comp_timer.printreport()
-    comp_timer.restart()
+    ids = dim.add(data)
+    table = dim.table()
+    old = table[table[dim.pk] < len(existing)]
+    old = old[old[attributes].notna().any(axis=1).values]
+    values = old[attributes].astype(object).where(old[attributes].notna(), None).values.tolist()
+    cur.executemany('update %s set %s where %s = ?' % (name, ', '.join('%s = coalesce(%s, ?)' % (a, a) for a in attributes), dim.pk),
+                    [row + [pk] for row, pk in zip(values, old[dim.pk].tolist())])
+    return ids, table[table[dim.pk] >= len(existing)]
 
 #creates tables, cleans up columns, prints out progress
-def prepare_data(data):
-    comp_timer = timer()
-    print('Generating record_type table')
+#independent stages run side by side in a process pool, unless serial is True
+#cache is an optional stage_cache, and metrics an optional profiler
+def prepare_data(data, serial=False, cache=None, metrics=None):
+    data, tables = run_stages(data, STAGES, serial=serial, cache=cache, metrics=metrics)
+    
+    #one last thing: clean nans in constructcost
+    data['constructcost'] = data['constructcost'].fillna(value=0)
+    
+    return (data, tables['record_type'], tables['record_rel'], tables['location'], tables['planner'], tables['prj_desc'],
+            tables['prj_desc_detail'], tables['land_use'], tables['prj_feature'], tables['dwelling'], tables['adu_area'], tables['hearing_date'])
+
+#a stage of prepare_data
+#function takes a dataframe with only the columns in inputs, and returns a dict of new tables and a dict of new or replaced columns.
+#inputs ending in '_' stand for every column with that prefix. outputs lists the columns it returns.
+stage = namedtuple('stage', ['description', 'function', 'inputs', 'outputs'])
+
+def record_type_stage(data):
     record_type = record_type_table(data)
     data = clean_record_type(data,record_type)
-    comp_timer.printreport()
-    comp_timer.restart()
-    print('Generating record_rel table')
-    record_rel = record_rel_table(data)
-    comp_timer.printreport()
-    comp_timer.restart()
-    print('Generating location table')
+    return {'record_type':record_type}, {'record_type_category':data['record_type_category']}
+
+def record_rel_stage(data):
+    return {'record_rel':record_rel_table(data)}, {}
+
+def location_stage(data):
     data, location = location_table(data)
-    comp_timer.printreport()
-    comp_timer.restart()
-    print('Generating planner table')
+    return {'location':location}, {'location_id':data['location_id']}
+
+def planner_stage(data):
     data, planner = planner_table(data)
-    comp_timer.printreport()
-    comp_timer.restart()
-    print('Generating prj_desc tables')
+    return {'planner':planner}, {'planner_id_int':data['planner_id_int']}
+
+def prj_desc_stage(data):
     prj_desc, prj_desc_detail = prj_desc_table(data)
-    comp_timer.printreport()
-    comp_timer.restart()
-    print('Generating land_use table')
-    land_use = land_use_table(data)
-    comp_timer.printreport()
-    comp_timer.restart()
-    print('Generating prj_feature table')
+    return {'prj_desc':prj_desc, 'prj_desc_detail':prj_desc_detail}, {}
+
+def land_use_stage(data):
+    return {'land_use':land_use_table(data)}, {}
+
+def prj_feature_stage(data):
     data = fix_prj_features(data)
-    prj_feature = prj_feature_table(data)
-    comp_timer.printreport()
-    comp_timer.restart()
-    print('Generating dwelling tables')
+    return ({'prj_feature':prj_feature_table(data)},
+            {'PRJ_FEATURE_STORIES_PROP':data['PRJ_FEATURE_STORIES_PROP'], 'PRJ_FEATURE_LOADING_PROP':data['PRJ_FEATURE_LOADING_PROP']})
+
+def dwelling_stage(data):
     dwelling, adu_area = dwelling_table(data)
-    comp_timer.printreport()
-    comp_timer.restart()
-    print('Generating year/month/day')
+    return {'dwelling':dwelling, 'adu_area':adu_area}, {}
+
+def ymd_stage(data):
     data = ymd(data)
-    comp_timer.printreport()
-    comp_timer.restart()
-    print('Generating hearing date table')
-    hearing_date = hearing_date_table(data)
-    comp_timer.printreport()
-    comp_timer.restart()
+    return {}, {col:data[col] for col in YMD_COLS + DATE_COLS}
+
+def hearing_date_stage(data):
+    return {'hearing_date':hearing_date_table(data)}, {}
+
+#the stages of prepare_data, in the order they run when serial
+STAGES = [
+    stage('record_type table', record_type_stage,
+          ['record_type_category','record_type','record_type_type','record_type_subtype','record_type_group','module'],
+          ['record_type_category']),
+    stage('record_rel table', record_rel_stage, ['record_id','children'], []),
+    stage('location table', location_stage, ['the_geom','Shape_Length','Shape_Area','address'], ['location_id']),
+    stage('planner table', planner_stage, ['planner_id','planner_email','planner_phone','planner_name'], ['planner_id_int']),
+    stage('prj_desc tables', prj_desc_stage, PRJ_DESC_COLS + ['MCD_REFERRAL','ENVIRONMENTAL_REVIEW_TYPE'], []),
+    stage('land_use table', land_use_stage, ['LAND_USE_'], []),
+    stage('prj_feature table', prj_feature_stage, ['PRJ_FEATURE_'], ['PRJ_FEATURE_STORIES_PROP','PRJ_FEATURE_LOADING_PROP']),
+    stage('dwelling tables', dwelling_stage, ['RESIDENTIAL_'], []),
+    stage('dates', ymd_stage, DATE_COLS, YMD_COLS + DATE_COLS),
+    stage('hearing date table', hearing_date_stage, HEARING_DATE_COLS, []),
+]
+
+#the columns of data that a stage reads
+def stage_columns(stg, columns):
+    prefixes = tuple(col for col in stg.inputs if col.endswith('_'))
+    return [col for col in columns if col in stg.inputs or col.startswith(prefixes)]
+
+#runs stages on data, and returns the updated data and a dict of all the tables the stages made
+#a stage waits for every earlier stage that outputs a column it reads. Otherwise, stages run in parallel
+#worker processes, and each worker is only sent the columns its stage reads.
+#if serial is True, the stages run one after the other in this process instead.
+#with a stage_cache, stages whose result is in the cache aren't run at all.
+#every stage is measured by metrics (a profiler), which also says which stage to profile
+def run_stages(data, stages, serial=False, cache=None, metrics=None):
+    if metrics is None:
+        metrics = profiler()
+    original_columns = list(data.columns)
+    all_columns = original_columns + [col for stg in stages for col in stg.outputs if col not in original_columns]
+    inputs = [stage_columns(stg, all_columns) for stg in stages]
+    depends = [set(j for j in range(i) if set(stages[j].outputs) & set(inputs[i])) for i in range(len(stages))]
+    tables = {}
     
-    #one last thing: clean nans in constructcost
-    data['constructcost'] = data['constructcost'].fillna(value=0)
+    def finish(i, result):
+        new_tables, new_columns = result
+        tables.update(new_tables)
+        for col, values in new_columns.items():
+            data[col] = values
+    
+    #the key of a stage and its cached result, if there is one
+    def lookup(i):
+        if cache is None:
+            return None, None
+        key = cache.key(stages[i].description, stages[i].function, data[inputs[i]])
+        result = cache.get(key)
+        if result is not None:
+            metrics.add({'kind':'stage', 'name':stages[i].description, 'cached':True})
+        return key, result
+    
+    def store(key, result):
+        if cache is not None:
+            cache.put(key, result)
+    
+    def measured(i, result, entry):
+        metrics.add(dict({'kind':'stage', 'name':stages[i].description}, **entry))
+        return result
+    
+    if serial:
+        for i, stg in enumerate(stages):
+            key, result = lookup(i)
+            if result is None:
+                print('Generating %s' % stg.description)
+                result = measured(i, *measured_call(stg.function, data[inputs[i]], metrics.profile_stage(stg)))
+                store(key, result)
+            finish(i, result)
+        return data, tables
+    
+    done = set()
+    keys = {}
+    with ProcessPoolExecutor() as pool:
+        waiting = list(range(len(stages)))
+        running = {}
+        while waiting or running:
+            for i in [i for i in waiting if depends[i] <= done]:
+                waiting.remove(i)
+                keys[i], result = lookup(i)
+                if result is not None:
+                    finish(i, result)
+                    done.add(i)
+                    continue
+                print('Generating %s' % stages[i].description)
+                running[pool.submit(measured_call, stages[i].function, data[inputs[i]], metrics.profile_stage(stages[i]))] = i
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                result = measured(i, *future.result())
+                store(keys[i], result)
+                finish(i, result)
+                done.add(i)
+    
+    #keep the columns in the same order as a serial run
+    return data[[col for col in all_columns if col in data.columns]], tables
+
+#on-disk cache of stage results, so that rebuilds only rerun the stages whose inputs or code have changed
+#each entry is a directory of parquet files (one per table, and one for the new columns), named after the key of
+#the stage: a hash of the stage's input columns and of its code (see code_version). Every stage that depends on a
+#changed stage sees changed input columns, so it is rerun as well.
+#when the entries take up more than max_size bytes, the least recently used ones are deleted.
+class stage_cache():
+    COLUMNS = '_columns.parquet'
     
-    return data, record_type, record_rel, location, planner, prj_desc, prj_desc_detail, land_use, prj_feature, dwelling, adu_area, hearing_date
+    def __init__(self, directory, max_size=CACHE_SIZE):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('the stage cache needs pyarrow, please install it (pip install pyarrow)')
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        #the limit may have been lowered since the last run
+        self.evict()
+    
+    #key of a stage run on the dataframe data
+    def key(self, description, function, data):
+        digest = hashlib.sha1(('%s\n%s\n%s\n' % (CACHE_VERSION, description, code_version(function))).encode())
+        for col in data.columns:
+            #parquet gives back text columns as strings, even if they went in as objects
+            dtype = data[col].dtype
+            dtype = 'text' if dtype == object or isinstance(dtype, pd.StringDtype) else dtype
+            digest.update(('%s %s\n' % (col, dtype)).encode())
+            digest.update(pd.util.hash_pandas_object(data[col]).values.tobytes())
+        return digest.hexdigest()
+    
+    #the (tables, columns) result stored under key, or None
+    def get(self, key):
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            tables = {f[:-len('.parquet')]: pd.read_parquet(os.path.join(path, f))
+                      for f in os.listdir(path) if f.endswith('.parquet') and f != self.COLUMNS}
+            columns = pd.read_parquet(os.path.join(path, self.COLUMNS))
+        except Exception as e:
+            print('Warning in stage_cache: could not read %s: %s' % (key, e))
+            return None
+        #mark it as recently used
+        os.utime(path)
+        return tables, {col: columns[col] for col in columns.columns}
+    
+    def put(self, key, result):
+        tables, columns = result
+        path = os.path.join(self.directory, key)
+        #written under a temporary name first, so that a crash never leaves half an entry
+        tmp = tempfile.mkdtemp(prefix='.tmp', dir=self.directory)
+        try:
+            for name, table in tables.items():
+                table.to_parquet(os.path.join(tmp, name + '.parquet'))
+            pd.DataFrame(columns).to_parquet(os.path.join(tmp, self.COLUMNS))
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmp, path)
+        except Exception as e:
+            print('Warning in stage_cache: could not store %s: %s' % (key, e))
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.evict()
+    
+    #deletes the least recently used entries until the cache fits in max_size
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.tmp') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+    
+    #read_source(source), from the cache if the file, its field catalogue and read_source() haven't changed
+    def source(self, source):
+        fields = field_source(source)
+        size, mtime = source_stat(source)
+        with open(fields, 'rb') as f:
+            catalogue = f.read()
+        key = hashlib.sha1(('%s\n%s\n%s\n%s\n%s\n' % (CACHE_VERSION, os.path.abspath(source), size, mtime,
+                                                       code_version(read_source))).encode() + catalogue).hexdigest()
+        result = self.get(key)
+        if result is not None:
+            print('Using cached %s' % source)
+            return result[0]['source']
+        data = read_source(source, fields)
+        self.put(key, ({'source': data}, {}))
+        return data
+
+#hash of the code of function, and of everything in its module it uses by name: the functions and classes
+#it calls (recursively) and the constants it reads. Editing any of them changes the hash.
+def code_version(function):
+    module = function.__globals__
+    seen = set()
+    parts = []
+    
+    def names(code):
+        yield from code.co_names
+        for const in code.co_consts:
+            if inspect.iscode(const):
+                yield from names(const)
+    
+    def visit(name):
+        if name in seen or name not in module:
+            return
+        seen.add(name)
+        obj = module[name]
+        if inspect.ismodule(obj):
+            return
+        if inspect.isfunction(obj) or inspect.isclass(obj):
+            try:
+                parts.append(inspect.getsource(obj))
+            except (OSError, TypeError):
+                #(namedtuples have no source of their own)
+                parts.append(repr(obj))
+            functions = [obj] if inspect.isfunction(obj) else [f for f in vars(obj).values() if inspect.isfunction(f)]
+            for f in functions:
+                for n in names(f.__code__):
+                    visit(n)
+        else:
+            parts.append('%s = %r' % (name, obj))
+    
+    visit(function.__name__)
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
 
 #initializes a sql database, given all the appropriate pandas tables, and a target destination
-#for the database schema, please see database_structure.xlsx
+#metrics is an optional profiler, which measures the write of each table and index
 def init_sql_database(destination, data, record_type, record_rel, location, planner, prj_desc,
-                      prj_desc_detail, land_use, prj_feature, dwelling, adu_area, hearing_date):
-    con = lite.connect(destination)
+                      prj_desc_detail, land_use, prj_feature, dwelling, adu_area, hearing_date, metrics=None):
+    if metrics is None:
+        metrics = profiler()
+    con = build_connection(destination)
     try:
-        cur = con.cursor()
-        
-        ### record
-        sqlcmd = '''
-        create table record( 
-            %s integer primary key autoincrement,
-            %s text,
-            %s integer, 
-            %s integer, 
-            %s text, %s integer, %s text,
-            %s text, %s text, %s text,
-            %s real, %s text, %s text, %s text,
-            %s integer, %s integer, %s integer,
-            %s integer, %s integer, %s integer
-             )''' % (RECORD_PK, RECORD_FK_TYPE, RECORD_FK_PLANNER, RECORD_FK_LOCATION, RECORD_ID,
-                     RECORD_OBJECT_ID, RECORD_TEMPLATE_ID, RECORD_NAME, RECORD_DESCRIPTION, RECORD_STATUS,
-                     RECORD_CONSTRUCT_COST, RECORD_BUILDING_PERMIT, RECORD_ACALINK, RECORD_AALINK,
-                     RECORD_YEAR_OPENED, RECORD_MONTH_OPENED, RECORD_DAY_OPENED,
-                     RECORD_YEAR_CLOSED, RECORD_MONTH_CLOSED, RECORD_DAY_CLOSED)
-        cur.execute(sqlcmd)
-        #create new dataframe with only the desired columns, relabeled as needed
-        data_transfer = pd.DataFrame({                
-              RECORD_FK_PLANNER:data['planner_id_int'],RECORD_FK_LOCATION:data['location_id'],
-              RECORD_FK_TYPE:data['record_type_category'],RECORD_ID:data['record_id'],
-              RECORD_NAME:data['record_name'],RECORD_DESCRIPTION:data['description'],
-              RECORD_STATUS:data['record_status'],
-              RECORD_OBJECT_ID:data['OBJECTID'],RECORD_TEMPLATE_ID:data['templateid'],
-              RECORD_CONSTRUCT_COST:data['constructcost'], RECORD_BUILDING_PERMIT:data['RELATED_BUILDING_PERMIT'],
-              RECORD_ACALINK:data['acalink'],RECORD_AALINK:data['aalink'],
-              RECORD_YEAR_OPENED:data['year_opened'], RECORD_MONTH_OPENED:data['month_opened'], RECORD_DAY_OPENED:data['day_opened'],
-              RECORD_YEAR_CLOSED:data['year_closed'], RECORD_MONTH_CLOSED:data['month_closed'], RECORD_DAY_CLOSED:data['day_closed']
-            })
-        data_transfer.to_sql('record',con,if_exists='append',index_label=RECORD_PK)
-        
-        #to_sql will do a bunch of this stuff for me,
-        #but I think it's better to explicitly create the table to ensure all the types are correct
-        
-        ### planner
-        sqlcmd = '''create table planner(
-            %s integer primary key autoincrement,
-            %s text, %s text, %s text, %s text)''' % (PLANNER_PK,PLANNER_ID,PLANNER_NAME,PLANNER_EMAIL,PLANNER_PHONE)
-        cur.execute(sqlcmd)
-        planner.to_sql('planner',con,if_exists='append',index=False)
-        
-        ### record_type
-        sqlcmd = '''create table record_type(
-            %s text primary key,
-            %s text, %s text, %s text,
-            %s text, %s text)''' % (RECORD_TYPE_PK,RECORD_TYPE,RECORD_TYPE_SUBTYPE,RECORD_TYPE_TYPE,RECORD_TYPE_GROUP,RECORD_TYPE_MODULE)
-        cur.execute(sqlcmd)
+        #the whole build is a single transaction
+        con.execute('begin')
+        create_tables(con)
+        append_tables(con, data, record_type, record_rel, location, planner, prj_desc,
+                      prj_desc_detail, land_use, prj_feature, dwelling, adu_area, hearing_date, metrics=metrics)
+        #indexes are built after loading, which is much faster than keeping them up to date during inserts
+        create_indexes(con, metrics=metrics)
+        create_spatial_index(con, metrics=metrics)
+        refresh_summaries(con, metrics=metrics)
+        update_search_index(con, metrics=metrics)
+        with metrics.measure('analyze', 'database'):
+            con.execute('analyze')
+            con.commit()
+        finish_build(con)
+    finally:    
+        con.close()
+
+#indexes of the database, as (table, column). These are the foreign keys and record_id, which
+#are what joins and lookups go through. Primary keys are indexed by sqlite already.
+INDEXES = [('record', RECORD_FK_PLANNER), ('record', RECORD_FK_LOCATION), ('record', RECORD_FK_TYPE), ('record', RECORD_ID),
+           ('record', RECORD_DAY_NUMBER_OPENED), ('record', RECORD_DAY_NUMBER_CLOSED),
+           ('land_use', LAND_USE_FK), ('prj_feature', PRJ_FEATURE_FK), ('dwelling', DWELLING_FK),
+           ('prj_desc', PRJ_DESC_FK), ('hearing_date', HEARING_FK),
+           ('record_rel', RECORD_REL_PARENT), ('record_rel', RECORD_REL_CHILD)]
+
+def index_name(table, column):
+    return '%s_%s' % (table, column)
+
+#creates any of the indexes (by default, all of INDEXES) that don't exist yet
+#if metrics (a profiler) is given, each index is measured
+def create_indexes(con, indexes=INDEXES, metrics=None):
+    for table, column in indexes:
+        sqlcmd = 'create index if not exists %s on %s(%s)' % (index_name(table, column), table, column)
+        if metrics is None:
+            con.execute(sqlcmd)
+            continue
+        with metrics.measure('index', index_name(table, column)):
+            con.execute(sqlcmd)
+
+#builds the R*Tree of location bounding boxes (LOCATION_RTREE), for map queries (see records_in_bbox and records_near)
+#locations that aren't in it yet are added, so this also brings it up to date after update() adds some.
+#if metrics (a profiler) is given, it is measured like an index
+def create_spatial_index(con, metrics=None):
+    if metrics is None:
+        metrics = profiler()
+    with metrics.measure('index', LOCATION_RTREE):
+        con.execute('create virtual table if not exists %s using rtree(%s, %s, %s, %s, %s)'
+                    % (LOCATION_RTREE, LOCATION_PK, LOCATION_MIN_X, LOCATION_MAX_X, LOCATION_MIN_Y, LOCATION_MAX_Y))
+        #location ids only ever grow
+        con.execute('''insert into %s select %s, %s, %s, %s, %s from location
+                       where %s is not null and %s > (select coalesce(max(%s), -1) from %s)'''
+                    % (LOCATION_RTREE, LOCATION_PK, LOCATION_MIN_X, LOCATION_MAX_X, LOCATION_MIN_Y, LOCATION_MAX_Y,
+                       LOCATION_MIN_X, LOCATION_PK, LOCATION_PK, LOCATION_RTREE))
+
+#columns returned by records_in_bbox() and records_near() by default
+SPATIAL_COLUMNS = ['record.%s' % RECORD_PK, 'record.%s' % RECORD_ID, 'record.%s' % RECORD_NAME, 'record.%s' % RECORD_FK_TYPE,
+                   'record.%s' % RECORD_STATUS, 'record.%s' % RECORD_DATE_OPENED, 'location.%s' % LOCATION_ADDRESS,
+                   'record.%s' % RECORD_FK_LOCATION, 'location.%s' % LOCATION_CENTROID_X, 'location.%s' % LOCATION_CENTROID_Y]
+#length of a degree of latitude, near enough everywhere
+METERS_PER_DEGREE = 111320
+
+#the records whose location's bounding box overlaps the box from (min_x, min_y) to (max_x, max_y), in degrees like the_geom
+#con is a connection to a database made by create(). columns are the sql expressions to select (record and location
+#can be used as table names), by default SPATIAL_COLUMNS. Returns a dataframe.
+def records_in_bbox(con, min_x, min_y, max_x, max_y, columns=SPATIAL_COLUMNS):
+    #the R*Tree stores 32 bit floats rounded outwards, so it finds a few boxes too many; the location table has the exact ones
+    sqlcmd = '''select %s from %s as rtree
+        join location on location.%s = rtree.%s
+        join record on record.%s = location.%s
+        where rtree.%s <= ? and rtree.%s >= ? and rtree.%s <= ? and rtree.%s >= ?
+        and location.%s <= ? and location.%s >= ? and location.%s <= ? and location.%s >= ?''' % (
+        ', '.join(columns), LOCATION_RTREE, LOCATION_PK, LOCATION_PK, RECORD_FK_LOCATION, LOCATION_PK,
+        LOCATION_MIN_X, LOCATION_MAX_X, LOCATION_MIN_Y, LOCATION_MAX_Y,
+        LOCATION_MIN_X, LOCATION_MAX_X, LOCATION_MIN_Y, LOCATION_MAX_Y)
+    return pd.read_sql(sqlcmd, con, params=[max_x, min_x, max_y, min_y]*2)
+
+#the records whose location's centroid is within meters of the point (x, y) (longitude and latitude), nearest first
+#the distance in meters is in the distance column. See records_in_bbox() for con and columns.
+def records_near(con, x, y, meters, columns=SPATIAL_COLUMNS):
+    dy = meters / METERS_PER_DEGREE
+    dx = dy / max(np.cos(np.radians(y)), 1e-6)
+    centroids = ['location.%s' % LOCATION_CENTROID_X, 'location.%s' % LOCATION_CENTROID_Y]
+    records = records_in_bbox(con, x - dx, y - dy, x + dx, y + dy, columns=list(columns) + centroids)
+    #the last two columns are the centroid, which may also be among columns
+    cx, cy = records.iloc[:, -2].values, records.iloc[:, -1].values
+    records = records.iloc[:, :-2]
+    #flat earth, which is plenty at the scale of a city
+    distance = METERS_PER_DEGREE * np.hypot((cx - x) * np.cos(np.radians(y)), cy - y)
+    records['distance'] = distance
+    return records[distance <= meters].sort_values('distance', kind='stable').reset_index(drop=True)
+
+#quarter a record was opened in, like 2018 Q3 (as in the notebooks and combined.tsv), as sql on the record table r
+SUMMARY_QUARTER = "cast(r.%s as integer) || ' Q' || ((cast(r.%s as integer) + 2) / 3)" % (RECORD_YEAR_OPENED, RECORD_MONTH_OPENED)
+#the prj_feature types that count housing units
+UNIT_FEATURES = ['AFFORDABLE', 'MARKET_RATE']
+#proposed units from which a project counts as a large building, as in the permits-large-buildings charts
+LARGE_PROJECT_UNITS = 25
+_unit_features = ', '.join("'%s'" % feature for feature in UNIT_FEATURES)
+_record_units = 'select r.*, (select sum(f.%s) from prj_feature f where f.%s = r.%s and f.%s in (%s)) as units from record r' % (
+    PRJ_FEATURE_PROP, PRJ_FEATURE_FK, RECORD_PK, PRJ_FEATURE_TYPE, _unit_features)
+
+#pre-aggregated tables for the charts of the notebooks, kept up to date by refresh_summaries(), as {table: (columns, query)}
+#each query aggregates the records r matched by %(where)s by quarter, into the columns (quarter is always the first)
+#units are the AFFORDABLE and MARKET_RATE units of prj_feature
+SUMMARIES = {
+    #units and net units by quarter, record type and status
+    'summary_units': ('quarter text, category text, status text, records integer, units integer, net_units integer', '''
+        select %s, r.%s, r.%s, count(distinct r.%s), coalesce(sum(f.%s), 0), coalesce(sum(f.%s), 0)
+        from record r left join prj_feature f on f.%s = r.%s and f.%s in (%s)
+        where %%(where)s group by 1, 2, 3''' % (SUMMARY_QUARTER, RECORD_FK_TYPE, RECORD_STATUS, RECORD_PK,
+                                               PRJ_FEATURE_PROP, PRJ_FEATURE_NET, PRJ_FEATURE_FK, RECORD_PK, PRJ_FEATURE_TYPE, _unit_features)),
+    #affordable and market rate units by quarter and record type, and the number of records proposing either
+    'summary_affordable': ('quarter text, category text, affordable_records integer, affordable_units integer, affordable_net integer, '
+                           'market_rate_records integer, market_rate_units integer, market_rate_net integer', '''
+        select %s, r.%s,
+            count(distinct case when f.%s = 'AFFORDABLE' then r.%s end),
+            coalesce(sum(case when f.%s = 'AFFORDABLE' then f.%s end), 0), coalesce(sum(case when f.%s = 'AFFORDABLE' then f.%s end), 0),
+            count(distinct case when f.%s = 'MARKET_RATE' then r.%s end),
+            coalesce(sum(case when f.%s = 'MARKET_RATE' then f.%s end), 0), coalesce(sum(case when f.%s = 'MARKET_RATE' then f.%s end), 0)
+        from record r join prj_feature f on f.%s = r.%s and f.%s in (%s)
+        where %%(where)s group by 1, 2''' % ((SUMMARY_QUARTER, RECORD_FK_TYPE)
+                                           + (PRJ_FEATURE_TYPE, RECORD_PK) + (PRJ_FEATURE_TYPE, PRJ_FEATURE_PROP, PRJ_FEATURE_TYPE, PRJ_FEATURE_NET)
+                                           + (PRJ_FEATURE_TYPE, RECORD_PK) + (PRJ_FEATURE_TYPE, PRJ_FEATURE_PROP, PRJ_FEATURE_TYPE, PRJ_FEATURE_NET)
+                                           + (PRJ_FEATURE_FK, RECORD_PK, PRJ_FEATURE_TYPE, _unit_features))),
+    #records (permits and applications) by quarter and record type: all of them, those proposing housing units,
+    #those proposing LARGE_PROJECT_UNITS or more, and those with a related building permit
+    'summary_permits': ('quarter text, category text, records integer, residential_records integer, large_records integer, '
+                        'building_permit_records integer', '''
+        select %s, r.%s, count(*), coalesce(sum(r.units > 0), 0), coalesce(sum(r.units >= %d), 0),
+            coalesce(sum(r.%s is not null and r.%s != ''), 0)
+        from (%s) r
+        where %%(where)s group by 1, 2''' % (SUMMARY_QUARTER, RECORD_FK_TYPE, LARGE_PROJECT_UNITS,
+                                           RECORD_BUILDING_PERMIT, RECORD_BUILDING_PERMIT, _record_units)),
+}
+
+#rebuilds the rows of the summary tables (SUMMARIES) for the quarters of the records opened on the day numbers in days
+#(RECORD_DAY_NUMBER_OPENED, nan for records without a date), or all of them if days is None. Only the records of
+#those quarters are read, through the day_number_opened index. The tables are created if they don't exist yet.
+#nothing is committed here. metrics is an optional profiler.
+def refresh_summaries(con, days=None, metrics=None):
+    if metrics is None:
+        metrics = profiler()
+    if days is None:
+        ranges = None
+    else:
+        days = pd.Series(days, dtype=float)
+        starts = pd.to_datetime(days.dropna().unique(), unit='D').to_period('Q').unique()
+        ranges = [('%d Q%d' % (q.year, q.quarter), (q.start_time - pd.Timestamp(0)).days, ((q + 1).start_time - pd.Timestamp(0)).days) for q in starts]
+        if days.isna().any():
+            ranges.append((None, None, None))
+    for table, (columns, query) in SUMMARIES.items():
+        with metrics.measure('summary', table) as entry:
+            con.execute('create table if not exists %s(%s)' % (table, columns))
+            con.execute('create index if not exists %s on %s(quarter)' % (index_name(table, 'quarter'), table))
+            if ranges is None:
+                con.execute('delete from %s' % table)
+                con.execute('insert into %s %s' % (table, query % {'where':'1'}))
+            else:
+                for quarter, start, stop in ranges:
+                    if quarter is None:
+                        con.execute('delete from %s where quarter is null' % table)
+                        con.execute('insert into %s %s' % (table, query % {'where':'r.%s is null' % RECORD_DAY_NUMBER_OPENED}))
+                        continue
+                    con.execute('delete from %s where quarter = ?' % table, (quarter,))
+                    con.execute('insert into %s %s' % (table, query % {'where':'r.%s >= ? and r.%s < ?'
+                                                                         % (RECORD_DAY_NUMBER_OPENED, RECORD_DAY_NUMBER_OPENED)}),
+                                (start, stop))
+            entry['rows_out'] = con.execute('select count(*) from %s' % table).fetchone()[0]
+
+#FTS5 index of the text of every record: its name, description and the address of its location, with the record id as rowid
+#porter stems words (so "densities" finds "density"), and the prefix indexes make prefix searches like "MISS*" fast
+RECORD_SEARCH = "record_search"
+#bm25 weights of name, description and address: a word in the name or address says more than one in a long description
+SEARCH_WEIGHTS = (2.0, 1.0, 2.0)
+#words around the match in the snippets of search_records()
+SNIPPET_WORDS = 16
+
+#brings the search index (RECORD_SEARCH) up to date with the records whose ids are in ids (added, changed or deleted),
+#or indexes every record if ids is None. The index is created if it doesn't exist yet.
+#nothing is committed here. metrics is an optional profiler.
+def update_search_index(con, ids=None, metrics=None):
+    if metrics is None:
+        metrics = profiler()
+    with metrics.measure('index', RECORD_SEARCH) as entry:
+        if con.execute("select 1 from sqlite_master where name = ?", (RECORD_SEARCH,)).fetchone() is None:
+            #(a database from before the index, which needs all of its records indexed)
+            ids = None
+        con.execute("create virtual table if not exists %s using fts5(%s, %s, %s, tokenize='porter unicode61', prefix='2 3')"
+                    % (RECORD_SEARCH, RECORD_NAME, RECORD_DESCRIPTION, LOCATION_ADDRESS))
+        sqlcmd = '''insert into %s(rowid, %s, %s, %s) select r.%s, r.%s, r.%s, l.%s
+            from record r left join location l on l.%s = r.%s''' % (RECORD_SEARCH, RECORD_NAME, RECORD_DESCRIPTION, LOCATION_ADDRESS,
+                                                                    RECORD_PK, RECORD_NAME, RECORD_DESCRIPTION, LOCATION_ADDRESS,
+                                                                    LOCATION_PK, RECORD_FK_LOCATION)
+        if ids is None:
+            con.execute('delete from %s' % RECORD_SEARCH)
+            con.execute(sqlcmd)
+        else:
+            con.execute('create temp table search_ids(id integer primary key)')
+            con.executemany('insert or ignore into search_ids values (?)', [(int(i),) for i in ids])
+            con.execute('delete from %s where rowid in temp.search_ids' % RECORD_SEARCH)
+            con.execute(sqlcmd + ' where r.%s in temp.search_ids' % RECORD_PK)
+            con.execute('drop table temp.search_ids')
+        entry['rows_out'] = con.execute('select count(*) from %s' % RECORD_SEARCH).fetchone()[0]
+
+#turns what someone typed (like: density bonus, or 24TH ST) into an FTS5 query that finds every word, whole or
+#as a prefix (whole words rank higher), so that punctuation in the text can't be taken for query syntax
+def search_query(text):
+    words = re.findall(r'\w+', text)
+    if not words:
+        raise ValueError('nothing to search for in %r' % text)
+    return ' AND '.join('("%s" OR "%s"*)' % (word, word) for word in words)
+
+#the records matching text (see search_query, or an FTS5 query if raw is True), best match first, with their
+#record type and address, and a snippet of the matching text with the matches in [brackets] (lower score is better)
+#con is a connection to a database made by create(). Returns a dataframe of at most limit rows.
+def search_records(con, text, limit=50, raw=False):
+    sqlcmd = '''select r.%s, r.%s, r.%s, r.%s, r.%s, r.%s, s.%s,
+        snippet(%s, -1, '[', ']', '...', %d) as snippet, bm25(%s, %s) as score
+        from %s s join record r on r.%s = s.rowid
+        where %s match ? order by score limit ?''' % (RECORD_PK, RECORD_ID, RECORD_NAME, RECORD_FK_TYPE, RECORD_STATUS,
+                                                       RECORD_DATE_OPENED, LOCATION_ADDRESS, RECORD_SEARCH, SNIPPET_WORDS,
+                                                       RECORD_SEARCH, ', '.join(map(str, SEARCH_WEIGHTS)), RECORD_SEARCH,
+                                                       RECORD_PK, RECORD_SEARCH)
+    return pd.read_sql(sqlcmd, con, params=(text if raw else search_query(text), limit))
+
+#pragmas used while building a new database: a large page cache, and no journal file or syncing to disk.
+#a crash part way through a build leaves a broken file, but it would be rebuilt from scratch anyway.
+#page_size only takes effect because it is set before any table is created.
+BUILD_PRAGMAS = [('page_size', 16384), ('cache_size', -65536), ('journal_mode', 'MEMORY'), ('synchronous', 'OFF')]
+#pragmas restored at the end of a build, for whoever uses the database afterwards
+SAFE_PRAGMAS = [('journal_mode', 'DELETE'), ('synchronous', 'FULL')]
+
+#opens a connection to a new database, set up for a fast build
+def build_connection(destination):
+    con = lite.connect(destination)
+    for pragma, value in BUILD_PRAGMAS:
+        con.execute('pragma %s = %s' % (pragma, value))
+    return con
+
+#restores safe settings on a connection from build_connection(), once everything is committed
+def finish_build(con):
+    for pragma, value in SAFE_PRAGMAS:
+        con.execute('pragma %s = %s' % (pragma, value))
+
+#creates all the (empty) tables of the database
+#for the database schema, please see database_structure.xlsx
+def create_tables(con):
+    cur = con.cursor()
+    
+    ### record
+    sqlcmd = '''
+    create table record( 
+        %s integer primary key autoincrement,
+        %s text,
+        %s integer, 
+        %s integer, 
+        %s text, %s integer, %s text,
+        %s text, %s text, %s text,
+        %s real, %s text, %s text, %s text,
+        %s integer, %s integer, %s integer,
+        %s integer, %s integer, %s integer,
+        %s text, %s text, %s integer, %s integer,
+        %s integer
+         )''' % (RECORD_PK, RECORD_FK_TYPE, RECORD_FK_PLANNER, RECORD_FK_LOCATION, RECORD_ID,
+                 RECORD_OBJECT_ID, RECORD_TEMPLATE_ID, RECORD_NAME, RECORD_DESCRIPTION, RECORD_STATUS,
+                 RECORD_CONSTRUCT_COST, RECORD_BUILDING_PERMIT, RECORD_ACALINK, RECORD_AALINK,
+                 RECORD_YEAR_OPENED, RECORD_MONTH_OPENED, RECORD_DAY_OPENED,
+                 RECORD_YEAR_CLOSED, RECORD_MONTH_CLOSED, RECORD_DAY_CLOSED,
+                 RECORD_DATE_OPENED, RECORD_DATE_CLOSED, RECORD_DAY_NUMBER_OPENED, RECORD_DAY_NUMBER_CLOSED,
+                 RECORD_SOURCE_HASH)
+    cur.execute(sqlcmd)
+    
+    #to_sql will do a bunch of this stuff for me,
+    #but I think it's better to explicitly create the table to ensure all the types are correct
+    
+    ### planner
+    sqlcmd = '''create table planner(
+        %s integer primary key autoincrement,
+        %s text, %s text, %s text, %s text)''' % (PLANNER_PK,PLANNER_ID,PLANNER_NAME,PLANNER_EMAIL,PLANNER_PHONE)
+    cur.execute(sqlcmd)
+    
+    ### record_type
+    sqlcmd = '''create table record_type(
+        %s text primary key,
+        %s text, %s text, %s text,
+        %s text, %s text)''' % (RECORD_TYPE_PK,RECORD_TYPE,RECORD_TYPE_SUBTYPE,RECORD_TYPE_TYPE,RECORD_TYPE_GROUP,RECORD_TYPE_MODULE)
+    cur.execute(sqlcmd)
+    
+    ### location
+    sqlcmd = '''create table location(
+        %s integer primary key autoincrement,
+        %s text, %s text, %s real, %s real,
+        %s real, %s real, %s real, %s real, %s real, %s real)''' % (LOCATION_PK,LOCATION_GEOM,LOCATION_ADDRESS,LOCATION_SHAPE_LENGTH,LOCATION_SHAPE_AREA,
+                                                      LOCATION_CENTROID_X,LOCATION_CENTROID_Y,LOCATION_MIN_X,LOCATION_MAX_X,LOCATION_MIN_Y,LOCATION_MAX_Y)
+    cur.execute(sqlcmd)
+    
+    ### prj_desc
+    sqlcmd = '''create table prj_desc(
+        %s integer primary key autoincrement,
+        %s integer, %s text)''' % (PRJ_DESC_PK, PRJ_DESC_FK, PRJ_DESC_TYPE)
+    cur.execute(sqlcmd)
+    
+    ### prj_desc_detail
+    sqlcmd = '''create table prj_desc_detail(
+        %s integer primary key,
+        %s text)''' % (PRJ_DESC_DETAIL_PK, PRJ_DESC_DETAIL)
+    cur.execute(sqlcmd)
+    
+    ### land_use
+    sqlcmd = '''create table land_use(
+        %s integer primary key autoincrement,
+        %s integer,
+        %s text, %s real, %s real,%s real)''' % (LAND_USE_PK, LAND_USE_FK, LAND_USE_TYPE, LAND_USE_EXIST, LAND_USE_PROP, LAND_USE_NET)
+    cur.execute(sqlcmd)
+    
+    ### prj_feature
+    sqlcmd = '''create table prj_feature(
+        %s integer primary key autoincrement,
+        %s integer,
+        %s text, %s integer, %s integer, %s integer)''' % (PRJ_FEATURE_PK, PRJ_FEATURE_FK, PRJ_FEATURE_TYPE, PRJ_FEATURE_EXIST, PRJ_FEATURE_PROP, PRJ_FEATURE_NET)
+    cur.execute(sqlcmd)
+    
+    ### dwelling
+    sqlcmd = '''create table dwelling(
+        %s integer primary key autoincrement,
+        %s integer,
+        %s text, %s integer, %s integer, %s integer)''' % (DWELLING_PK, DWELLING_FK, DWELLING_TYPE, DWELLING_EXIST, DWELLING_PROP, DWELLING_NET)
+    cur.execute(sqlcmd)
+                       
+    ### adu_area
+    sqlcmd = '''create table adu_area(
+        %s integer primary key,
+        %s real)''' % (ADU_PK, ADU_AREA)
+    cur.execute(sqlcmd)
+    
+    ### record_rel
+    sqlcmd = '''create table record_rel(
+        %s integer primary key autoincrement,
+        %s integer, %s integer)''' % (RECORD_REL_PK, RECORD_REL_PARENT, RECORD_REL_CHILD)
+    cur.execute(sqlcmd)
+    
+    ### hearing_date
+    sqlcmd = '''create table hearing_date(
+        %s integer primary key,
+        %s integer, %s text, %s text)''' % (HEARING_PK, HEARING_FK, HEARING_TYPE, HEARING_DATE)
+    cur.execute(sqlcmd)
+
+#appends pandas tables to the tables made by create_tables()
+#any table that is None is skipped, so this can also be used to write the database piece by piece
+#nothing is committed here. If metrics (a profiler) is given, the write of each table is measured.
+def append_tables(con, data=None, record_type=None, record_rel=None, location=None, planner=None, prj_desc=None,
+                  prj_desc_detail=None, land_use=None, prj_feature=None, dwelling=None, adu_area=None, hearing_date=None,
+                  metrics=None):
+    for table, frame, index_label in output_frames(data, record_type, record_rel, location, planner, prj_desc,
+                                                   prj_desc_detail, land_use, prj_feature, dwelling, adu_area, hearing_date):
+        if metrics is None:
+            bulk_insert(con, table, frame, index_label)
+            continue
+        with metrics.measure('table', table, len(frame)):
+            bulk_insert(con, table, frame, index_label)
+
+#the dataframes to write for each table, as (table, frame, index_label), where index_label names the column
+#the index is written to (if it is written at all). Tables that are None are left out.
+def output_frames(data=None, record_type=None, record_rel=None, location=None, planner=None, prj_desc=None,
+                  prj_desc_detail=None, land_use=None, prj_feature=None, dwelling=None, adu_area=None, hearing_date=None):
+    if data is not None:
+        data = record_frame(data)
+    if record_type is not None:
         #there was an extra column that I don't want to write to the db
         record_type = record_type.drop(labels='original_type',axis=1)
-        record_type.to_sql('record_type',con,if_exists='append',index=False)
-        
-        ### location
-        sqlcmd = '''create table location(
-            %s integer primary key autoincrement,
-            %s text, %s text, %s real, %s real)''' % (LOCATION_PK,LOCATION_GEOM,LOCATION_ADDRESS,LOCATION_SHAPE_LENGTH,LOCATION_SHAPE_AREA)
-        cur.execute(sqlcmd)
-        location.to_sql('location',con,if_exists='append',index=False)
-        
-        ### prj_desc
-        sqlcmd = '''create table prj_desc(
-            %s integer primary key autoincrement,
-            %s integer, %s text)''' % (PRJ_DESC_PK, PRJ_DESC_FK, PRJ_DESC_TYPE)
-        cur.execute(sqlcmd)
-        prj_desc.to_sql('prj_desc',con,if_exists='append',index_label=PRJ_DESC_PK)
-        
-        ### prj_desc_detail
-        sqlcmd = '''create table prj_desc_detail(
-            %s integer primary key,
-            %s text)''' % (PRJ_DESC_DETAIL_PK, PRJ_DESC_DETAIL)
-        cur.execute(sqlcmd)
-        prj_desc_detail.to_sql('prj_desc_detail',con,if_exists='append',index=False)
-        
-        ### land_use
-        sqlcmd = '''create table land_use(
-            %s integer primary key autoincrement,
-            %s integer,
-            %s text, %s real, %s real,%s real)''' % (LAND_USE_PK, LAND_USE_FK, LAND_USE_TYPE, LAND_USE_EXIST, LAND_USE_PROP, LAND_USE_NET)
-        cur.execute(sqlcmd)
-        land_use.to_sql('land_use',con,if_exists='append',index_label=LAND_USE_PK)
-        
-        ### prj_feature
-        sqlcmd = '''create table prj_feature(
-            %s integer primary key autoincrement,
-            %s integer,
-            %s text, %s integer, %s integer, %s integer)''' % (PRJ_FEATURE_PK, PRJ_FEATURE_FK, PRJ_FEATURE_TYPE, PRJ_FEATURE_EXIST, PRJ_FEATURE_PROP, PRJ_FEATURE_NET)
-        cur.execute(sqlcmd)
-        prj_feature.to_sql('prj_feature',con,if_exists='append',index_label=PRJ_FEATURE_PK)
-        
-        ### dwelling
-        sqlcmd = '''create table dwelling(
-            %s integer primary key autoincrement,
-            %s integer,
-            %s text, %s integer, %s integer, %s integer)''' % (DWELLING_PK, DWELLING_FK, DWELLING_TYPE, DWELLING_EXIST, DWELLING_PROP, DWELLING_NET)
-        cur.execute(sqlcmd)
-        dwelling.to_sql('dwelling',con,if_exists='append',index_label=DWELLING_PK)
-                           
-        ### adu_area
-        sqlcmd = '''create table adu_area(
-            %s integer primary key,
-            %s real)''' % (ADU_PK, ADU_AREA)
-        cur.execute(sqlcmd)
-        adu_area.to_sql('adu_area',con,if_exists='append',index=False)
-        
-        ### record_rel
-        sqlcmd = '''create table record_rel(
-            %s integer primary key autoincrement,
-            %s integer, %s integer)''' % (RECORD_REL_PK, RECORD_REL_PARENT, RECORD_REL_CHILD)
-        cur.execute(sqlcmd)
-        record_rel.to_sql('record_rel',con,if_exists='append',index_label=RECORD_REL_PK)
-        
-        ### hearing_date
-        sqlcmd = '''create table hearing_date(
-            %s integer primary key,
-            %s integer, %s text, %s text)''' % (HEARING_PK, HEARING_FK, HEARING_TYPE, HEARING_DATE)
-        cur.execute(sqlcmd)
-        hearing_date.to_sql('hearing_date',con,if_exists='append',index_label=HEARING_PK)
-    finally:    
+    if location is not None:
+        location = location_bounds(location)
+    frames = [('record', data, RECORD_PK), ('planner', planner, None), ('record_type', record_type, None),
+              ('location', location, None), ('prj_desc', prj_desc, PRJ_DESC_PK), ('prj_desc_detail', prj_desc_detail, None),
+              ('land_use', land_use, LAND_USE_PK), ('prj_feature', prj_feature, PRJ_FEATURE_PK),
+              ('dwelling', dwelling, DWELLING_PK), ('adu_area', adu_area, None),
+              ('record_rel', record_rel, RECORD_REL_PK), ('hearing_date', hearing_date, HEARING_PK)]
+    return [(table, frame, index_label) for table, frame, index_label in frames if frame is not None]
+
+#column names and declared types of every table, as {table: [(column, type)]}, taken from create_tables()
+def table_schemas():
+    con = lite.connect(':memory:')
+    try:
+        create_tables(con)
+        tables = [row[0] for row in con.execute("select name from sqlite_master where type = 'table' and name not like 'sqlite_%'")]
+        return {table: [(row[1], row[2].lower()) for row in con.execute('pragma table_info(%s)' % table)] for table in tables}
+    finally:
         con.close()
+
+#writes the tables as zstd compressed parquet files, one per table (e.g. record.parquet), in the directory destination
+#every column gets the type declared for it in create_tables(), and strings are dictionary encoded.
+#needs pyarrow. read_parquet() loads the files back. metrics is an optional profiler.
+def write_parquet(destination, data, record_type, record_rel, location, planner, prj_desc,
+                  prj_desc_detail, land_use, prj_feature, dwelling, adu_area, hearing_date, metrics=None):
+    if metrics is None:
+        metrics = profiler()
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('writing parquet files needs pyarrow, please install it (pip install pyarrow)')
+    
+    os.makedirs(destination, exist_ok=True)
+    schemas = table_schemas()
+    for table, frame, index_label in output_frames(data, record_type, record_rel, location, planner, prj_desc,
+                                                   prj_desc_detail, land_use, prj_feature, dwelling, adu_area, hearing_date):
+        with metrics.measure('parquet', table, len(frame)):
+            if index_label is not None:
+                frame = frame.copy()
+                frame.insert(0, index_label, frame.index)
+            columns = [(column, sql_type) for column, sql_type in schemas[table] if column in frame.columns]
+            arrays = [arrow_array(pa, table, column, frame[column], sql_type) for column, sql_type in columns]
+            pq.write_table(pa.Table.from_arrays(arrays, names=[column for column, _ in columns]),
+                           os.path.join(destination, table + '.parquet'), compression='zstd', use_dictionary=True)
+
+#converts a column to an arrow array of the type matching its sqlite type
+def arrow_array(pa, table, column, values, sql_type):
+    if sql_type == 'text':
+        strings = values.astype(object)
+        #sqlite would store numbers in a text column as text, so do the same
+        strings = strings.where(strings.isna() | strings.map(lambda x: isinstance(x, str)), values.astype(str))
+        return pa.array(strings.where(strings.notna(), None).tolist(), type=pa.string())
+    if sql_type == 'integer' and values.dtype.kind in 'iub':
+        #going through float would round large values like source_hash
+        return pa.array(values.values.astype(np.int64), type=pa.int64())
+    numbers = pd.to_numeric(values, errors='coerce').astype(float)
+    if sql_type == 'integer':
+        if (numbers.dropna() % 1 == 0).all():
+            return pa.array(numbers.values, type=pa.int64(), from_pandas=True)
+        #sqlite keeps fractional values in integer columns as they are, so don't round them here either
+        print('Warning in write_parquet(): %s.%s has fractional values, written as double' % (table, column))
+    return pa.array(numbers.values, type=pa.float64(), from_pandas=True)
+
+#loads parquet files written by write_parquet() into a dict of dataframes
+#tables can list the tables to load (by default, every file in directory)
+def read_parquet(directory, tables=None):
+    import pyarrow.parquet as pq
+    if tables is None:
+        tables = sorted(f[:-len('.parquet')] for f in os.listdir(directory) if f.endswith('.parquet'))
+    return {table: pq.read_table(os.path.join(directory, table + '.parquet')).to_pandas() for table in tables}
+
+#rows per executemany() call in bulk_insert(), which bounds the number of python objects alive at once
+BULK_BATCH = 50000
+
+#writes a dataframe into an existing table, through one prepared insert statement
+#if index_label is given, the index is written too, as that column. Returns the number of rows written.
+def bulk_insert(con, table, frame, index_label=None):
+    columns = list(frame.items())
+    if index_label is not None:
+        columns = [(index_label, frame.index.to_series())] + columns
+    sqlcmd = 'insert into %s (%s) values (%s)' % (table, ', '.join(name for name, _ in columns), ', '.join('?'*len(columns)))
+    for start in range(0, len(frame), BULK_BATCH):
+        values = [sql_values(column.iloc[start:start+BULK_BATCH]) for _, column in columns]
+        con.executemany(sqlcmd, zip(*values))
+    return len(frame)
+
+#converts a column to a list of python values that sqlite3 can store, with None for missing values
+def sql_values(column):
+    if isinstance(column.dtype, np.dtype) and column.dtype.kind in 'biufO':
+        #numpy already gives python objects, and sqlite stores nan as null
+        return column.values.tolist()
+    #extension types (categories, nullable integers, strings) can hold missing values sqlite3 doesn't understand
+    return column.to_numpy(dtype=object, na_value=None).tolist()
+
+#create new dataframe with only the columns of the record table, relabeled as needed
+def record_frame(data):
+    return pd.DataFrame({                
+          RECORD_FK_PLANNER:data['planner_id_int'],RECORD_FK_LOCATION:data['location_id'],
+          RECORD_FK_TYPE:data['record_type_category'],RECORD_ID:data['record_id'],
+          RECORD_NAME:data['record_name'],RECORD_DESCRIPTION:data['description'],
+          RECORD_STATUS:data['record_status'],
+          RECORD_OBJECT_ID:data['OBJECTID'],RECORD_TEMPLATE_ID:data['templateid'],
+          RECORD_CONSTRUCT_COST:data['constructcost'], RECORD_BUILDING_PERMIT:data['RELATED_BUILDING_PERMIT'],
+          RECORD_ACALINK:data['acalink'],RECORD_AALINK:data['aalink'],
+          RECORD_YEAR_OPENED:data['year_opened'], RECORD_MONTH_OPENED:data['month_opened'], RECORD_DAY_OPENED:data['day_opened'],
+          RECORD_YEAR_CLOSED:data['year_closed'], RECORD_MONTH_CLOSED:data['month_closed'], RECORD_DAY_CLOSED:data['day_closed'],
+          RECORD_DATE_OPENED:data['date_opened'], RECORD_DATE_CLOSED:data['date_closed'],
+          RECORD_DAY_NUMBER_OPENED:data['day_number_opened'], RECORD_DAY_NUMBER_CLOSED:data['day_number_closed'],
+          RECORD_SOURCE_HASH:data['source_hash']
+        })
+
+#hash of each row of the source, as it was read. Used by update() to find records that have changed.
+def source_hash(data):
+    columns = sorted(data.columns)
+    #sqlite integers are signed
+    return pd.util.hash_pandas_object(data[columns],index=False).values.view(np.int64)
     
 #and creates a new dataframe record_type, which will eventually be made into a SQL table.
+#all categories are resolved at once from a handful of representative rows, rather than rescanning the data per category
 def record_type_table(data):
-    record_type = pd.DataFrame({'original_type':data['record_type_category'].unique()})
-    
-    #Go through each original_type, standardize the format and find associated info
-    for i, og_type in enumerate(record_type['original_type'].unique()):
-        #find first row with this record type
-        flag = False
-        for j, r_type in enumerate(data['record_type_category']):
-            if(r_type == og_type):
-                record_type.loc[i,RECORD_TYPE] = data.loc[j,'record_type']
-                record_type.loc[i,RECORD_TYPE_TYPE] = data.loc[j,'record_type_type']
-                record_type.loc[i,RECORD_TYPE_SUBTYPE] = data.loc[j,'record_type_subtype']
-                record_type.loc[i,RECORD_TYPE_GROUP] = data.loc[j,'record_type_group']
-                record_type.loc[i,RECORD_TYPE_MODULE] = data.loc[j,'module']
-                #check if format is standardized
-                m = re.match('^(...)$',og_type)
-                if(m or og_type=="Other"):
-                    record_type.loc[i,RECORD_TYPE] = og_type
-                    flag = True
-                    break
-                else:
-                    #if format is not standardized, try to find the acronym
-                    m = re.match('^.* \((...)\)',data.loc[j,'record_type'])
-                    if(m):
-                        record_type.loc[i,RECORD_TYPE] = m.groups()[0]
-                        flag = True
-                        break
-                    else:
-                        record_type.loc[i,RECORD_TYPE] = og_type
-                        #if no acronym is found, better keep looking by continuing the for loop
-        #if no acronym is ever found, then we have a real problem
-        if not flag:
-            print('Error in record_type_table(): Could not determine acronym for %s' % og_type)
+    categories = data['record_type_category']
+    record_type = pd.DataFrame({'original_type':categories.unique()})
+    og_types = record_type['original_type']
+    
+    #a category is already standardized if it is a 3 letter acronym (or "Other")
+    standardized = (og_types.str.match('^(...)$') | (og_types == "Other")).values
+    #otherwise, the acronym can be found from any row whose record_type looks like "... (XXX)"
+    unresolved = ~categories.isin(og_types[standardized]).values
+    acronyms = data['record_type'][unresolved].str.extract('^.* \\((...)\\)',expand=False)
+    acronyms = acronyms.reindex(data.index)
+    
+    #row positions of the first row, the last row, and the first row with an acronym, for each category
+    rows = pd.Series(np.arange(len(data)),index=categories.values)
+    first_row = rows[~rows.index.duplicated(keep='first')].reindex(og_types).values
+    last_row = rows[~rows.index.duplicated(keep='last')].reindex(og_types).values
+    rows = rows[acronyms.notna().values]
+    acronym_row = rows[~rows.index.duplicated(keep='first')].reindex(og_types).values
+    found = ~np.isnan(acronym_row)
+    
+    #standardized categories take their info from the first row
+    #the rest take it from the first row with an acronym, or from the last row if there is none
+    source = np.where(standardized, first_row, np.where(found, acronym_row, last_row)).astype(int)
+    names = np.where(np.logical_or(standardized, ~found), og_types.values, acronyms.values[source])
+    
+    record_type[RECORD_TYPE] = names
+    record_type[RECORD_TYPE_TYPE] = data['record_type_type'].values[source]
+    record_type[RECORD_TYPE_SUBTYPE] = data['record_type_subtype'].values[source]
+    record_type[RECORD_TYPE_GROUP] = data['record_type_group'].values[source]
+    record_type[RECORD_TYPE_MODULE] = data['module'].values[source]
+    
+    #if no acronym is ever found, then we have a real problem
+    for og_type in og_types[np.logical_and(~standardized, ~found)]:
+        print('Error in record_type_table(): Could not determine acronym for %s' % og_type)
     
     return record_type
 
+#the few rows of data that record_type_table() depends on: the first and last row of each category,
+#and the first row of each category with an acronym. Running record_type_table() on these rows gives the same table.
+def record_type_rows(data):
+    categories = data['record_type_category']
+    acronym = data['record_type'].str.match('^.* \\((...)\\)') == True
+    first_acronym = np.zeros(len(data),dtype=bool)
+    first_acronym[acronym.values] = ~categories[acronym.values].duplicated().values
+    keep = ~categories.duplicated(keep='first').values | ~categories.duplicated(keep='last').values | first_acronym
+    return data.loc[keep, ['record_type_category','record_type','record_type_type',
+                           'record_type_subtype','record_type_group','module']]
+
 #clean the record_type_category column through use of the record_type table
 def clean_record_type(data,record_type):
-    record_type_dict = {}
-    for row in record_type.index:
-        record_type_dict[record_type.loc[row,'original_type']] = record_type.loc[row,RECORD_TYPE]
-    data['record_type_category'] = data.apply(lambda row: record_type_dict[row['record_type_category']],axis=1)
+    record_type_map = pd.Series(record_type[RECORD_TYPE].values,index=record_type['original_type'].values)
+    data['record_type_category'] = data['record_type_category'].map(record_type_map)
     return data
 
 #create a new dataframe for parent/child relationships
 #parent_id and child_id go by the index of the dataframe, rather than the record_id
 def record_rel_table(data):
-    child_list = []
-    parent_list = []
-    
-    #this goes much faster if we turn record_id into the index column
-    data_reind = data.copy()
-    data_reind['old_index'] = data.index
-    data_reind = data_reind.set_index('record_id')
-    
-    for curr_row,children_str in enumerate(data['children']):
-        if not pd.isna(children_str):
-            children = children_str.split(',')
-            for child in children:
-                try:
-                    parent_list.append(data_reind.loc[child,'old_index'])
-                    child_list.append(curr_row)
-                except:
-                    pass
-    
-    record_rel = pd.DataFrame({RECORD_REL_CHILD:child_list,RECORD_REL_PARENT:parent_list})
+    #one row per (row position, listed child record_id)
+    children = data['children'].reset_index(drop=True).dropna().str.split(',').explode()
+    
+    #resolve every child in one lookup against the record_id -> row position map
+    positions = pd.Series(np.arange(len(data)),index=data['record_id'].values)
+    positions = positions[~positions.index.duplicated()]
+    child_rows = children.map(positions)
+    resolved = child_rows.notna().values
+    
+    if not resolved.all():
+        print('Warning in record_rel_table(): %d children do not match any record_id' % (~resolved).sum())
+    
+    record_rel = pd.DataFrame({RECORD_REL_CHILD:children.index[resolved],
+                               RECORD_REL_PARENT:child_rows[resolved].astype(int).values})
     return record_rel
 
-#creates a new dataframe for unique locations
-#also adds new column location_id
-def location_table(data):
-    try:
-        newcoltimer = timer()
-        #dict mapping geometry to location_id
-        lid_dict = {}
-        #dict matching location_id to list of indices in original data
-        index_list = {}
-
-        #populate above two dicts
-        lid_counter = int(0)
-        for i,geom in enumerate(data['the_geom']):
-            if geom in lid_dict:
-                index_list[lid_dict[geom]].append(i)
-            else:
-                lid_dict[geom] = lid_counter
-                index_list[lid_counter] = [i]
-                lid_counter += 1
+#fills record_rel from the temporary table record_rel_staging(row, child_record_id), as record_rel_table() would
+def record_rel_from_staging(con):
+    cur = con.cursor()
+    create_indexes(con, [('record', RECORD_ID)])
+    #the temp table numbers the resolved pairs in order, so that ids match those of record_rel_table()
+    cur.execute('''create temp table record_rel_resolved as
+        select s.row as %s, min(r.%s) as %s
+        from record_rel_staging s join record r on r.%s = s.child_record_id
+        group by s.rowid order by s.rowid''' % (RECORD_REL_CHILD, RECORD_PK, RECORD_REL_PARENT, RECORD_ID))
+    cur.execute('''insert into record_rel(%s, %s, %s)
+        select rowid - 1, %s, %s from record_rel_resolved order by rowid'''
+        % (RECORD_REL_PK, RECORD_REL_PARENT, RECORD_REL_CHILD, RECORD_REL_PARENT, RECORD_REL_CHILD))
+    
+    resolved = cur.rowcount
+    unresolved = cur.execute('select count(*) from record_rel_staging').fetchone()[0] - resolved
+    if unresolved > 0:
+        print('Warning in record_rel_table(): %d children do not match any record_id' % unresolved)
+    cur.execute('drop table record_rel_resolved')
+    cur.execute('drop table record_rel_staging')
+
+#generic builder for dimension tables, such as location and planner
+#every distinct value of key_col gets an integer id, in order of first appearance.
+#attributes maps dimension table columns to data columns, and each takes the first non-null value for its key.
+#if dropna is False, missing keys are treated as one more distinct value instead of getting a nan id.
+#data can be added in several pieces (e.g. chunks of a csv), and ids stay consistent between them.
+class dimension():
+    def __init__(self, key_col, key_name, pk, attributes, dropna=True):
+        self.key_col = key_col
+        self.key_name = key_name
+        self.pk = pk
+        self.attributes = attributes
+        self.dropna = dropna
+        self.keys = pd.Index([],dtype=object)
+        self.firsts = None
+    
+    #registers keys that already have ids, such as those in an existing database, in order of id
+    def seed(self, keys):
+        keys = np.array(keys,dtype=object)
+        #missing keys read back from sqlite are None, which doesn't match nan
+        keys[pd.isna(keys)] = np.nan
+        self.keys = pd.Index(keys,dtype=object)
+    
+    #registers the keys and attributes in data, and returns the id column (aligned with data)
+    def add(self, data):
+        codes, uniques = pd.factorize(data[self.key_col])
+        uniques = pd.Series(uniques, dtype=object)
+        missing = codes < 0
+        if not self.dropna and missing.any():
+            #slot the missing key in at the position of its first appearance
+            first_missing = np.argmax(missing)
+            slot = codes[:first_missing].max() + 1 if first_missing > 0 else 0
+            codes = codes + (codes >= slot)
+            codes[missing] = slot
+            uniques = pd.concat([uniques[:slot], pd.Series([np.nan],dtype=object), uniques[slot:]], ignore_index=True)
+        valid = codes >= 0
         
-        #generate location_id column
-        data['location_id'] = data.apply(lambda row: lid_dict[row['the_geom']],axis=1)
-        newcoltimer.pause()
+        #translate codes into ids, giving new keys the next free ids
+        ids = self.keys.get_indexer(uniques)
+        new = ids < 0
+        ids[new] = len(self.keys) + np.arange(new.sum())
+        self.keys = self.keys.append(pd.Index(uniques[new].values,dtype=object))
+        codes = np.where(valid, ids[codes], -1)
         
-        tablepoptimer = timer()
-        addresstimer = timer(start=False)
+        columns = list(self.attributes.values())
+        firsts = data.loc[valid, columns].groupby(codes[valid]).first()
+        if self.firsts is None:
+            self.firsts = firsts
+        else:
+            #values seen earlier take precedence
+            self.firsts = self.firsts.combine_first(firsts)
         
-        #create location dataframe
-        location = pd.DataFrame({LOCATION_GEOM:list(lid_dict.keys())})
-        for i,geom in enumerate(location[LOCATION_GEOM]):
-            tablepoptimer.start()
-            curr_lid = lid_dict[geom]
-            location.loc[i,LOCATION_PK] = curr_lid
-            ilist = index_list[curr_lid]
-            location.loc[i,LOCATION_SHAPE_LENGTH] = data.loc[ilist[0],'Shape_Length']
-            location.loc[i,LOCATION_SHAPE_AREA] = data.loc[ilist[0],'Shape_Area']
-            tablepoptimer.pause()
-            
-            addresstimer.start()
-            #sometimes addresses aren't listed.  Find the first one that is
-            for index in ilist:
-                address = data.loc[index,'address']
-                if not pd.isna(address):
-                    location.loc[i,LOCATION_ADDRESS] = address
-                    break
-                #if none is ever found, then address will remain as nan
-            addresstimer.pause()
-            
-        return data, location
-    except(KeyboardInterrupt):
-        #if you interrupt the function while it's running, then it will produce a computation time report
-        print('rows so far: %s' % i)
-        print('time generating location_id: %s' % newcoltimer.report())
-        print('time populating location table: %s' % tablepoptimer.report())
-        print('time finding addresses: %s' % addresstimer.report())
+        return pd.Series(codes, index=data.index).where(valid)
+    
+    #returns the dimension table for all the data added so far
+    def table(self):
+        table = pd.DataFrame({self.key_name:self.keys.values, self.pk:np.arange(len(self.keys))})
+        if self.firsts is None:
+            firsts = pd.DataFrame(index=table[self.pk], columns=list(self.attributes.values()))
+        else:
+            firsts = self.firsts.reindex(table[self.pk])
+        for dim_col, data_col in self.attributes.items():
+            table[dim_col] = firsts[data_col].values
+        return table
+
+#builds a dimension table from a single dataframe
+#returns the id column (aligned with data) and the dimension table
+def dimension_table(data, dim):
+    ids = dim.add(data)
+    return ids, dim.table()
+
+def location_dimension():
+    #records without a geometry share a single location
+    return dimension('the_geom', LOCATION_GEOM, LOCATION_PK,
+        {LOCATION_SHAPE_LENGTH:'Shape_Length', LOCATION_SHAPE_AREA:'Shape_Area', LOCATION_ADDRESS:'address'},
+        dropna=False)
+
+#adds the centroid and bounding box of the_geom to a location table (see parse_geometries)
+def location_bounds(location):
+    bounds = parse_geometries(location[LOCATION_GEOM])
+    location = location.copy()
+    for col in bounds:
+        location[col] = bounds[col].values
+    return location
+
+#parses WKT geometries (POINT, POLYGON, MULTIPOLYGON...) into their centroid and bounding box
+#returns a dataframe aligned with wkt, with the LOCATION_CENTROID_X ... LOCATION_MAX_Y columns, nan where there is no geometry.
+#the centroid of a polygon is its area-weighted centroid (holes count negatively, as long as they wind the other way,
+#which WKT asks for); that of points and lines is the mean of their vertices.
+#every distinct geometry is parsed once, and all the coordinates of all of them are converted to floats in one go.
+def parse_geometries(wkt):
+    columns = [LOCATION_CENTROID_X, LOCATION_CENTROID_Y, LOCATION_MIN_X, LOCATION_MAX_X, LOCATION_MIN_Y, LOCATION_MAX_Y]
+    codes, uniques = pd.factorize(pd.Series(wkt).astype(object))
+    result = np.full((len(uniques), len(columns)), np.nan)
+    #one row per ring (or point, or line), holding "x y, x y, ..."
+    rings = (pd.Series(uniques, dtype=object).str.replace(r'^\s*[A-Za-z ]*', '', regex=True)
+             .str.split(r'\)\s*,\s*\(', regex=True).explode().str.strip('() '))
+    rings = rings[rings.notna() & (rings != '') & (rings.str.upper() != 'EMPTY')]
+    sizes = rings.str.count(',').values + 1
+    coords = parse_coordinates(rings.values, sizes)
+    if coords is None:
+        #find the geometries that don't parse one ring at a time, and leave only them out
+        good = np.array([parse_coordinates([ring], size) is not None for ring, size in zip(rings.values, sizes)])
+        bad = np.unique(rings.index.values[~good])
+        print('Warning in parse_geometries(): %d of %d geometries could not be parsed, their bounds are left empty'
+              % (len(bad), len(uniques)))
+        keep = ~np.isin(rings.index.values, bad)
+        rings, sizes = rings[keep], sizes[keep]
+        coords = parse_coordinates(rings.values, sizes)
+    if len(rings):
+        x, y = coords[0::2], coords[1::2]
+        geometry = np.repeat(rings.index.values, sizes)
+        ring = np.repeat(np.arange(len(rings)), sizes)
+        starts = np.flatnonzero(np.r_[True, geometry[1:] != geometry[:-1]])
+        found = geometry[starts]
+        result[found, 2] = np.minimum.reduceat(x, starts)
+        result[found, 3] = np.maximum.reduceat(x, starts)
+        result[found, 4] = np.minimum.reduceat(y, starts)
+        result[found, 5] = np.maximum.reduceat(y, starts)
+        
+        #shoelace formula over consecutive vertices of the same ring (WKT rings are closed),
+        #relative to the corner of each bounding box so that the products don't lose the small differences
+        x0, y0 = x - result[geometry, 2], y - result[geometry, 4]
+        cross = x0[:-1]*y0[1:] - x0[1:]*y0[:-1]
+        cross[ring[:-1] != ring[1:]] = 0
+        pairs = geometry[:-1]
+        area = np.bincount(pairs, cross, len(uniques))
+        cx = np.bincount(pairs, (x0[:-1] + x0[1:])*cross, len(uniques))
+        cy = np.bincount(pairs, (y0[:-1] + y0[1:])*cross, len(uniques))
+        counts = np.bincount(geometry, minlength=len(uniques))
+        mean_x = np.bincount(geometry, x0, len(uniques)) / np.maximum(counts, 1)
+        mean_y = np.bincount(geometry, y0, len(uniques)) / np.maximum(counts, 1)
+        #points, lines, and slivers with no area to speak of
+        flat = np.abs(area) <= 1e-12 * (result[:, 3] - result[:, 2]) * (result[:, 5] - result[:, 4]) + 1e-300
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result[:, 0] = result[:, 2] + np.where(flat, mean_x, cx / (3*area))
+            result[:, 1] = result[:, 4] + np.where(flat, mean_y, cy / (3*area))
+    
+    rows = result[codes] if len(uniques) else np.full((len(codes), len(columns)), np.nan)
+    rows[codes < 0] = np.nan
+    return pd.DataFrame(rows, columns=columns, index=pd.Series(wkt).index)
+
+#the coordinates of rings (strings of "x y, x y, ...") with sizes vertices, as one array of floats (x, y, x, y...),
+#or None if they don't all parse
+def parse_coordinates(rings, sizes):
+    try:
+        coords = np.array(' '.join(rings).replace(',', ' ').split(), dtype=float)
+    except ValueError:
+        return None
+    return coords if len(coords) == 2*np.sum(sizes) else None
+
+def planner_dimension():
+    #records without a planner get a nan planner_id_int
+    return dimension('planner_id', PLANNER_ID, PLANNER_PK,
+        {PLANNER_EMAIL:'planner_email', PLANNER_PHONE:'planner_phone', PLANNER_NAME:'planner_name'})
+
+#creates a new dataframe for unique locations
+#also adds new column location_id
+def location_table(data):
+    data['location_id'], location = dimension_table(data, location_dimension())
+    return data, location
 
 #creates a dataframe for planners
 #also adds column planner_id_int
 def planner_table(data):
-    try:
-        newcoltimer = timer()
-        #dict mapping planner_strid to planner_id
-        pid_dict = {}
-        #dict matching planner_id to first index
-        index_dict = {}
-
-        #populate above two dicts
-        pid_counter = int(0)
-        for i,planner in enumerate(data['planner_id']):
-            if ~pd.isna(planner):
-                if planner in pid_dict:
-                    pass
-                else:
-                    pid_dict[planner] = pid_counter
-                    index_dict[pid_counter] = i
-                    pid_counter += 1
-        
-        #temporarily map nan to nan for exception handling
-        pid_dict[np.nan] = np.nan
-        
-        # change planner_id column to int
-        data['planner_id_int'] = data.apply(lambda row: pid_dict[row['planner_id']],axis=1)
-                              
-        del pid_dict[np.nan]
-        newcoltimer.pause()
-        
-        tablepoptimer = timer()
-        
-        #create location dataframe
-        planner_t = pd.DataFrame({PLANNER_ID:list(pid_dict.keys())})
-        for i,planner in enumerate(planner_t[PLANNER_ID]):
-            curr_pid = pid_dict[planner]
-            planner_t.loc[i,PLANNER_PK] = curr_pid
-            
-            #get e-mail, phone, and name
-            index = index_dict[curr_pid]
-            planner_t.loc[i,PLANNER_EMAIL] = data.loc[index,'planner_email']
-            planner_t.loc[i,PLANNER_PHONE] = data.loc[index,'planner_phone']
-            planner_t.loc[i,PLANNER_NAME] = data.loc[index,'planner_name']
-        
-        tablepoptimer.pause()
-            
-        return data, planner_t
-    except(KeyboardInterrupt):
-        #if you interrupt the function while it's running, then it will produce a computation time report
-        print('rows so far: %s' % i)
-        print('time generating planner_id: %s' % newcoltimer.report())
-        print('time populating planner table: %s' % tablepoptimer.report())
-    pass
+    data['planner_id_int'], planner = dimension_table(data, planner_dimension())
+    return data, planner
        
 #fixes two columns in the data that are empty
+#the proposed value is existing + net, or whichever of the two is known
 def fix_prj_features(data):
-    def get_prop(row,feature_net,feature_exist):
-        if pd.isna(row[feature_net]):
-            return row[feature_exist]
-        elif pd.isna(row[feature_exist]):
-            return row[feature_net]
-        else:
-            return row[feature_exist] + row[feature_net]
-    data['PRJ_FEATURE_STORIES_PROP'] = data.apply(lambda row: get_prop(
-            row,'PRJ_FEATURE_STORIES_NET', 'PRJ_FEATURE_STORIES_EXIST'),axis=1)
-    data['PRJ_FEATURE_LOADING_PROP'] = data.apply(lambda row: get_prop(
-            row,'PRJ_FEATURE_LOADING_NET', 'PRJ_FEATURE_LOADING_EXIST'),axis=1)
+    data['PRJ_FEATURE_STORIES_PROP'] = data['PRJ_FEATURE_STORIES_EXIST'].add(data['PRJ_FEATURE_STORIES_NET'], fill_value=0)
+    data['PRJ_FEATURE_LOADING_PROP'] = data['PRJ_FEATURE_LOADING_EXIST'].add(data['PRJ_FEATURE_LOADING_NET'], fill_value=0)
     return data
 
+#turns groups of wide columns into a long table, with a row for each record and type that is filled in
+#spec is a melt; the long table has the row position of the record in fk, the type in type_col,
+#and a column for each of spec.suffixes. present is an optional boolean array of records x types saying
+#which rows to make; by default a row is made wherever any of the type's columns has a value.
+#rows are ordered by type, then by record.
+def unpivot(data, spec, fk, type_col, present=None):
+    values = {long_col: np.column_stack([data[spec.prefix + t + suffix].to_numpy() for t in spec.types])
+              for long_col, suffix in spec.suffixes.items()}
+    if present is None:
+        present = np.logical_or.reduce([~pd.isna(v) for v in values.values()])
+    types, rows = np.nonzero(present.T)
+    
+    table = pd.DataFrame({fk:rows, type_col:np.array(spec.types, dtype=object)[types]})
+    for long_col, v in values.items():
+        table[long_col] = v[rows, types]
+    return table
+
 #creates the prj_desc table in dataframe form
 #also creates prj_desc_detail
 def prj_desc_table(data):
-    #the column names are hard-coded because if the planning department adds a new column somewhere I don't want this to break.
-    prj_desc_cols = ["CHANGE_OF_USE", "ADDITIONS", "NEW_CONSTRUCTION", "LEG_ZONE_CHANGE", "DEMOLITION", "LOT_LINE_ADJUST", "FACADE_ALT", "ROW_IMPROVE", "OTHER_PRJ_DESC", "SPECIAL_NEEDS", "SENIOR", "AFFORDABLE_UNITS", "STUDENT", "INCLUSIONARY", "STATE_DENSITY_BONUS", "ADU", "FORMULA_RETAIL", "MCD", "TOBACCO", "FINANCIAL", "MASSAGE", "OTHER_NON_RES"]
-    
-    #generate lists, which will be used afterwards to create a dataframe
-    record_id = []
-    desc_type = []
-    desc_id_detail = []
-    detail = []
-    
-    for col in prj_desc_cols:
-        #the following line causes a warning when performed on empty columns (such as leg_zone_change)
-        #I think the warning can be ignored.
-        indices = np.where(data[col]=="CHECKED")
-        if len(indices)>0:
-            record_id += list(indices[0])
-            desc_type += [col]*len(indices[0])
-    
-    #handling special cases:
-    col = "DEMOLITION"
-    indices = np.where(data[col]=="Yes")
-    if len(indices)>0:
-        record_id += list(indices[0])
-        desc_type += [col]*len(indices[0])
-    
-    for col in ["MCD_REFERRAL","ENVIRONMENTAL_REVIEW_TYPE"]:
-        indices = np.where(~pd.isna(data[col]))
-        if len(indices)>0:
-            start = len(record_id)
-            record_id += list(indices[0])
-            desc_type += [col]*len(indices[0])
-            desc_id_detail += range(start,start+len(indices[0]))
-            detail += list(data.loc[indices[0],col])
-    
-    prj_desc = pd.DataFrame({PRJ_DESC_FK:record_id,PRJ_DESC_TYPE:desc_type})
-    prj_desc_detail = pd.DataFrame({PRJ_DESC_DETAIL_PK:desc_id_detail,PRJ_DESC_DETAIL:detail})
-    return prj_desc, prj_desc_detail
+    #read_source() turns the checkboxes into booleans (except DEMOLITION, which also has Yes/No)
+    checked = np.column_stack([data[col].to_numpy() if data[col].dtype == bool else (data[col] == "CHECKED").to_numpy()
+                               for col in PRJ_DESC_MELT.types])
+    #handling special cases: DEMOLITION is also set by a Yes, and the detail columns have a row wherever they have a value
+    demolition = (data["DEMOLITION"] == "Yes").to_numpy()
+    prj_desc = pd.concat([unpivot(data, PRJ_DESC_MELT, PRJ_DESC_FK, PRJ_DESC_TYPE, checked),
+                          unpivot(data, melt('', ["DEMOLITION"], {}), PRJ_DESC_FK, PRJ_DESC_TYPE, demolition[:, None]),
+                          unpivot(data, PRJ_DESC_DETAIL_MELT, PRJ_DESC_FK, PRJ_DESC_TYPE)], ignore_index=True)
+    
+    has_detail = prj_desc[PRJ_DESC_DETAIL].notna().to_numpy()
+    prj_desc_detail = pd.DataFrame({PRJ_DESC_DETAIL_PK:np.flatnonzero(has_detail),
+                                    PRJ_DESC_DETAIL:prj_desc[PRJ_DESC_DETAIL].to_numpy()[has_detail]})
+    return prj_desc.drop(columns=PRJ_DESC_DETAIL), prj_desc_detail
 
 #creates the hearing_date table in dataframe form
+#(ymd() has already rewritten the dates as ISO dates)
 def hearing_date_table(data):
-    #the column names are hard-coded because if the planning department adds a new column somewhere I don't want this to break.
-    hearing_date_cols = ["BOS_1ST_READ","BOS_2ND_READ","COM_HEARING","MAYORAL_SIGN","TRANSMIT_DATE_BOS","COM_HEARING_DATE_BOS"]
-    
-    #generate lists, which will be used afterwards to create a dataframe
-    record_id = []
-    hearing_type = []
-    date = []
-    
-    for col in hearing_date_cols:
-        indices = np.where(~pd.isna(data[col]))
-        #the following line causes a warning when performed on empty columns (which is true of several of them)
-        #I think the warning can be ignored.
-        indices = np.where(data[col]=="CHECKED")
-        if len(indices)>0:
-            record_id += list(indices[0])
-            hearing_type += [col]*len(indices[0])
-            date += list(data.loc[indices[0],col])
-    
-    hearing_date = pd.DataFrame({HEARING_FK:record_id,HEARING_TYPE:hearing_type,HEARING_DATE:date})
-    return hearing_date
+    return unpivot(data, HEARING_DATE_MELT, HEARING_FK, HEARING_TYPE)
     
 #creates the land_use table in dataframe form
 def land_use_table(data):    
-    #the column names are hard-coded because if the planning department adds a new column somewhere I don't want this to break.
-    land_use_cols = ["RC", "RESIDENTIAL", "CIE", "PDR", "OFFICE", "MEDICAL", "VISITOR", "PARKING_SPACES"]
-    
-    #generate lists, which will be used afterwards to create a dataframe
-    record_id = []
-    land_use_type = []
-    land_use_exist = []
-    land_use_prop = []
-    land_use_net = []
-    
-    for col in land_use_cols:
-        col_exist = 'LAND_USE_' + col + '_EXIST'
-        col_prop = 'LAND_USE_' + col + '_PROP'
-        col_net = 'LAND_USE_' + col + '_NET'
-        indices = np.where( np.logical_or(~pd.isna(data[col_exist]),
-                                          np.logical_or(~pd.isna(data[col_prop]) ,
-                                          ~pd.isna(data[col_net]) ) ) )
-        if len(indices)>0:
-            record_id += list(indices[0])
-            land_use_type += [col]*len(indices[0])
-            land_use_exist += list(data.loc[indices[0],col_exist])
-            land_use_prop += list(data.loc[indices[0],col_prop])
-            land_use_net += list(data.loc[indices[0],col_net])
-    
-    land_use = pd.DataFrame({LAND_USE_FK:record_id,LAND_USE_TYPE:land_use_type,
-                             LAND_USE_EXIST:land_use_exist,LAND_USE_PROP:land_use_prop,
-                             LAND_USE_NET:land_use_net})
+    land_use = unpivot(data, LAND_USE_MELT, LAND_USE_FK, LAND_USE_TYPE)
     land_use.fillna(value=0,inplace=True)
-    
     return land_use
 
 # creates the prj_feature table in dataframe form
 def prj_feature_table(data):    
-    prj_feature_cols = ["AFFORDABLE", "HOTEL_ROOMS", "MARKET_RATE", "BUILD", "STORIES", "PARKING", "LOADING", "BIKE", "CAR_SHARE", "USABLE", "PUBLIC", "ART", "ROOF", "SOLAR", "LIVING"]
-    
-    #generate lists, which will be used afterwards to create a dataframe
-    record_id = []
-    prj_feature_type = []
-    prj_feature_exist = []
-    prj_feature_prop = []
-    prj_feature_net = []
-    
-    for col in prj_feature_cols:
-        col_exist = 'PRJ_FEATURE_' + col + '_EXIST'
-        col_prop = 'PRJ_FEATURE_' + col + '_PROP'
-        col_net = 'PRJ_FEATURE_' + col + '_NET'
-        indices = np.where( np.logical_or(~pd.isna(data[col_exist]),
-                                          np.logical_or(~pd.isna(data[col_prop]) ,
-                                          ~pd.isna(data[col_net]) ) ) )
-        if len(indices)>0:
-            record_id += list(indices[0])
-            prj_feature_type += [col]*len(indices[0])
-            prj_feature_exist += list(data.loc[indices[0],col_exist])
-            prj_feature_prop += list(data.loc[indices[0],col_prop])
-            prj_feature_net += list(data.loc[indices[0],col_net])
-    
-    #special handling for "other" feature
-    col = 'OTHER'
-    col_name = 'PRJ_FEATURE_' + col
-    col_exist = 'PRJ_FEATURE_' + col + '_EXIST'
-    col_prop = 'PRJ_FEATURE_' + col + '_PROP'
-    col_net = 'PRJ_FEATURE_' + col + '_NET'
-    indices = np.where( np.logical_or(~pd.isna(data[col_exist]),
-                                      np.logical_or(~pd.isna(data[col_prop]) ,
-                                      ~pd.isna(data[col_net]) ) ) )
-    if len(indices)>0:
-        record_id += list(indices[0])
-        names = data.loc[indices[0],col_name]
-        names.fillna(value='unknown',inplace=True)
-        prj_feature_type += ['OTHER: ' + name for name in list(names)]
-        prj_feature_exist += list(data.loc[indices[0],col_exist])
-        prj_feature_prop += list(data.loc[indices[0],col_prop])
-        prj_feature_net += list(data.loc[indices[0],col_net])
-    
-    prj_feature = pd.DataFrame({PRJ_FEATURE_FK:record_id,PRJ_FEATURE_TYPE:prj_feature_type,
-                             PRJ_FEATURE_EXIST:prj_feature_exist,PRJ_FEATURE_PROP:prj_feature_prop,
-                             PRJ_FEATURE_NET:prj_feature_net})
-    prj_feature.fillna(value=0,inplace=True)
+    prj_feature = unpivot(data, PRJ_FEATURE_MELT, PRJ_FEATURE_FK, PRJ_FEATURE_TYPE)
     
+    #special handling for "other" feature, which is named in PRJ_FEATURE_OTHER
+    other = (prj_feature[PRJ_FEATURE_TYPE] == 'OTHER').to_numpy()
+    #(the column can be read as float if it happens to be empty)
+    names = data['PRJ_FEATURE_OTHER'].astype(object).fillna('unknown').to_numpy()[prj_feature[PRJ_FEATURE_FK].to_numpy()[other]]
+    prj_feature.loc[other, PRJ_FEATURE_TYPE] = 'OTHER: ' + pd.Series(names, dtype=object).astype(str).to_numpy()
+    prj_feature.fillna(value=0,inplace=True)
     return prj_feature
 
 #creates the dwelling table in dataframe form
 #also creates adu_area
 def dwelling_table(data):    
-    #the column names are hard-coded because if the planning department adds a new column somewhere I don't want this to break.
-    dwelling_cols = ["STUDIO", "1BR", "2BR", "3BR", "GH_ROOMS", "GH_BEDS", "SRO", "MICRO"]
-    adu_cols = ["ADU_STUDIO", "ADU_1BR", "ADU_2BR", "ADU_3BR"]
-    
-    #generate lists, which will be used afterwards to create a dataframe
-    record_id = []
-    dwelling_type = []
-    dwelling_exist = []
-    dwelling_prop = []
-    dwelling_net = []
-    adu_dwelling_id = []
-    adu_area = []
-    
-    for col in dwelling_cols:
-        col_exist = 'RESIDENTIAL_' + col + '_EXIST'
-        col_prop = 'RESIDENTIAL_' + col + '_PROP'
-        col_net = 'RESIDENTIAL_' + col + '_NET'
-        indices = np.where( np.logical_or(~pd.isna(data[col_exist]),
-                                          np.logical_or(~pd.isna(data[col_prop]) ,
-                                          ~pd.isna(data[col_net]) ) ) )
-        if len(indices)>0:
-            record_id += list(indices[0])
-            dwelling_type += [col]*len(indices[0])
-            dwelling_exist += list(data.loc[indices[0],col_exist])
-            dwelling_prop += list(data.loc[indices[0],col_prop])
-            dwelling_net += list(data.loc[indices[0],col_net])
+    dwelling = unpivot(data, DWELLING_MELT, DWELLING_FK, DWELLING_TYPE)
     
     #additional handling for adu columns
-    #tricky because not all of these have an area listed
-    for col in adu_cols:
-        col_area = 'RESIDENTIAL_' + col + '_AREA'
-        col_exist = 'RESIDENTIAL_' + col + '_EXIST'
-        col_prop = 'RESIDENTIAL_' + col + '_PROP'
-        col_net = 'RESIDENTIAL_' + col + '_NET'
-        area_indices = np.where( np.logical_or(~pd.isna(data[col_exist]),
-                               np.logical_or(~pd.isna(data[col_prop]),
-                               np.logical_or(~pd.isna(data[col_net]),
-                                             ~pd.isna(data[col_area]) ) ) ) )
-        indices = np.where( np.logical_or(~pd.isna(data[col_exist]),
-                               np.logical_or(~pd.isna(data[col_prop]),
-                               np.logical_or(~pd.isna(data[col_net]),
-                                             pd.isna(data[col_area]) ) ) ) )
-        if len(area_indices)>0:
-            start = len(record_id)
-            record_id += list(area_indices[0])
-            dwelling_type += [col]*len(area_indices[0])
-            dwelling_exist += list(data.loc[area_indices[0],col_exist])
-            dwelling_prop += list(data.loc[area_indices[0],col_prop])
-            dwelling_net += list(data.loc[area_indices[0],col_net])
-            adu_dwelling_id += range(start,start+len(area_indices[0]))
-            adu_area += list(data.loc[area_indices[0],col_area])
-        if len(indices)>0:
-            record_id += list(indices[0])
-            dwelling_type += [col]*len(indices[0])
-            dwelling_exist += list(data.loc[indices[0],col_exist])
-            dwelling_prop += list(data.loc[indices[0],col_prop])
-            dwelling_net += list(data.loc[indices[0],col_net])
-            
-    dwelling = pd.DataFrame({DWELLING_FK:record_id,DWELLING_TYPE:dwelling_type,
-                             DWELLING_EXIST:dwelling_exist,DWELLING_PROP:dwelling_prop,
-                             DWELLING_NET:dwelling_net})
-    adu_area = pd.DataFrame({ADU_PK:adu_dwelling_id,ADU_AREA:adu_area})
+    #tricky because not all of these have an area listed. For each adu type, the rows with an area come first,
+    #and get an adu_area row.
+    adu = unpivot(data, ADU_MELT, DWELLING_FK, DWELLING_TYPE)
+    adu_types = pd.Categorical(adu[DWELLING_TYPE], categories=ADU_MELT.types).codes
+    adu = adu.iloc[np.lexsort((adu[DWELLING_FK].to_numpy(), adu[ADU_AREA].isna().to_numpy(), adu_types))]
+    
+    has_area = adu[ADU_AREA].notna().to_numpy()
+    adu_area = pd.DataFrame({ADU_PK:len(dwelling) + np.flatnonzero(has_area), ADU_AREA:adu[ADU_AREA].to_numpy()[has_area]})
+    dwelling = pd.concat([dwelling, adu.drop(columns=ADU_AREA)], ignore_index=True)
     dwelling.fillna(value=0,inplace=True)
     
     return dwelling, adu_area
 
-#generates additional columns for year, month, day, for date opened and date closed
+#generates additional columns for year, month, day and day number, for date opened and date closed
+#and rewrites every date column (DATE_COLS) as an ISO date, YYYY-MM-DD
+#each distinct date string in all of those columns is parsed only once
 def ymd(data):
-    #internal function that returns year, month, day, or nans if date is missing
-    def parse_date(datestr):
-        if not pd.isna(datestr):
-            m = re.match('^(\d+)/(\d+)/(\d+)',datestr)
-            return m.groups()[2], m.groups()[0], m.groups()[1]
-        else:
-            return np.nan, np.nan, np.nan
-    
-    #now apply the function and unpack results
-    date_opened = data['date_opened'].apply(lambda dt: parse_date(dt))
-    date_closed = data['date_closed'].apply(lambda dt: parse_date(dt))
-    
-    data['year_opened'] = date_opened.apply(lambda dt: dt[0])
-    data['month_opened'] = date_opened.apply(lambda dt: dt[1])
-    data['day_opened'] = date_opened.apply(lambda dt: dt[2])
-    data['year_closed'] = date_closed.apply(lambda dt: dt[0])
-    data['month_closed'] = date_closed.apply(lambda dt: dt[1])
-    data['day_closed'] = date_closed.apply(lambda dt: dt[2])
+    columns = [col for col in DATE_COLS if col in data.columns]
+    codes, uniques = pd.factorize(pd.concat([data[col].astype(object) for col in columns], ignore_index=True))
+    dates = parse_dates(pd.Series(uniques, dtype=object))
+    
+    for i, col in enumerate(columns):
+        #missing values have code -1, which picks the row of missing values at the end of dates
+        parsed = dates.iloc[codes[i*len(data):(i+1)*len(data)]].set_axis(data.index)
+        if col in ('date_opened', 'date_closed'):
+            suffix = col[len('date_'):]
+            data['year_' + suffix] = parsed['year']
+            data['month_' + suffix] = parsed['month']
+            data['day_' + suffix] = parsed['day']
+            data['day_number_' + suffix] = parsed['day_number']
+        data[col] = parsed['iso']
     return data
 
+#parses date strings like 1/31/2018 or 1/31/2018 12:00:00 AM (or 2018-01-31, or 31-JAN-18), all at once
+#returns a dataframe of year, month, day, day number (days since 1970-01-01) and ISO date,
+#with an extra row of missing values at the end
+def parse_dates(strings):
+    parts = strings.str.extract(r'^\s*(\d+)/(\d+)/(\d+)', expand=True)[[2, 0, 1]]
+    iso = strings.str.extract(r'^\s*(\d{4})-(\d+)-(\d+)', expand=True)
+    parts = parts.fillna(pd.DataFrame(iso.values, index=parts.index, columns=parts.columns))
+    #two digit years are read the way strptime reads %y: 69-99 are 1900s, the rest 2000s
+    named = strings.str.extract(r'^\s*(\d+)-([A-Za-z]{3})-(\d+)', expand=True)
+    if named.notna().any().any():
+        year = pd.to_numeric(named[2])
+        year = year.where(named[2].str.len() != 2, year + np.where(year < 69, 2000, 1900))
+        month = named[1].str.upper().map({name: i + 1 for i, name in enumerate(MONTH_NAMES)})
+        parts = parts.fillna(pd.DataFrame({2:year, 0:month, 1:named[0]}, index=parts.index)[parts.columns])
+    parts.columns = ['year', 'month', 'day']
+    parts = parts.apply(pd.to_numeric)
+    dates = pd.to_datetime(parts, errors='coerce').values.astype('datetime64[D]')
+    missing = pd.isna(dates)
+    
+    unparsed = strings.notna().values & missing
+    if unparsed.any():
+        print('Warning in parse_dates(): could not read %d dates, such as %s' % (unparsed.sum(), strings[unparsed].iloc[0]))
+        parts[unparsed] = np.nan
+    
+    parsed = pd.DataFrame({'year':parts['year'], 'month':parts['month'], 'day':parts['day'],
+                           'day_number':np.where(missing, np.nan, dates.astype(np.int64)),
+                           'iso':pd.Series(np.datetime_as_string(dates), dtype=object).where(~missing)})
+    return pd.concat([parsed, pd.DataFrame(np.nan, index=[len(parsed)], columns=parsed.columns)], ignore_index=True)
+
+#measurements of a run: wall time, cpu time, growth of the peak RSS, and rows in and out of each step
+#(a stage of prepare_data, a table write, an index...). Each measurement is printed as it is added,
+#and save() writes them all as json.
+#profile names a stage (its description or function name) to run under cProfile, or under tracemalloc
+#if profile_mode is 'tracemalloc'. The top lines of the profile go in the stage's measurement.
+class profiler():
+    def __init__(self, profile=None, profile_mode='cprofile'):
+        if profile_mode not in ('cprofile', 'tracemalloc'):
+            raise ValueError('unknown profile_mode %s' % profile_mode)
+        self.profile = profile
+        self.profile_mode = profile_mode
+        self.entries = []
+        self.started = time.time()
+        self.start = resource_usage()
+    
+    #how measured_call() should profile the stage stg, if at all
+    def profile_stage(self, stg):
+        return self.profile_mode if self.profile in (stg.description, stg.function.__name__) else None
+    
+    #measures the code inside a with block. The block can fill in rows_out (and anything else) in the entry it gets.
+    @contextmanager
+    def measure(self, kind, name, rows_in=None):
+        before = resource_usage()
+        entry = {'kind':kind, 'name':name, 'rows_in':rows_in, 'rows_out':rows_in}
+        yield entry
+        entry.update(usage_since(before))
+        self.add(entry)
+    
+    def add(self, entry):
+        seconds = entry.get('wall_seconds')
+        if seconds and entry.get('rows_in') is not None:
+            entry['rows_per_sec'] = entry['rows_in'] / max(seconds, 1e-6)
+        self.entries.append(entry)
+        
+        line = '%s %s:' % (entry['kind'], entry['name'])
+        if entry.get('cached'):
+            line += ' cached'
+        if seconds is not None:
+            line += ' %.2f s (%.2f s cpu)' % (seconds, entry['cpu_seconds'])
+        if entry.get('peak_rss_delta_mb'):
+            line += ', peak rss +%.0f MB' % entry['peak_rss_delta_mb']
+        if entry.get('rows_in') is not None:
+            line += ', %s rows in, %s rows out' % (entry['rows_in'], entry['rows_out'])
+        if entry.get('rows_per_sec') is not None:
+            line += ' (%.0f rows/sec)' % entry['rows_per_sec']
+        print(line)
+        for profile_line in entry.get('profile', []):
+            print('    ' + profile_line)
+    
+    def report(self):
+        total = usage_since(self.start)
+        return {'started':time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'wall_seconds':total['wall_seconds'], 'cpu_seconds':total['cpu_seconds'],
+                'peak_rss_mb':resource_usage()['peak_rss_mb'], 'steps':self.entries}
+    
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+#wall clock, cpu time and peak RSS (None where the resource module is missing) of this process
+def resource_usage():
+    peak = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #linux gives kilobytes, mac bytes
+        peak = peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+    return {'wall':time.perf_counter(), 'cpu':time.process_time(), 'peak_rss_mb':peak}
+
+#measurements since an earlier resource_usage()
+#the cpu time is only that of this process, and the peak RSS only grows if this is the largest the process has been
+def usage_since(before):
+    after = resource_usage()
+    delta = None
+    if before['peak_rss_mb'] is not None:
+        delta = after['peak_rss_mb'] - before['peak_rss_mb']
+    return {'wall_seconds':after['wall'] - before['wall'], 'cpu_seconds':after['cpu'] - before['cpu'], 'peak_rss_delta_mb':delta}
+
+#runs a stage function on data and measures it, where it runs (so in the worker process for parallel stages)
+#returns the result of the function and the measurement. profile_mode is None, 'cprofile' or 'tracemalloc'.
+def measured_call(function, data, profile_mode=None):
+    before = resource_usage()
+    lines = []
+    if profile_mode == 'cprofile':
+        profile = cProfile.Profile()
+        result = profile.runcall(function, data)
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(PROFILE_LINES)
+        lines = [line for line in out.getvalue().splitlines() if line.strip()]
+    elif profile_mode == 'tracemalloc':
+        tracemalloc.start()
+        result = function(data)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        lines = [str(stat) for stat in snapshot.statistics('lineno')[:PROFILE_LINES]]
+    else:
+        result = function(data)
+    
+    entry = usage_since(before)
+    tables, columns = result
+    entry['rows_in'] = len(data)
+    entry['rows_out'] = sum(len(table) for table in tables.values()) if tables else len(data)
+    if lines:
+        entry['profile'] = lines
+    return result, entry
+
 #quick timer class for debugging computation time
+#(the pipeline itself is measured by profiler; this is still used in the notebooks)
 class timer():
     def __init__(self,start=True):
         self.paused = True
@@ -0,0 +1,188 @@
+'''
+database_reader
+Read-only access to a database made by database_creator (db_create.py), for notebooks and dashboards that ask the same
+few questions over and over: a record with everything attached to it, units by quarter and status, the records at a
+location or near a point, and keyword searches.
+A reader keeps a pool of read-only connections that threads share, and runs the same sql every time, so sqlite3 reuses
+the prepared statements of each connection. Results are kept in a bounded LRU cache, which is emptied whenever the
+database file changes (it is rebuilt by db_create.py, or updated with --update).
+
+Example python script:
+import database_reader
+db = database_reader.reader("2018Q4.db")
+detail = db.record("2017-012345PRJ")
+units = db.units_by_quarter(category="PRJ")
+'''
+
+import database_creator as dc
+import sqlite3 as lite
+import pandas as pd
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from urllib.request import pathname2url
+import copy
+import os
+import queue
+import threading
+
+#connections a reader opens at most. Threads wait for one to be free beyond that.
+POOL_SIZE = 4
+#results a reader caches at most, the least recently used are dropped first
+CACHE_ENTRIES = 1024
+#prepared statements each connection keeps
+CACHED_STATEMENTS = 64
+
+#a record, as a dict of its columns (with those of its record type, planner and location),
+#the record_ids of its children, and dataframes of its dwellings, land uses and project features
+record_detail = namedtuple('record_detail', ['record', 'children', 'dwellings', 'land_uses', 'features'])
+
+RECORD_SQL = '''select r.*, t.%s as type_subtype, t.%s as type_record_type, t.%s as type_group, t.%s as type_module,
+    p.%s as planner_id, p.%s as planner_name, p.%s as planner_email, p.%s as planner_phone,
+    l.%s as address, l.%s as centroid_x, l.%s as centroid_y
+    from record r
+    left join record_type t on t.%s = r.%s
+    left join planner p on p.%s = r.%s
+    left join location l on l.%s = r.%s
+    where r.%s = ?''' % (dc.RECORD_TYPE_SUBTYPE, dc.RECORD_TYPE_TYPE, dc.RECORD_TYPE_GROUP, dc.RECORD_TYPE_MODULE,
+                         dc.PLANNER_ID, dc.PLANNER_NAME, dc.PLANNER_EMAIL, dc.PLANNER_PHONE,
+                         dc.LOCATION_ADDRESS, dc.LOCATION_CENTROID_X, dc.LOCATION_CENTROID_Y,
+                         dc.RECORD_TYPE, dc.RECORD_FK_TYPE, dc.PLANNER_PK, dc.RECORD_FK_PLANNER, dc.LOCATION_PK, dc.RECORD_FK_LOCATION,
+                         dc.RECORD_ID)
+#record_rel_table() stores the record whose children field lists the relationship in the child column
+CHILDREN_SQL = '''select c.%s from record_rel x join record c on c.%s = x.%s
+    where x.%s = ? order by c.%s''' % (dc.RECORD_ID, dc.RECORD_PK, dc.RECORD_REL_PARENT, dc.RECORD_REL_CHILD, dc.RECORD_ID)
+DWELLINGS_SQL = 'select %s, %s, %s, %s from dwelling where %s = ? order by %s' % (
+    dc.DWELLING_TYPE, dc.DWELLING_EXIST, dc.DWELLING_PROP, dc.DWELLING_NET, dc.DWELLING_FK, dc.DWELLING_PK)
+LAND_USES_SQL = 'select %s, %s, %s, %s from land_use where %s = ? order by %s' % (
+    dc.LAND_USE_TYPE, dc.LAND_USE_EXIST, dc.LAND_USE_PROP, dc.LAND_USE_NET, dc.LAND_USE_FK, dc.LAND_USE_PK)
+FEATURES_SQL = 'select %s, %s, %s, %s from prj_feature where %s = ? order by %s' % (
+    dc.PRJ_FEATURE_TYPE, dc.PRJ_FEATURE_EXIST, dc.PRJ_FEATURE_PROP, dc.PRJ_FEATURE_NET, dc.PRJ_FEATURE_FK, dc.PRJ_FEATURE_PK)
+#from the summary table of refresh_summaries(). A null category matches all of them.
+UNITS_SQL = '''select quarter, status, sum(records) as records, sum(units) as units, sum(net_units) as net_units
+    from summary_units where (?1 is null or category = ?1)
+    group by quarter, status order by quarter, status'''
+LOCATION_RECORDS_SQL = '''select %s from record join location on location.%s = record.%s
+    where location.%s in (select %s from location where %s = ?1 or upper(%s) = upper(?2))
+    order by record.%s''' % (', '.join(dc.SPATIAL_COLUMNS), dc.LOCATION_PK, dc.RECORD_FK_LOCATION,
+                             dc.LOCATION_PK, dc.LOCATION_PK, dc.LOCATION_PK, dc.LOCATION_ADDRESS, dc.RECORD_ID)
+
+class reader():
+    def __init__(self, path, pool_size=POOL_SIZE, cache_entries=CACHE_ENTRIES):
+        if not os.path.exists(path):
+            raise ValueError('%s does not exist, please create it with db_create.py' % path)
+        self.path = os.path.abspath(path)
+        self.pool_size = pool_size
+        self.cache_entries = cache_entries
+        self.pool = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.stamp = None
+        self.hits = 0
+        self.misses = 0
+
+    #identifies the build of the database file: it changes when the file is rebuilt or updated
+    def build_stamp(self):
+        stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    #a connection from the pool, opened if there are fewer than pool_size. Connections of an older build are closed.
+    @contextmanager
+    def connection(self):
+        stamp = self.build_stamp()
+        with self.lock:
+            opening = self.pool.empty() and self.opened < self.pool_size
+            if opening:
+                self.opened += 1
+        if opening:
+            con = (self.connect(), stamp)
+        else:
+            con = self.pool.get()
+            if con[1] != stamp:
+                con[0].close()
+                con = (self.connect(), stamp)
+        try:
+            yield con[0]
+        finally:
+            self.pool.put(con)
+
+    def connect(self):
+        con = lite.connect('file:%s?mode=ro' % pathname2url(self.path), uri=True, check_same_thread=False,
+                           cached_statements=CACHED_STATEMENTS)
+        con.execute('pragma query_only = 1')
+        return con
+
+    #closes every connection in the pool
+    def close(self):
+        while True:
+            try:
+                con, _ = self.pool.get_nowait()
+            except queue.Empty:
+                break
+            con.close()
+            with self.lock:
+                self.opened -= 1
+
+    #the result of function(con, *args), from the cache if the database hasn't changed since it was computed
+    #results are copied on the way out, so callers can't change what is cached
+    def cached(self, name, function, *args):
+        key = (name,) + args
+        stamp = self.build_stamp()
+        with self.lock:
+            if stamp != self.stamp:
+                self.cache.clear()
+                self.stamp = stamp
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(self.cache[key])
+            self.misses += 1
+        with self.connection() as con:
+            result = function(con, *args)
+        with self.lock:
+            if stamp == self.stamp:
+                self.cache[key] = result
+                while len(self.cache) > self.cache_entries:
+                    self.cache.popitem(last=False)
+        return copy.deepcopy(result)
+
+    #the record with this record_id as a record_detail, or None if there is none
+    def record(self, record_id):
+        return self.cached('record', record_query, record_id)
+
+    #records, units and net units (of prj_feature AFFORDABLE and MARKET_RATE) by quarter opened and status,
+    #of the records of one category (like 'PRJ') or of all of them
+    def units_by_quarter(self, category=None):
+        return self.cached('units_by_quarter', read_query, UNITS_SQL, (category,))
+
+    #the records at a location, given by its id or its address (in any case)
+    def records_at_location(self, location_id=None, address=None):
+        if location_id is None and address is None:
+            raise ValueError('records_at_location() needs a location_id or an address')
+        return self.cached('records_at_location', read_query, LOCATION_RECORDS_SQL, (location_id, address))
+
+    #the records within meters of the point (x, y), nearest first (see database_creator.records_near)
+    def records_near(self, x, y, meters):
+        return self.cached('records_near', dc.records_near, x, y, meters)
+
+    #the records whose location overlaps a box (see database_creator.records_in_bbox)
+    def records_in_bbox(self, min_x, min_y, max_x, max_y):
+        return self.cached('records_in_bbox', dc.records_in_bbox, min_x, min_y, max_x, max_y)
+
+    #the records whose name, description or address match text, best first (see database_creator.search_records)
+    def search(self, text, limit=50):
+        return self.cached('search', dc.search_records, text, limit)
+
+def read_query(con, sqlcmd, params):
+    return pd.read_sql(sqlcmd, con, params=params)
+
+def record_query(con, record_id):
+    cur = con.execute(RECORD_SQL, (record_id,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    record = dict(zip([column[0] for column in cur.description], row))
+    pk = record[dc.RECORD_PK]
+    children = [child for child, in con.execute(CHILDREN_SQL, (pk,))]
+    return record_detail(record, children, read_query(con, DWELLINGS_SQL, (pk,)),
+                         read_query(con, LAND_USES_SQL, (pk,)), read_query(con, FEATURES_SQL, (pk,)))
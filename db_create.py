@@ -6,9 +6,75 @@ Expect it to take about 10 minutes and take about 200 MB space.
 
 Example bash script:
 python db_create.py "planning-department-records-2018/PPTS_Records_data.csv" "2018Q4.db"
+
+The export can also be read straight from the split archive made by compress.sh, without decompressing it first:
+python db_create.py "planning-department-records-2018/PPTS_Records_data.tgz_" "2018Q4.db"
+
+To keep memory use bounded on large exports, stream the file in chunks:
+python db_create.py "planning-department-records-2018/PPTS_Records_data.csv" "2018Q4.db" --chunksize 50000
+
+To bring an existing database up to date with a newer export, touching only the records that changed:
+python db_create.py --update "2018Q4.db" "planning-department-records-2019/PPTS_Records_data.csv"
+
+To also write the tables as parquet files (into the directory 2018Q4_parquet), for use with pandas/arrow:
+python db_create.py "planning-department-records-2018/PPTS_Records_data.csv" "2018Q4.db" --format both
+
+To keep the results of each stage between runs, so that a rerun only redoes what changed:
+python db_create.py "planning-department-records-2018/PPTS_Records_data.csv" "2018Q4.db" --cache ".stage-cache"
+
+To save the time, cpu and memory use of every step as json, and profile the dwelling stage while at it:
+python db_create.py "planning-department-records-2018/PPTS_Records_data.csv" "2018Q4.db" --metrics "metrics.json" --profile dwelling_stage
+
+To check the export against the limits of the database models first, and stop before building if it doesn't fit:
+python db_create.py "planning-department-records-2018/PPTS_Records_data.csv" "2018Q4.db" --validate
 '''
 
 import database_creator
-import sys
+import argparse
+
+parser = argparse.ArgumentParser(description='Generate a database of SF Planning records from a PPTS export.')
+parser.add_argument('source', help='PPTS records csv file, or the prefix of its split tar.gz archive (PPTS_Records_data.tgz_)')
+parser.add_argument('destination', nargs='?', help='sqlite database file to create')
+parser.add_argument('--chunksize', type=int, default=None,
+                    help='read and write the source this many rows at a time, instead of all at once')
+parser.add_argument('--update', metavar='DATABASE', default=None,
+                    help='update this existing database from source, instead of creating a new one')
+parser.add_argument('--format', choices=['sqlite', 'parquet', 'both'], default='sqlite',
+                    help='output format; with parquet, destination is a directory of parquet files')
+parser.add_argument('--cache', metavar='DIRECTORY', default=None,
+                    help='keep the source and the result of each stage in this directory, and reuse them when unchanged')
+parser.add_argument('--cache-size', type=int, default=database_creator.CACHE_SIZE//1024**2, metavar='MB',
+                    help='size limit of the cache; the least recently used entries go first (default %(default)s)')
+parser.add_argument('--metrics', metavar='FILE', default=None,
+                    help='save the measurements of every stage and table write to this json file')
+parser.add_argument('--profile', metavar='STAGE', default=None,
+                    help='profile this stage of prepare_data (its description or function name, e.g. dwelling_stage)')
+parser.add_argument('--profile-mode', choices=['cprofile', 'tracemalloc'], default='cprofile',
+                    help='profile time with cProfile, or memory allocations with tracemalloc')
+parser.add_argument('--validate', action='store_true',
+                    help='first check that the source fits the database models, and stop if it does not')
+parser.add_argument('--serial', action='store_true',
+                    help='run the table generating stages one at a time, instead of in parallel processes')
 
-database_creator.create(sys.argv[1],sys.argv[2])
\ No newline at end of file
+#the guard is needed because the parallel stages start new python processes, which import this file
+if __name__ == '__main__':
+    args = parser.parse_args()
+    
+    if args.chunksize and args.format != 'sqlite':
+        parser.error('--chunksize only writes sqlite databases')
+    if args.cache and (args.chunksize or args.update):
+        parser.error('--cache only works when creating a database in one go')
+    metrics = database_creator.profiler(profile=args.profile, profile_mode=args.profile_mode)
+    if args.update:
+        if args.destination or args.chunksize or args.format != 'sqlite':
+            parser.error('--update takes only the source file, and updates sqlite databases only')
+        database_creator.update(args.update, args.source, metrics=metrics)
+    elif args.destination:
+        database_creator.create(args.source, args.destination, chunksize=args.chunksize, serial=args.serial,
+                                output=args.format, cache=args.cache, cache_size=args.cache_size*1024**2,
+                                metrics=metrics, validate=args.validate)
+    else:
+        parser.error('the following arguments are required: destination')
+    
+    if args.metrics:
+        metrics.save(args.metrics)
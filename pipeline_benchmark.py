@@ -0,0 +1,111 @@
+'''
+pipeline_benchmark
+This is an executable script that times database_creator on synthetic PPTS exports of growing size (see synthetic_ppts.py),
+to show how each step scales: reading the source, every stage of prepare_data, and every table and index written by
+init_sql_database. Each size runs in a fresh process, so the peak memory of one doesn't hide that of the next.
+For every step it prints the time at each size, and the scaling exponent between the two largest sizes: about 1 is
+linear, and above SUPERLINEAR the step is flagged, which usually means something quadratic crept in.
+
+Example bash script:
+python pipeline_benchmark.py --rows 10000 100000 1000000 --output "benchmark.json"
+
+To keep the generated exports (they are reused on the next run):
+python pipeline_benchmark.py --rows 10000 100000 --keep "synthetic"
+'''
+
+import database_creator as dc
+import synthetic_ppts
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import math
+import os
+import shutil
+import tempfile
+
+SUPERLINEAR = 1.3
+#steps faster than this at the largest size are too noisy to say how they scale
+MIN_SECONDS = 0.05
+
+#generates the export of n rows in directory, unless it is already there
+def synthetic_source(directory, n, seed):
+    source = os.path.join(directory, 'synthetic_%d_%d.csv' % (n, seed))
+    if not os.path.exists(source):
+        print('Generating %d rows' % n)
+        synthetic_ppts.write_csv(n, source + '.tmp', seed=seed)
+        os.replace(source + '.tmp', source)
+    return source
+
+#builds a database from source and returns the measurements. Runs in its own process.
+def run(source, chunksize=None):
+    directory = tempfile.mkdtemp()
+    try:
+        metrics = dc.profiler()
+        dc.create(source, os.path.join(directory, 'benchmark.db'), chunksize=chunksize, serial=True, metrics=metrics)
+        return metrics.report()
+    finally:
+        shutil.rmtree(directory)
+
+#total time of every step, by kind and name. Streaming runs have many chunks; they add up to one step.
+#the source is a different file at every size, so reading it is just 'read'
+def step_times(report):
+    times = {}
+    for entry in report['steps']:
+        kind, name = entry['kind'], entry['name']
+        step = kind if kind in ('chunk', 'read') else '%s %s' % (kind, name)
+        times[step] = times.get(step, 0) + (entry.get('wall_seconds') or 0)
+    return times
+
+def benchmark(rows, directory, seed=0, chunksize=None):
+    reports = {}
+    for n in sorted(rows):
+        source = synthetic_source(directory, n, seed)
+        #a new process for every size
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            reports[n] = executor.submit(run, source, chunksize).result()
+    return reports
+
+#log-log slope of time against rows between two sizes
+def exponent(rows_a, seconds_a, rows_b, seconds_b):
+    if seconds_a <= 0 or seconds_b < MIN_SECONDS or rows_a == rows_b:
+        return None
+    return math.log(seconds_b / seconds_a) / math.log(rows_b / rows_a)
+
+def print_report(reports):
+    rows = sorted(reports)
+    times = {n: step_times(reports[n]) for n in rows}
+    steps = list(dict.fromkeys(step for n in rows for step in times[n]))
+
+    print('%-32s' % 'step' + ''.join(' %12s' % ('%d rows' % n) for n in rows) + '%10s' % 'exponent')
+    for step in steps:
+        seconds = [times[n].get(step, 0) for n in rows]
+        line = '%-32s' % step + ''.join(' %12.2f' % s for s in seconds)
+        slope = exponent(rows[-2], seconds[-2], rows[-1], seconds[-1]) if len(rows) > 1 else None
+        if slope is not None:
+            line += '%10.2f' % slope + (' superlinear' if slope > SUPERLINEAR else '')
+        print(line)
+    print('%-32s' % 'total (s)' + ''.join(' %12.2f' % reports[n]['wall_seconds'] for n in rows))
+    if all(reports[n]['peak_rss_mb'] is not None for n in rows):
+        print('%-32s' % 'peak rss (MB)' + ''.join(' %12.0f' % reports[n]['peak_rss_mb'] for n in rows))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time every step of database_creator on synthetic exports of growing size.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000], help='sizes of the synthetic exports')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic exports')
+    parser.add_argument('--chunksize', type=int, default=None, help='benchmark streaming creation with chunks of this many rows')
+    parser.add_argument('--keep', metavar='DIRECTORY', default=None,
+                        help='keep the synthetic exports in this directory, and reuse the ones already there')
+    parser.add_argument('--output', metavar='FILE', default=None, help='save all the measurements to this json file')
+    args = parser.parse_args()
+
+    directory = args.keep or tempfile.mkdtemp()
+    os.makedirs(directory, exist_ok=True)
+    try:
+        reports = benchmark(args.rows, directory, seed=args.seed, chunksize=args.chunksize)
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory)
+    print_report(reports)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({str(n): report for n, report in reports.items()}, f, indent=1)
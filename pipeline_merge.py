@@ -0,0 +1,301 @@
+'''
+pipeline_merge
+This is an executable script that merges the quarterly SF Development Pipeline reports
+(build-pipeline/SF_Development_Pipeline_<year>_Q<n>.tsv, from http://sf-planning.org/pipeline-report)
+into build-pipeline/combined.tsv, which Housing Pipeline.ipynb reads.
+Every report names its columns differently (BESTSTAT or Best Stat, Location or Location 1...), and COLUMN_MAP says
+which report column goes where. Only new reports are read: a manifest (combined_manifest.json) remembers which
+reports are in combined.tsv, and the rows of a new report are appended to it.
+Most projects are in many reports unchanged. The manifest also keeps the last row of each project (by Blocklot and
+Case Number), and a row that is the same as the last one of its project is left out.
+
+Example bash script:
+python pipeline_merge.py "build-pipeline"
+
+The address and description text of every row is also indexed for full-text search, in combined_search.db.
+
+To rebuild combined.tsv from all the reports:
+python pipeline_merge.py "build-pipeline" --rebuild
+
+To search the descriptions (after merging):
+python pipeline_merge.py "build-pipeline" --search "density bonus"
+'''
+
+import database_creator as dc
+import pandas as pd
+import numpy as np
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3 as lite
+
+COMBINED = 'combined.tsv'
+MANIFEST = 'combined_manifest.json'
+#bump this when the columns or the way they are made change, so that combined.tsv is rebuilt
+MERGE_VERSION = 2
+PIPELINE_FILE = re.compile(r'^SF_Development_Pipeline_(\d{4})_Q([1-4])\.tsv$')
+#2012 Q1 has lowercase column names and a second header row, and has never been part of combined.tsv
+SKIP_QUARTERS = ['2012 Q1']
+#rows are the same project if they have the same values of these
+KEY_COLS = ['Blocklot', 'Case Number']
+
+SEARCH = 'combined_search.db'
+#FTS5 table of combined_search.db, with the row of combined.tsv as rowid: {column: combined.tsv column}
+#the text columns are searched, the others only come back with the results
+SEARCH_TABLE = 'pipeline_search'
+SEARCH_TEXT = {'address':'Address', 'description':'Description', 'dbi_description':'DBI Description'}
+SEARCH_INFO = {'case_number':'Case Number', 'blocklot':'Blocklot', 'quarter':'Quarter'}
+
+#two pieces of the location, like (37.7565, -122.3889), sometimes after an address or zip code and a newline
+def location(values):
+    latlng = values.str.extract(r'\(\s*([-\d.]+)\s*,\s*([-\d.]+)\s*\)\s*$', expand=True).astype(float)
+    #written like shapely writes points, with 16 significant digits
+    points = 'POINT (' + latlng[1].map('%.16g'.__mod__) + ' ' + latlng[0].map('%.16g'.__mod__) + ')'
+    return points.where(latlng.notna().all(axis=1))
+
+#the address before the location, if there is one
+def location_address(values):
+    return values.str.extract(r'^([^\n]*)\n', expand=False)
+
+#block and lot number, like 3725093 or 4644002A (some reports have "APN 3725093")
+def blocklot(values):
+    return values.str.upper().str.replace('APN', '', regex=False).str.strip().replace('', np.nan)
+
+#Yes/No, TRUE/FALSE or 1/0
+def entitled(values):
+    return values.str.strip().str.lower().isin(['yes', 'true', '1']).where(values.notna())
+
+#-1 if entitled
+def entitlement_status(values):
+    return pd.to_numeric(values, errors='coerce') == -1
+
+def iso_date(values):
+    codes, uniques = pd.factorize(values)
+    dates = dc.parse_dates(pd.Series(uniques, dtype=object))
+    return pd.Series(dates['iso'].iloc[codes].to_numpy(), index=values.index)
+
+#always floats, so that a number is written (and hashed by new_rows) the same way in every quarter,
+#whether or not that quarter has missing values
+def number(values):
+    return pd.to_numeric(values, errors='coerce').astype('float64')
+
+def upper(values):
+    return values.str.upper()
+
+def text(values):
+    return values
+
+#{combined column: [(report column, conversion)]}. The first of the report columns that a report has is used.
+COLUMN_MAP = {'Affordable units': [('AFFORDABLE', number), ('AFF_UNITS', number)],
+              'Best Date': [('BESTDATE', iso_date), ('Best Date', iso_date)],
+              'Best Status': [('BESTSTAT', upper), ('Best Stat', upper)],
+              'Blocklot': [('BLKLOT', blocklot), ('APN', blocklot), ('Block Lot', blocklot), ('block lot', blocklot)],
+              'Entitled': [('Entitled', entitled), ('ENTITLED', entitled), ('Entitlement', entitled), ('ENTITLEMENT', entitled),
+                           ('EntitlementStatus', entitlement_status)],
+              'Location': [('Location', location), ('Location 1', location), ('LOCATION', location), ('Geography', location)],
+              'Project Type': [('PROJECT_TYPE', text)],
+              'Units': [('UNITS', number), ('Units', number)],
+              'Address': [('NAMEADDR', text), ('Location 1', location_address)],
+              'Case Number': [('CASENO', text), ('PLN_CASENO', text), ('Planning ID', text)],
+              'Description': [('DESCRIPT', text), ('PLN_DESC', text), ('Planning Project Description', text)],
+              'DBI Description': [('DBIDESC', text), ('BP_DESC', text), ('DBI Project Description', text)]}
+#columns of the reports that combined.tsv leaves out. read_report() warns about any other column that isn't in
+#COLUMN_MAP, which is most likely a new spelling of one that is.
+UNUSED_REPORT_COLUMNS = [
+    'ObjectID', 'sort', 'TempSelect', 'ACTION_SEQ', 'building_type_id', 'SOURCE', 'PHASE', 'DA', 'STATUS', 'StatusGroup',
+    'BESTSTAT GROUP', 'YEAR_', 'QTR', 'YEAR_QTR', 'alias', 'Alias', 'ALIAS', 'LANDUSE', 'EXISTUSE', 'PROPUSE',
+    'FirstFiled', 'FILEDATE', 'Planning Filed', 'DBI Filed', 'DBI Permit', 'DBI Permit ID', 'BP_APPLNO', 'BPAPPLNO', 'COST',
+    'BLOCK', 'LOT', 'SiteArea', 'Net Added Units', 'UNITSNET', 'NET_UNITS', 'AFFORDABLENET', 'AFFORDABLE_NET',
+    'NET_AFF_UNITS', 'AFF_UNITS_NET', 'SECTION415', 'AFF_TARGET', 'TENURE_TYPE',
+    'Total GSF (Commercial)', 'Office', 'Cult, Inst, Educ', 'Medical', 'Prod, Dist, Rep', 'Ret, Ent', 'Visitor',
+    'Net Added SF', 'Net Cult, Inst, Educ', 'Net Medical', 'Net Office', 'Net Prod, Dist, Rep', 'Net Ret, Ent', 'Net Visitor',
+    'TotalSqftEstim', 'TOTAL_GSF', 'NET_GSF', 'CIE', 'NET_CIE', 'CIE_EXIST', 'CIENET', 'MED', 'NET_MED', 'MED_EXIST', 'MEDNET',
+    'MIPS', 'NET_MIPS', 'MIPS_EXIST', 'MIPSNET', 'PDR', 'NET_PDR', 'PDR_EXIST', 'PDRNET', 'RET', 'NET_RET', 'RET_EXIST',
+    'RETNET', 'VISIT', 'NET_VISIT', 'VISIT_EXIST', 'VISITNET', 'RESTAURANT', 'RESTAURANTNET', 'RESTAURANT_NET',
+    'HOTEL_ROOM', 'HOTEL_ROOM_EXIST', 'HOTEL_ROOM_PROP', 'HOTEL_ROOM_NET', 'PARKING', 'PARKINGNET',
+    'Planning Neighborhood', 'NEIGHBORHOOD', 'NEWNEIGHBO', 'Zoning Generalized', 'Zoning Simplified', 'Zoning_Generalized',
+    'Zoning_Simplified', 'ZONING', 'ZONING_GEN', 'ZONING_SIM', 'ZONING_DISTRICT', 'HEIGHTLIMIT', 'HeightNum',
+    'HEIGHT_DISTRICT', 'Traffic Analysis Zone', 'TAZ', 'SUPDIST', 'SUPE_DISTRICT', 'SUPE_DISTRCIT', 'Supe_District',
+    'supervisor', 'SD', 'PlanningDistrictsCombo', 'PLAN_DISTRICT', 'PLN_DISTRICT', 'PD', 'PLAN_AREA', 'PLANAREA', 'PLNGAREA',
+    'PDA', 'PUBLICREALM', 'PLANNER', 'Sponsor Firm', 'Sponsor Name', 'SPONSOR', 'APPLICANT', 'CONTACT', 'CONTACTPH',
+    'CONTACTPHONE', 'FULLNAME', 'CONTACTCITY', 'CONTACTADD', 'SP_CONTACT', 'SP_CONTACTPH']
+#columns of combined.tsv, after its index: the mapped ones, and the quarter of the report
+COLUMNS = list(COLUMN_MAP) + ['Quarter']
+
+#the reports in directory, as [(quarter, path)] in order of quarter
+def pipeline_files(directory):
+    files = []
+    for name in os.listdir(directory):
+        match = PIPELINE_FILE.match(name)
+        if match and '%s Q%s' % match.groups() not in SKIP_QUARTERS:
+            files.append(('%s Q%s' % match.groups(), os.path.join(directory, name)))
+    return sorted(files)
+
+# merges the reports in directory that aren't in combined.tsv yet
+# combined.tsv is rebuilt from all of them if rebuild is True, if there is no manifest, or if a report that is already
+# in it has changed, or a new report is older than the newest one in it (its rows would go in the middle)
+# returns the number of rows added
+def merge(directory, rebuild=False):
+    store = os.path.join(directory, COMBINED)
+    manifest_path = os.path.join(directory, MANIFEST)
+    files = pipeline_files(directory)
+
+    manifest = None
+    if not rebuild and os.path.exists(manifest_path) and os.path.exists(store):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        reason = rebuild_reason(manifest, files)
+        size = os.path.getsize(store)
+        if not reason and size < manifest['bytes']:
+            reason = '%s has been changed since the last merge' % COMBINED
+        elif not reason and size > manifest['bytes']:
+            #rows of a merge that was interrupted before it could write the manifest
+            print('Removing the rows of an unfinished merge from %s' % COMBINED)
+            with open(store, 'r+b') as f:
+                f.truncate(manifest['bytes'])
+        if reason:
+            print('Rebuilding %s: %s' % (COMBINED, reason))
+            manifest = None
+    if manifest is None:
+        manifest = {'version':MERGE_VERSION, 'rows':0, 'bytes':0, 'quarters':{}, 'index':{}}
+        for old in [store, os.path.join(directory, SEARCH)]:
+            if os.path.exists(old):
+                os.remove(old)
+    search = open_search(directory, manifest['rows'])
+
+    added = 0
+    for quarter, path in files:
+        if quarter in manifest['quarters']:
+            #the same file, touched
+            manifest['quarters'][quarter].update(fingerprint(path, with_hash=False))
+            continue
+        frame = read_report(path, quarter)
+        rows = len(frame)
+        frame = new_rows(frame, manifest['index'])
+        frame.index = np.arange(manifest['rows'], manifest['rows'] + len(frame))
+        frame.to_csv(store, sep='\t', mode='a', header=(manifest['rows'] == 0))
+        index_rows(search, frame)
+        print('%s: %d rows, %d new' % (os.path.basename(path), rows, len(frame)))
+        manifest['quarters'][quarter] = dict(fingerprint(path), rows=len(frame))
+        manifest['rows'] += len(frame)
+        added += len(frame)
+
+    search.commit()
+    search.close()
+    #written last, so that the rows of an interrupted merge are left out
+    manifest['bytes'] = os.path.getsize(store) if os.path.exists(store) else 0
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return added
+
+#why combined.tsv can't just be appended to, or None if it can
+def rebuild_reason(manifest, files):
+    if manifest.get('version') != MERGE_VERSION:
+        return 'it was made by another version of pipeline_merge.py'
+    paths = dict(files)
+    for quarter, entry in manifest['quarters'].items():
+        if quarter not in paths:
+            return 'the report of %s is gone' % quarter
+        current = fingerprint(paths[quarter], with_hash=False)
+        if (current['size'], current['mtime_ns']) != (entry['size'], entry['mtime_ns']):
+            if fingerprint(paths[quarter])['sha1'] != entry['sha1']:
+                return 'the report of %s has changed' % quarter
+    newest = max(manifest['quarters'], default=None)
+    older = [quarter for quarter, _ in files if quarter not in manifest['quarters'] and newest and quarter < newest]
+    if older:
+        return 'the report of %s is older than the newest merged one (%s)' % (older[0], newest)
+    return None
+
+#size and modification time of path, and the sha1 of its contents if with_hash
+def fingerprint(path, with_hash=True):
+    stat = os.stat(path)
+    entry = {'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns}
+    if with_hash:
+        with open(path, 'rb') as f:
+            entry['sha1'] = hashlib.sha1(f.read()).hexdigest()
+    return entry
+
+#connection to the search index of the first rows of combined.tsv (rows of an interrupted merge are removed)
+#if there is no index yet, the rows already in combined.tsv are indexed
+def open_search(directory, rows):
+    path = os.path.join(directory, SEARCH)
+    exists = os.path.exists(path)
+    con = lite.connect(path)
+    if not exists:
+        columns = list(SEARCH_TEXT) + ['%s unindexed' % col for col in SEARCH_INFO]
+        con.execute("create virtual table %s using fts5(%s, tokenize='porter unicode61', prefix='2 3')" % (SEARCH_TABLE, ', '.join(columns)))
+        if rows:
+            combined = pd.read_csv(os.path.join(directory, COMBINED), sep='\t', index_col=0, dtype=str, nrows=rows)
+            index_rows(con, combined)
+    con.execute('delete from %s where rowid >= ?' % SEARCH_TABLE, (rows,))
+    return con
+
+#adds rows of combined.tsv (with their row number as index) to the search index
+def index_rows(con, frame):
+    columns = {**SEARCH_TEXT, **SEARCH_INFO}
+    values = frame[list(columns.values())].astype(object)
+    values = values.where(values.notna(), None)
+    con.executemany('insert into %s(rowid, %s) values (?%s)' % (SEARCH_TABLE, ', '.join(columns), ', ?'*len(columns)),
+                    zip(frame.index.tolist(), *[values[col].tolist() for col in columns.values()]))
+
+#the rows of combined.tsv whose address or descriptions match text (see database_creator.search_query), best first,
+#with a snippet of the matching text with the matches in [brackets]. Returns a dataframe of at most limit rows.
+def search(directory, text, limit=50):
+    con = lite.connect(os.path.join(directory, SEARCH))
+    try:
+        sqlcmd = '''select rowid as row, %s, snippet(%s, -1, '[', ']', '...', %d) as snippet, bm25(%s) as score
+            from %s where %s match ? order by score limit ?''' % (', '.join(list(SEARCH_INFO) + list(SEARCH_TEXT)), SEARCH_TABLE,
+                                                                  dc.SNIPPET_WORDS, SEARCH_TABLE, SEARCH_TABLE, SEARCH_TABLE)
+        return pd.read_sql(sqlcmd, con, params=(dc.search_query(text), limit))
+    finally:
+        con.close()
+
+#the rows of a report, with the columns of combined.tsv (see COLUMN_MAP)
+def read_report(path, quarter):
+    report = pd.read_csv(path, sep='\t', dtype=str, encoding='utf-8-sig')
+    mapped = [source for sources in COLUMN_MAP.values() for source, _ in sources]
+    unknown = [col for col in report.columns if col not in mapped and col not in UNUSED_REPORT_COLUMNS]
+    if unknown:
+        print('Warning in read_report(): %s has columns that are not in COLUMN_MAP or UNUSED_REPORT_COLUMNS, '
+              'and are left out: %s' % (os.path.basename(path), ', '.join(unknown)))
+    frame = pd.DataFrame(index=report.index)
+    for col, sources in COLUMN_MAP.items():
+        frame[col] = np.nan
+        for source, convert in sources:
+            if source in report:
+                frame[col] = convert(report[source])
+                break
+    frame['Quarter'] = quarter
+    return frame[COLUMNS]
+
+#the rows of frame that aren't in combined.tsv yet, according to index {project key: hash of its last row}, which is updated
+#a row is left out if it has the same values (whatever the quarter) as the last row of the same project, so that the
+#last row of a project is always its latest values, even if they went back to earlier ones
+def new_rows(frame, index):
+    keys = frame[KEY_COLS].fillna('').astype(str).agg('|'.join, axis=1)
+    hashes = pd.util.hash_pandas_object(frame.drop(columns='Quarter').astype(str), index=False).map('%x'.__mod__)
+    keep = np.zeros(len(frame), dtype=bool)
+    for i, (key, row_hash) in enumerate(zip(keys, hashes)):
+        if index.get(key) != row_hash:
+            index[key] = row_hash
+            keep[i] = True
+    return frame[keep]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge new SF Development Pipeline reports into combined.tsv.')
+    parser.add_argument('directory', help='directory of the SF_Development_Pipeline_<year>_Q<n>.tsv reports and combined.tsv')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild combined.tsv from all the reports')
+    parser.add_argument('--search', metavar='TEXT', default=None, help='search the addresses and descriptions instead of merging')
+    args = parser.parse_args()
+    if args.search:
+        try:
+            found = search(args.directory, args.search)
+        except ValueError as e:
+            parser.error(str(e))
+        with pd.option_context('display.max_colwidth', 80, 'display.width', 200):
+            print(found[['case_number', 'blocklot', 'quarter', 'address', 'snippet']].to_string(index=False))
+    else:
+        print('Added %d rows' % merge(args.directory, rebuild=args.rebuild))
@@ -0,0 +1,254 @@
+'''
+ppts_history
+This is an executable script that keeps successive PPTS exports in one history database, instead of a full copy of
+every snapshot. Each version of a record is stored once, keyed by its record_id and the hash of its source row (the
+source_hash of database_creator), along with the intervals of snapshot dates it was valid for. A record that hasn't
+changed since the last export only costs a lookup, so the history grows with the number of changes, not of snapshots.
+Any snapshot can be read back as the export it came from, or as the record and child tables of database_creator.
+
+Example bash script:
+python ppts_history.py "ppts_history.db" --ingest "planning-department-records/PPTS_Records_data.csv" --date 2017-12-31
+python ppts_history.py "ppts_history.db" --ingest "planning-department-records-2018/PPTS_Records_data.csv" --date 2018-12-31
+
+Snapshots have to be ingested in date order. To print the status of every record on a date:
+python ppts_history.py "ppts_history.db" --as-of 2017-12-31 --columns record_id record_status
+
+To build the database of a snapshot, the same as db_create.py would have built from its export:
+python ppts_history.py "ppts_history.db" --as-of 2017-12-31 --build "2017Q4.db"
+
+Example python script:
+import ppts_history
+status = ppts_history.as_of("ppts_history.db", "2017-12-31", columns=["record_id", "record_status"])
+'''
+
+import database_creator as dc
+import sqlite3 as lite
+import pandas as pd
+import numpy as np
+import argparse
+import os
+import zlib
+
+#every distinct source row, as (record_id, source_hash) and the columns of the export
+VERSION_TABLE = 'record_version'
+VERSION_PK = 'version_id'
+VERSION_HASH = 'source_hash'
+#when each version was in the exports: from the date of the first snapshot it was in, up to (but not including)
+#the date of the first snapshot it wasn't in anymore, or null if it is still in the last one
+INTERVAL_TABLE = 'version_interval'
+INTERVAL_FROM = 'valid_from'
+INTERVAL_TO = 'valid_to'
+#columns of the snapshot table, besides row_order: the version ids of the snapshot in the order of its export,
+#stored as the zlib compressed differences from one to the next, which are mostly the same while records keep their order
+SNAPSHOT_COLUMNS = ['taken', 'source', 'records', 'new', 'changed', 'removed']
+
+#adds the export source, taken on the date taken (anything pandas reads as a date), to the history database history
+#only new versions of records are stored, and the intervals of changed and removed records are closed
+#returns the number of new, changed, unchanged and removed records
+def ingest(history, source, taken, metrics=None):
+    if metrics is None:
+        metrics = dc.profiler()
+    taken = snapshot_date(taken)
+    with metrics.measure('read', source) as entry:
+        data = dc.read_source(source)
+        data[VERSION_HASH] = dc.source_hash(data)
+        entry['rows_out'] = len(data)
+    if data['record_id'].duplicated().any():
+        print('Warning in ingest(): only the first of each duplicated record_id is used')
+        data = data.drop_duplicates('record_id').reset_index(drop=True)
+
+    con = lite.connect(history)
+    try:
+        create_history_tables(con)
+        last = con.execute('select max(taken) from snapshot').fetchone()[0]
+        if last is not None and taken <= last:
+            raise ValueError('snapshots have to be ingested in date order, and %s already has one from %s' % (history, last))
+
+        #sort records into new, changed, unchanged and removed, by their current version
+        current = pd.read_sql('''select v.%s, v.record_id, v.%s from %s i join %s v on v.%s = i.%s
+                              where i.%s is null''' % (VERSION_PK, VERSION_HASH, INTERVAL_TABLE, VERSION_TABLE,
+                                                       VERSION_PK, VERSION_PK, INTERVAL_TO), con)
+        matched = current.set_index('record_id').reindex(data['record_id'])
+        is_new = matched[VERSION_PK].isna().values
+        changed = ~is_new & (matched[VERSION_HASH].values != data[VERSION_HASH].values)
+        removed = ~current['record_id'].isin(data['record_id']).values
+        counts = {'new':int(is_new.sum()), 'changed':int(changed.sum()), 'unchanged':int((~is_new & ~changed).sum()),
+                  'removed':int(removed.sum())}
+        print('%(new)s new, %(changed)s changed, %(unchanged)s unchanged, %(removed)s removed records' % counts)
+
+        with metrics.measure('store', 'versions', counts['new'] + counts['changed']) as entry:
+            versions, stored = store_versions(con, data.loc[is_new | changed].reset_index(drop=True))
+            entry['rows_out'] = stored
+        order = matched[VERSION_PK].values.copy()
+        order[is_new | changed] = versions
+        closing = np.concatenate([matched.loc[changed, VERSION_PK].values, current.loc[removed, VERSION_PK].values])
+        con.executemany('update %s set %s = ? where %s = ? and %s is null' % (INTERVAL_TABLE, INTERVAL_TO, VERSION_PK, INTERVAL_TO),
+                        [(taken, int(version)) for version in closing])
+        con.executemany('insert into %s (%s, %s) values (?, ?)' % (INTERVAL_TABLE, VERSION_PK, INTERVAL_FROM),
+                        [(int(version), taken) for version in versions])
+        con.execute('insert into snapshot (%s, row_order) values (?, ?, ?, ?, ?, ?, ?)' % ', '.join(SNAPSHOT_COLUMNS),
+                    (taken, os.path.abspath(source), len(data), counts['new'], counts['changed'], counts['removed'],
+                     pack_order(order)))
+        con.commit()
+    finally:
+        con.close()
+    return counts
+
+#the version ids of the rows of data, storing the rows whose (record_id, source_hash) isn't in the history yet
+#a record that changes back to an earlier version gets that version again. Returns the ids and the number stored.
+def store_versions(con, data):
+    known = pd.read_sql('select %s, record_id, %s from %s' % (VERSION_PK, VERSION_HASH, VERSION_TABLE), con)
+    keys = pd.MultiIndex.from_frame(data[['record_id', VERSION_HASH]])
+    versions = pd.Series(known[VERSION_PK].values,
+                         index=pd.MultiIndex.from_frame(known[['record_id', VERSION_HASH]])).reindex(keys).values.astype(float)
+    missing = np.isnan(versions)
+    last = con.execute('select max(%s) from %s' % (VERSION_PK, VERSION_TABLE)).fetchone()[0]
+    versions[missing] = (0 if last is None else last + 1) + np.arange(missing.sum())
+    versions = versions.astype(np.int64)
+
+    add_columns(con, data)
+    rows = data.loc[missing]
+    rows.index = versions[missing]
+    dc.bulk_insert(con, VERSION_TABLE, rows, VERSION_PK)
+    return versions, int(missing.sum())
+
+#adds the columns of data that the version table doesn't have yet (the field catalogue can change between exports)
+#and records the dtype of each column, to read the snapshots back with the types read_source() gives
+def add_columns(con, data):
+    existing = [row[1] for row in con.execute('pragma table_info(%s)' % VERSION_TABLE)]
+    for col in data.columns:
+        if col not in existing:
+            con.execute('alter table %s add column %s' % (VERSION_TABLE, col))
+    con.executemany('insert or replace into history_column values (?, ?, ?)',
+                    [(col, str(data[col].dtype), i) for i, col in enumerate(data.columns) if col != VERSION_HASH])
+
+#version ids, in order, as a blob for the row_order column of the snapshot table
+def pack_order(versions):
+    return zlib.compress(np.diff(np.asarray(versions, dtype=np.int64), prepend=0).tobytes())
+
+def unpack_order(blob):
+    return np.cumsum(np.frombuffer(zlib.decompress(blob), dtype=np.int64))
+
+#creates the tables of the history database, if they aren't there yet
+def create_history_tables(con):
+    con.execute('''create table if not exists snapshot(taken text primary key, source text, records integer,
+                new integer, changed integer, removed integer, row_order blob)''')
+    #(histories from before row_order was kept read back in the order the versions were stored)
+    if 'row_order' not in [row[1] for row in con.execute('pragma table_info(snapshot)')]:
+        con.execute('alter table snapshot add column row_order blob')
+    con.execute('create table if not exists history_column(name text primary key, dtype text, position integer)')
+    con.execute('create table if not exists %s(%s integer primary key, record_id text, %s integer)' % (VERSION_TABLE, VERSION_PK, VERSION_HASH))
+    con.execute('create unique index if not exists %s_key on %s(record_id, %s)' % (VERSION_TABLE, VERSION_TABLE, VERSION_HASH))
+    con.execute('create table if not exists %s(%s integer, %s text, %s text)' % (INTERVAL_TABLE, VERSION_PK, INTERVAL_FROM, INTERVAL_TO))
+    con.execute('create index if not exists %s_%s on %s(%s)' % (INTERVAL_TABLE, VERSION_PK, INTERVAL_TABLE, VERSION_PK))
+    con.execute('create index if not exists %s_%s on %s(%s)' % (INTERVAL_TABLE, INTERVAL_TO, INTERVAL_TABLE, INTERVAL_TO))
+
+#ISO date (YYYY-MM-DD) of anything pandas reads as a date, so that dates compare as text in sqlite
+def snapshot_date(taken):
+    return pd.Timestamp(taken).strftime('%Y-%m-%d')
+
+#the snapshots in the history, oldest first
+def snapshots(history):
+    con = open_history(history)
+    try:
+        return pd.read_sql('select %s from snapshot order by taken' % ', '.join(SNAPSHOT_COLUMNS), con)
+    finally:
+        con.close()
+
+def open_history(history):
+    if not os.path.exists(history):
+        raise ValueError('%s does not exist, please create it with ingest()' % history)
+    return lite.connect(history)
+
+#the export as it was in the last snapshot taken on or before the date taken, in the order of its rows and with the
+#columns and types read_source() gives, and the source_hash column create() adds.
+#columns limits it to some of them (record_id is always included).
+def as_of(history, taken, columns=None):
+    taken = snapshot_date(taken)
+    con = open_history(history)
+    try:
+        dtypes = pd.read_sql('select name, dtype from history_column order by position', con)
+        dtypes = pd.Series(dtypes['dtype'].values, index=dtypes['name'].values)
+        if columns is None:
+            columns = list(dtypes.index) + [VERSION_HASH]
+        unknown = [col for col in columns if col not in dtypes.index and col != VERSION_HASH]
+        if unknown:
+            raise ValueError('%s has no columns %s' % (history, ', '.join(unknown)))
+        if 'record_id' not in columns:
+            columns = ['record_id'] + list(columns)
+        kept = 'row_order' in [row[1] for row in con.execute('pragma table_info(snapshot)')]
+        snapshot = con.execute('select %s from snapshot where taken <= ? order by taken desc limit 1'
+                               % ('row_order' if kept else 'null'), (taken,)).fetchone()
+        if snapshot is None:
+            print('Warning in as_of(): %s has no snapshot from before %s' % (history, taken))
+        data = pd.read_sql('''select v.%s, %s from %s i join %s v on v.%s = i.%s
+                           where i.%s <= ?1 and (i.%s is null or i.%s > ?1) order by v.%s'''
+                           % (VERSION_PK, ', '.join('v.%s' % col for col in columns), INTERVAL_TABLE, VERSION_TABLE,
+                              VERSION_PK, VERSION_PK, INTERVAL_FROM, INTERVAL_TO, INTERVAL_TO, VERSION_PK), con, params=(taken,))
+    finally:
+        con.close()
+    if snapshot is not None and snapshot[0] is not None:
+        data = data.set_index(VERSION_PK).loc[unpack_order(snapshot[0])].reset_index(drop=True)
+    else:
+        data = data.drop(columns=VERSION_PK)
+    return restore_types(data, dtypes)
+
+#converts columns read from sqlite back to the dtypes they were ingested with
+#checkboxes of versions from before the column existed are unchecked, and integer columns with missing values stay floats
+def restore_types(data, dtypes):
+    for col in data.columns:
+        if col not in dtypes.index or dtypes[col] in ('object', 'str'):
+            continue
+        if dtypes[col] == 'bool':
+            data[col] = data[col].fillna(0).astype(bool)
+        elif dtypes[col].startswith('int') and data[col].isna().any():
+            data[col] = data[col].astype('float64')
+        else:
+            data[col] = data[col].astype(dtypes[col])
+    return data
+
+#every version of one record, oldest first, with the dates it was valid from and to
+def record_history(history, record_id, columns=None):
+    con = open_history(history)
+    try:
+        if columns is None:
+            columns = [row[0] for row in con.execute('select name from history_column order by position')]
+        return pd.read_sql('''select i.%s, i.%s, %s from %s i join %s v on v.%s = i.%s
+                           where v.record_id = ? order by i.%s'''
+                           % (INTERVAL_FROM, INTERVAL_TO, ', '.join('v.%s' % col for col in columns), INTERVAL_TABLE,
+                              VERSION_TABLE, VERSION_PK, VERSION_PK, INTERVAL_FROM), con, params=(record_id,))
+    finally:
+        con.close()
+
+#the record and child tables of the snapshot on the date taken, as returned by database_creator.prepare_data()
+def as_of_tables(history, taken, serial=False, metrics=None):
+    return dc.prepare_data(as_of(history, taken), serial=serial, metrics=metrics)
+
+#builds the database of the snapshot on the date taken at destination, the same as db_create.py builds from its export
+def build(history, taken, destination, serial=False, metrics=None):
+    tables = as_of_tables(history, taken, serial=serial, metrics=metrics)
+    dc.init_sql_database(destination, *tables, metrics=metrics)
+
+#the guard is needed because the parallel stages of build() start new python processes, which import this file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep the history of successive PPTS exports without storing unchanged records again.')
+    parser.add_argument('history', help='sqlite file of the history')
+    parser.add_argument('--ingest', metavar='SOURCE', default=None, help='PPTS records csv file (or the prefix of its split archive) to add as a new snapshot')
+    parser.add_argument('--date', default=None, help='date the export was taken (YYYY-MM-DD), needed with --ingest')
+    parser.add_argument('--as-of', metavar='DATE', default=None, help='read the records as they were on this date')
+    parser.add_argument('--columns', nargs='+', default=None, help='columns to print with --as-of')
+    parser.add_argument('--build', metavar='DATABASE', default=None, help='with --as-of, build the database of that date here')
+    parser.add_argument('--serial', action='store_true',
+                        help='with --build, run the table generating stages one at a time, instead of in parallel processes')
+    args = parser.parse_args()
+
+    if args.ingest:
+        if args.date is None:
+            parser.error('--ingest needs the --date the export was taken')
+        ingest(args.history, args.ingest, args.date)
+    elif args.as_of and args.build:
+        build(args.history, args.as_of, args.build, serial=args.serial)
+    elif args.as_of:
+        print(as_of(args.history, args.as_of, columns=args.columns).to_csv(index=False), end='')
+    else:
+        print(snapshots(args.history).to_string(index=False))
@@ -0,0 +1,86 @@
+'''
+query_benchmark
+This is an executable script that times a few typical queries against a database made by db_create.py,
+once without the indexes of database_creator.INDEXES and once with them.
+The database itself is not modified: both runs use a temporary copy.
+
+Example bash script:
+python query_benchmark.py "2018Q4.db"
+'''
+
+import database_creator as dc
+import sqlite3 as lite
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+QUERIES = [
+    ('units by status', '''
+        select r.%s, sum(d.%s) from record r join dwelling d on d.%s = r.%s
+        group by r.%s''' % (dc.RECORD_STATUS, dc.DWELLING_NET, dc.DWELLING_FK, dc.RECORD_PK, dc.RECORD_STATUS), ()),
+    ('records per planner', '''
+        select p.%s, count(*) from planner p join record r on r.%s = p.%s
+        group by p.%s''' % (dc.PLANNER_NAME, dc.RECORD_FK_PLANNER, dc.PLANNER_PK, dc.PLANNER_PK), ()),
+    #record_rel_table() stores the record whose children field lists the relationship in the child column
+    ('children of a record', '''
+        select c.%s from record r
+        join record_rel x on x.%s = r.%s
+        join record c on c.%s = x.%s
+        where r.%s = ?''' % (dc.RECORD_ID, dc.RECORD_REL_CHILD, dc.RECORD_PK, dc.RECORD_PK, dc.RECORD_REL_PARENT, dc.RECORD_ID), None),
+    ('dwellings of a record', '''
+        select d.%s, d.%s from record r join dwelling d on d.%s = r.%s
+        where r.%s = ?''' % (dc.DWELLING_TYPE, dc.DWELLING_NET, dc.DWELLING_FK, dc.RECORD_PK, dc.RECORD_ID), None),
+]
+
+#median time of a query in ms, over repeat runs
+def time_query(con, sqlcmd, params, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        con.execute(sqlcmd, params).fetchall()
+        times.append((time.perf_counter() - start)*1000)
+    return sorted(times)[len(times)//2]
+
+def run_queries(con, params, repeat):
+    return [time_query(con, sqlcmd, params if default is None else default, repeat) for _, sqlcmd, default in QUERIES]
+
+def benchmark(database, repeat):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        copy = os.path.join(tmpdir, 'benchmark.db')
+        shutil.copyfile(database, copy)
+        con = lite.connect(copy)
+
+        #a record with children, for the per-record lookups
+        row = con.execute('select r.%s from record_rel x join record r on r.%s = x.%s limit 1'
+                          % (dc.RECORD_ID, dc.RECORD_PK, dc.RECORD_REL_CHILD)).fetchone()
+        params = (row[0] if row else '',)
+
+        for table, column in dc.INDEXES:
+            con.execute('drop index if exists %s' % dc.index_name(table, column))
+        con.execute('drop table if exists sqlite_stat1')
+        con.commit()
+        before = run_queries(con, params, repeat)
+
+        start = time.perf_counter()
+        dc.create_indexes(con)
+        con.execute('analyze')
+        con.commit()
+        print('Building indexes and statistics: %.1f s' % (time.perf_counter() - start))
+        after = run_queries(con, params, repeat)
+        con.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('%-24s %12s %12s' % ('query', 'before (ms)', 'after (ms)'))
+    for (name, _, _), b, a in zip(QUERIES, before, after):
+        print('%-24s %12.2f %12.2f' % (name, b, a))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time typical queries on a planning database, without and with indexes.')
+    parser.add_argument('database', help='sqlite database made by db_create.py')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each query; the median is reported')
+    args = parser.parse_args()
+    benchmark(args.database, args.repeat)
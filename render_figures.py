@@ -0,0 +1,397 @@
+'''
+render_figures
+This is an executable script that renders the charts of figs/ (first drawn in Housing Pipeline.ipynb and New Pipeline.ipynb).
+Every chart is a named target in TARGETS, which says which datasets it reads (DATASETS), how to get the numbers it
+plots from them, and how to draw them. Each dataset is loaded once and shared by all the targets.
+A chart is only drawn again if the numbers it plots, its spec or its code have changed since it was last drawn
+(figs/figures_manifest.json remembers), so after a new quarter is merged only the charts that show it are redrawn.
+Charts are drawn in parallel worker processes. Needs matplotlib (and seaborn, for the notebook style, if installed).
+
+Example bash script:
+python render_figures.py --database "2018Q4.db"
+
+To redraw a few charts, whether or not they have changed:
+python render_figures.py permits-by-type units-by-type --force
+
+To see which charts would be drawn:
+python render_figures.py --database "2018Q4.db" --dry-run
+'''
+
+import database_creator as dc
+from concurrent.futures import ProcessPoolExecutor
+from collections import namedtuple
+from datetime import datetime
+import sqlite3 as lite
+import pandas as pd
+import numpy as np
+import argparse
+import hashlib
+import json
+import os
+
+MANIFEST = 'figures_manifest.json'
+PIPELINE_SOURCE = os.path.join('build-pipeline', 'combined.tsv')
+DBI_SOURCE = os.path.join('build-pipeline', 'dbi', 'Building_Permits.tsv')
+#the split archive of it made by build-pipeline/dbi/compress.sh, read when the tsv hasn't been uncompressed
+DBI_ARCHIVE = os.path.join('build-pipeline', 'dbi', 'permits.tgz_')
+#the notebooks' palette for charts with many series
+PAIRED = ['#a6cee3', '#1f78b4', '#b2df8a', '#33a02c', '#fb9a99', '#e31a1c', '#fdbf6f', '#ff7f00', '#cab2d6', '#6a3d9a', '#ffff99']
+#proposed units from which a project is a large building
+LARGE_UNITS = dc.LARGE_PROJECT_UNITS
+#projects of these types build housing
+RESIDENTIAL_TYPES = ['Mixres', 'Resident', 'Vacant']
+#DBI permits for new buildings, and the uses that are housing
+DBI_CONSTRUCTION = ['new construction wood frame', 'new construction']
+DBI_RESIDENTIAL = ['1 family dwelling', '2 family dwelling', 'apartments', 'misc group residns.', 'residential hotel', 'tower']
+#Prop C (higher inclusionary requirements) took effect in the third quarter of 2016
+PROP_C_QUARTER = '2016 Q3'
+
+#a chart: its name (figs/<name>.png), the datasets it reads, the function giving the dataframe it plots
+#(data(datasets, spec)), the function drawing it (draw(frame, spec, path)), and spec, a dict of settings for both
+figure = namedtuple('figure', ['name', 'datasets', 'data', 'draw', 'spec'])
+
+##### datasets
+
+#combined.tsv, the merged pipeline reports (see pipeline_merge.py)
+def load_pipeline(sources):
+    combined = pd.read_csv(sources['pipeline'], sep='\t', index_col=0)
+    #older versions of combined.tsv have times in some of the dates
+    combined['Best Date'] = pd.to_datetime(combined['Best Date'].str[:10], errors='coerce')
+    return combined
+
+#the DBI building permits (https://data.sfgov.org/Housing-and-Buildings/Building-Permits/i98e-djp9), new residential buildings only
+#sources['dbi'] can also be the prefix of a split archive (see database_creator.source_file)
+def load_dbi(sources):
+    with dc.source_file(sources['dbi']) as f:
+        dbi = pd.read_csv(f, sep='\t', dtype={'Block':str, 'Lot':str},
+                          usecols=['Block', 'Lot', 'Filed Date', 'Permit Type Definition', 'Proposed Use', 'Proposed Units'])
+    dbi = dbi[dbi['Permit Type Definition'].isin(DBI_CONSTRUCTION) & dbi['Proposed Use'].isin(DBI_RESIDENTIAL)].copy()
+    dbi['Blocklot'] = dbi['Block'] + dbi['Lot']
+    dbi['Filed Date'] = pd.to_datetime(dbi['Filed Date'], errors='coerce')
+    return dbi
+
+#the summary_affordable table of a database made by db_create.py (see database_creator.refresh_summaries)
+def load_affordable(sources):
+    with lite.connect(sources['database']) as con:
+        return pd.read_sql('select * from summary_affordable', con)
+
+#the market rate units of every PRJ record of a database made by db_create.py, with the quarter it was opened in
+def load_projects(sources):
+    sqlcmd = '''select %s as quarter, f.%s as market_rate_net from record r
+        join prj_feature f on f.%s = r.%s and f.%s = 'MARKET_RATE'
+        where r.%s = 'PRJ' ''' % (dc.SUMMARY_QUARTER, dc.PRJ_FEATURE_NET, dc.PRJ_FEATURE_FK, dc.RECORD_PK,
+                                   dc.PRJ_FEATURE_TYPE, dc.RECORD_FK_TYPE)
+    with lite.connect(sources['database']) as con:
+        return pd.read_sql(sqlcmd, con)
+
+#{dataset: (source it is read from, loader)}
+DATASETS = {'pipeline':('pipeline', load_pipeline), 'dbi':('dbi', load_dbi),
+            'affordable':('database', load_affordable), 'projects':('database', load_projects)}
+
+##### the numbers of the charts
+
+#like 2017 Q3, 2017 H2 and 2017
+def periods(dates, period):
+    if period == 'quarter':
+        return dates.dt.year.astype(str) + ' Q' + dates.dt.quarter.astype(str)
+    if period == 'half':
+        return dates.dt.year.astype(str) + ' H' + ((dates.dt.month + 5) // 6).astype(str)
+    return dates.dt.year.astype(str)
+
+#the first filing of each project, filed in the years after min_year and before max_year
+#a parcel (Blocklot) that had a filing with units since 2005 before the start of a year is an ongoing project in that
+#year, and its filings are left out, so that a project filed in 2005 and again in 2008 counts once
+def first_filings(data, min_year, max_year, datefield, unitfield):
+    dates = data[datefield]
+    seen = data[(dates > datetime(2005,1,1)) & (data[unitfield] > 0)].groupby('Blocklot')[datefield].min()
+    keys = [col for col in ['Blocklot', 'Best Status'] if col in data]
+    filings = []
+    for year in range(min_year + 1, max_year):
+        ongoing = seen.index[seen < datetime(year,1,1)]
+        in_year = data[(dates < datetime(year+1,1,1)) & (dates > datetime(year,1,1)) & ~data['Blocklot'].isin(ongoing)]
+        filings.append(in_year.drop_duplicates(keys))
+    return pd.concat(filings)
+
+#every period between the first and the last of index, so that empty ones show as 0 instead of being left out
+def all_periods(frame, period):
+    if period != 'quarter' or frame.empty:
+        return frame
+    quarters = pd.period_range(frame.index.min().replace(' ', ''), frame.index.max().replace(' ', ''), freq='Q')
+    return frame.reindex(['%d Q%d' % (q.year, q.quarter) for q in quarters], fill_value=0)
+
+#share of affordable units, in the buckets of the inclusionary zoning rates
+def iz_bucket(ratio):
+    return pd.cut(ratio, [-np.inf, .01, .13, .19, .20, np.inf], right=False, labels=['0', '12', '18', '19', '25']).astype(str)
+
+#first filings of residential projects in combined.tsv, counted (value 'count') or summed by period and by spec['group']
+#spec: min_year, max_year, before (dates from which filings are left out, or None), status (only filings of that
+#Best Status, or None), min_units, group (a column, 'bucket' for iz_bucket, or None), value and period
+def pipeline_counts(datasets, spec):
+    data = datasets['pipeline']
+    data = data[(data['Units'] > 0) & data['Project Type'].isin(RESIDENTIAL_TYPES)]
+    filings = first_filings(data, spec['min_year'], spec['max_year'], 'Best Date', 'Units')
+    if spec.get('before'):
+        filings = filings[filings['Best Date'] < spec['before']]
+    if spec.get('status'):
+        filings = filings[filings['Best Status'] == spec['status']]
+    filings = filings[filings['Units'] >= spec.get('min_units', 0)]
+    group = spec.get('group')
+    if group == 'bucket':
+        #(no affordable units is 0%)
+        group = iz_bucket(filings['Affordable units'].fillna(0) / filings['Units'])
+    elif group is None:
+        group = filings['Best Status']
+    keys = [periods(filings['Best Date'], spec['period']), group]
+    if spec['value'] == 'count':
+        frame = filings.groupby(keys).size().unstack(fill_value=0)
+    else:
+        frame = filings.groupby(keys)[spec['value']].sum().unstack(fill_value=0)
+    return all_periods(frame.sort_index(), spec['period'])
+
+#first filings by period, split into small and large buildings (LARGE_UNITS), as units and as permits
+#spec: dataset, datefield, unitfield, min_year, max_year, before and period, and status to keep one Best Status
+def filings_by_size(datasets, spec):
+    data = datasets[spec['dataset']]
+    data = data[data[spec['unitfield']] > 0]
+    if spec.get('status'):
+        data = data[data['Best Status'] == spec['status']]
+    filings = first_filings(data, spec['min_year'], spec['max_year'], spec['datefield'], spec['unitfield'])
+    if spec.get('before'):
+        filings = filings[filings[spec['datefield']] < spec['before']]
+    units = filings[spec['unitfield']]
+    large = units >= LARGE_UNITS
+    frame = pd.DataFrame({'Units in small buildings':units.where(~large, 0), 'Units in large buildings':units.where(large, 0),
+                          'Small permits':(~large).astype(int), 'Large permits':large.astype(int)})
+    return frame.groupby(periods(filings[spec['datefield']], spec['period']).values).sum().sort_index()
+
+#net units of PRJ records by quarter opened, from the summary tables. spec: column, first and last quarter
+def net_units(datasets, spec):
+    affordable = datasets['affordable']
+    rows = affordable[(affordable['category'] == 'PRJ') & (affordable['quarter'] >= spec['first'])
+                      & (affordable['quarter'] <= spec['last'])]
+    return rows.groupby('quarter')[[spec['column']]].sum().sort_index()
+
+#net market rate units of PRJ records by quarter, of projects of one size (spec['size'], see project_size)
+def net_units_by_size(datasets, spec):
+    projects = datasets['projects']
+    projects = projects[(projects['market_rate_net'] > 0) & (projects['quarter'] >= spec['first'])
+                        & (projects['quarter'] <= spec['last'])]
+    sizes = project_size(projects['market_rate_net'])
+    totals = projects[(sizes == spec['size']).values].groupby('quarter')['market_rate_net'].sum()
+    return totals.reindex(sorted(projects['quarter'].unique()), fill_value=0).to_frame()
+
+#the size classes of New Pipeline.ipynb, named after the affordable share projects of that size have to build
+def project_size(units):
+    return pd.cut(units, [0, 10, 25, np.inf], right=False, labels=['0', '12', '18-20']).astype(str)
+
+##### drawing (these run in the worker processes)
+
+def start_figure(spec):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    try:
+        import seaborn as sns
+        sns.set()
+        sns.set_style('whitegrid')
+        sns.set_style('ticks')
+    except ImportError:
+        sns = None
+    f = plt.figure()
+    f.set_size_inches(*spec.get('size', (8, 6)))
+    return plt, sns, f, f.gca()
+
+def save_figure(plt, sns, f, path, **despine):
+    if sns is not None:
+        sns.despine(fig=f, **despine)
+    f.savefig(path, dpi=300, bbox_inches='tight')
+    plt.close(f)
+
+#bars by period, stacked if spec['stacked']
+def draw_bars(frame, spec, path):
+    plt, sns, f, ax = start_figure(spec)
+    colors = PAIRED if spec.get('paired') else None
+    frame.plot.bar(ax=ax, stacked=spec.get('stacked', False), color=colors[:frame.shape[1]] if colors else None)
+    ax.set_title(spec['title'])
+    ax.set_ylabel(spec['ylabel'])
+    ax.set_xlabel(spec.get('xlabel', 'Filing year'))
+    ax.legend(loc='upper left')
+    save_figure(plt, sns, f, path)
+
+#units in small and large buildings as stacked bars, and the number of permits of each as lines on a second axis
+def draw_filings(frame, spec, path):
+    plt, sns, f, ax = start_figure(spec)
+    axr = ax.twinx()
+    frame[['Units in small buildings', 'Units in large buildings']].plot.bar(ax=ax, stacked=True)
+    frame[['Small permits', 'Large permits']].plot(ax=axr, zorder=2)
+    ax.set_title(spec['title'])
+    ax.set_ylabel('# Housing units')
+    ax.set_xlabel('Filing year')
+    ax.legend(loc='upper left')
+    axr.set_ylabel('# Permits filed')
+    axr.legend(loc='upper right')
+    save_figure(plt, sns, f, path, top=True, right=False)
+
+#bars by quarter, with a linear trend and the averages before and after Prop C
+def draw_trend(frame, spec, path):
+    plt, sns, f, ax = start_figure(spec)
+    values = frame.iloc[:, 0].values.astype(float)
+    frame.plot.bar(ax=ax, legend=False)
+    lines = []
+    if len(values) > 1:
+        poly = np.poly1d(np.polyfit(range(len(values)), values, 1))
+        xp = np.linspace(0, len(values), 20)
+        lines.append(ax.plot(xp, poly(xp), color='red')[0])
+    offset = int((frame.index < PROP_C_QUARTER).sum())
+    if 0 < offset < len(values):
+        lines.append(ax.hlines(values[:offset].mean(), 0, offset, linestyles='dashed'))
+        lines.append(ax.hlines(values[offset:].mean(), offset, len(values), linestyles='dotted'))
+    ax.set_title(spec['title'])
+    ax.set_ylabel('# Housing units')
+    ax.set_xlabel('Filing year')
+    if len(lines) == 3:
+        ax.legend(lines, ('trend', 'avg before prop C', 'avg after prop C'))
+    save_figure(plt, sns, f, path)
+
+#the charts, by name (figs/<name>.png). The -2017q4 charts include 2017 Q4, the others stop before it.
+def pipeline_targets():
+    targets = []
+    for suffix, before, units_filed in [('', '2017-10-01', 'permits-units-filed-new'), ('-2017q4', None, 'permits-units-filed-2017q4')]:
+        base = {'min_year':2012, 'max_year':2018, 'before':before, 'period':'quarter'}
+        targets += [
+            figure('permits-by-type' + suffix, ['pipeline'], pipeline_counts, draw_bars,
+                   dict(base, min_year=2011, value='count', stacked=True, paired=True,
+                        title='Number of residential permits, by type, over time', ylabel='# Permits')),
+            figure('units-by-type' + suffix, ['pipeline'], pipeline_counts, draw_bars,
+                   dict(base, min_year=2011, value='Units', stacked=True, paired=True,
+                        title='Number of residential units in permits, by type, over time', ylabel='# units')),
+            figure(units_filed, ['pipeline'], pipeline_counts, draw_bars,
+                   dict(base, status='PL FILED', value='Units', stacked=True,
+                        title='Number of units in new residential permits, over time', ylabel='# Units')),
+            figure('housing-applications-planning-quarter' + suffix, ['pipeline'], filings_by_size, draw_filings,
+                   dict(base, dataset='pipeline', datefield='Best Date', unitfield='Units', status='PL FILED', min_year=2011,
+                        title='Housing construction filings (Planning)')),
+            figure('housing-applications-planning-half' + suffix, ['pipeline'], filings_by_size, draw_filings,
+                   dict(base, dataset='pipeline', datefield='Best Date', unitfield='Units', status='PL FILED', min_year=2011,
+                        period='half', title='Housing construction filings (Planning)')),
+        ]
+    base = {'min_year':2012, 'max_year':2018, 'before':'2017-10-01', 'period':'quarter'}
+    targets += [
+        figure('permits-filed-new', ['pipeline'], pipeline_counts, draw_bars,
+               dict(base, status='PL FILED', value='count', title='Number of new residential permits, over time', ylabel='# Permits')),
+        figure('permits-large-buildings-filed-new', ['pipeline'], pipeline_counts, draw_bars,
+               dict(base, status='PL FILED', value='count', min_units=LARGE_UNITS,
+                    title='Number of new residential permits, buildings over 25 units, over time', ylabel='# Permits')),
+        figure('permits-by-type-iz', ['pipeline'], pipeline_counts, draw_bars,
+               dict(base, status='PL FILED', value='Affordable units', group='bucket', stacked=True, paired=True,
+                    title='Number of Affordable residential permits, by IZ%, over time', ylabel='# Units')),
+        figure('housing-applications-dbi', ['dbi'], filings_by_size, draw_filings,
+               dict(base, dataset='dbi', datefield='Filed Date', unitfield='Proposed Units', min_year=2011, before=None,
+                    period='year', title='Housing construction filings (DBI)')),
+        figure('housing-applications-dbi-quarters', ['dbi'], filings_by_size, draw_filings,
+               dict(base, dataset='dbi', datefield='Filed Date', unitfield='Proposed Units', min_year=2011, before=None,
+                    title='Housing construction filings (DBI)')),
+    ]
+    return targets
+
+def ppts_targets():
+    #the quarters New Pipeline.ipynb looks at: planning has no unit counts before 2014 Q4
+    base = {'first':'2014 Q4', 'last':'2018 Q3'}
+    targets = [figure('market-rate-net', ['affordable'], net_units, draw_trend,
+                      dict(base, column='market_rate_net', title='Market Rate Units Proposed (net)')),
+               figure('affordable-net', ['affordable'], net_units, draw_trend,
+                      dict(base, column='affordable_net', title='Affordable Units Proposed (net)'))]
+    for size in ['0', '12', '18-20']:
+        targets.append(figure('market-rate-net-%s-affordable' % size, ['projects'], net_units_by_size, draw_trend,
+                              dict(base, size=size, title='Market Rate Units Proposed (net), %s%% affordable projects' % size)))
+    return targets
+
+TARGETS = pipeline_targets() + ppts_targets()
+
+##### rendering
+
+#hash of what a target's chart shows: its plotted numbers, its spec, and the code that makes and draws them
+def fingerprint(target, frame):
+    parts = [target.name, json.dumps(target.spec, sort_keys=True, default=str), frame.to_csv(),
+             dc.code_version(target.data), dc.code_version(target.draw)]
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+#draws one chart. Runs in a worker process.
+def draw(name, frame, spec, path):
+    target = {t.name: t for t in TARGETS}[name]
+    target.draw(frame, spec, path + '.tmp.png')
+    os.replace(path + '.tmp.png', path)
+    return name
+
+# draws the targets (all of them by default) into directory, skipping those that haven't changed since the last run
+# sources says where each source of DATASETS is ({'pipeline':..., 'dbi':..., 'database':...}); targets whose source
+# is missing are skipped. Returns the names of the targets that were drawn (or would be, if dry_run).
+def render(directory, sources, names=None, force=False, jobs=None, dry_run=False):
+    targets = TARGETS if not names else [t for t in TARGETS if t.name in names]
+    unknown = set(names or []) - set(t.name for t in TARGETS)
+    if unknown:
+        raise ValueError('unknown targets: %s' % ', '.join(sorted(unknown)))
+    manifest_path = os.path.join(directory, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    #every dataset is loaded once, and only if a target needs it
+    datasets = {}
+    for name in dict.fromkeys(d for t in targets for d in t.datasets):
+        source, loader = DATASETS[name]
+        if sources.get(source) and dc.source_exists(sources[source]):
+            datasets[name] = loader(sources)
+        else:
+            print('Warning in render(): no %s source, the charts using %s are skipped' % (source, name))
+
+    work = []
+    for target in targets:
+        if not all(d in datasets for d in target.datasets):
+            continue
+        frame = target.data(datasets, target.spec)
+        stamp = fingerprint(target, frame)
+        path = os.path.join(directory, target.name + '.png')
+        if force or manifest.get(target.name) != stamp or not os.path.exists(path):
+            work.append((target, frame, stamp, path))
+    print('%d of %d charts to draw' % (len(work), len(targets)))
+    if dry_run:
+        for target, _, _, _ in work:
+            print(target.name)
+        return [target.name for target, _, _, _ in work]
+
+    os.makedirs(directory, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [(target, stamp, executor.submit(draw, target.name, frame, target.spec, path))
+                   for target, frame, stamp, path in work]
+        for target, stamp, future in futures:
+            future.result()
+            print('Drew %s' % target.name)
+            manifest[target.name] = stamp
+            #written after every chart, so an interrupted run keeps what it drew
+            with open(manifest_path + '.tmp', 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(manifest_path + '.tmp', manifest_path)
+    return [target.name for target, _, _, _ in work]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Draw the charts of figs/ that have changed.')
+    parser.add_argument('targets', nargs='*', help='names of the charts to draw (by default, all of them)')
+    parser.add_argument('--output', default='figs', help='directory of the charts')
+    parser.add_argument('--pipeline', default=PIPELINE_SOURCE, help='combined.tsv, made by pipeline_merge.py')
+    parser.add_argument('--dbi', default=DBI_SOURCE if os.path.exists(DBI_SOURCE) else DBI_ARCHIVE,
+                        help='the DBI building permits, as a tsv file or the prefix of its split archive (permits.tgz_)')
+    parser.add_argument('--database', default=None, help='a database made by db_create.py')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes (by default, one per cpu)')
+    parser.add_argument('--force', action='store_true', help='draw the charts even if they have not changed')
+    parser.add_argument('--dry-run', action='store_true', help='only list the charts that would be drawn')
+    parser.add_argument('--list', action='store_true', help='list all the charts and the datasets they read')
+    args = parser.parse_args()
+
+    if args.list:
+        for target in TARGETS:
+            print('%-48s %s' % (target.name, ', '.join(target.datasets)))
+    else:
+        render(args.output, {'pipeline':args.pipeline, 'dbi':args.dbi, 'database':args.database},
+               names=args.targets, force=args.force, jobs=args.jobs, dry_run=args.dry_run)
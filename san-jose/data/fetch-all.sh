@@ -3,4 +3,4 @@ for i in {2001..2017}; do
     wget https://sjpermits.org/permits/ftproot/SanJose/permitdataYears/PD_${i}_FINAL.TXT
     wget https://sjpermits.org/permits/ftproot/SanJose/permitdataYears/PD_${i}_ISSUE.TXT
 done
-cd ../../ && patch -p0 < san-jose/data/fix-dates.patch
+cd ../../ && python san_jose_permits.py san-jose/data san-jose.db
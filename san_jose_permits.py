@@ -0,0 +1,269 @@
+'''
+san_jose_permits
+This is an executable script that loads the San Jose permit files (san-jose/data/PD_<year>_FINAL.TXT and
+PD_<year>_ISSUE.TXT, see san-jose/data/fetch-all.sh) into one typed permit table, as sqlite and/or parquet.
+The files are tab separated, but some records are broken over two lines: sometimes the newline is in the middle
+of a field, and sometimes it replaced the tab between two fields. Records are put back together by counting fields,
+so the files can be used as downloaded. Dates come as 1/31/2001, 1/31/2001 4:34:10 PM or 31-JAN-11, and are stored
+as ISO dates. The files are parsed in parallel processes.
+
+Example bash script:
+python san_jose_permits.py "san-jose/data" "san-jose.db"
+
+To also write the table as parquet (san-jose_parquet/permit.parquet):
+python san_jose_permits.py "san-jose/data" "san-jose.db" --format both
+'''
+
+import database_creator as dc
+import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+import re
+import shutil
+
+PERMIT_TABLE = 'permit'
+#columns of the permit files and their types, see https://sjpermits.org/permits/ftproot/SanJose/permitdataMonths/PD_00_Layout.txt
+#older ISSUE files have no FINALDATE. flags are Y/N, stored as 1/0.
+PERMIT_COLUMNS = {'TRACT':'text', 'APN':'text', 'ISSUEDATE':'date', 'FINALDATE':'date', 'LOT':'text',
+                  'FOLDERNUMBER':'text', 'OWNERNAME':'text', 'CONTRACTOR':'text', 'APPLICANT':'text',
+                  'JOBLOCATION':'text', 'PERMITAPPROVALS':'text', 'SUBCODE':'integer', 'SUBDESC':'text',
+                  'WORKCODE':'integer', 'WORKDESC':'text', 'CENSUSCODE':'integer', 'PERMITVALUATION':'real',
+                  'REROOFVALUATION':'real', 'SQFT':'real', 'DWELLUNITS':'integer', 'FOLDERRSN':'integer',
+                  'SWIMMINGPOOL':'flag', 'SEWER':'flag', 'ENTERPRISE':'flag', 'PERMITFLAG':'text'}
+#columns added from the file name: which file the permit is from, its year, and FINAL or ISSUE
+FILE_COLUMNS = {'FILE':'text', 'YEAR':'integer', 'KIND':'text'}
+#the free text field, where records with too many fields put the extra ones (their descriptions have tabs)
+FREE_TEXT_COL = 'JOBLOCATION'
+PERMIT_INDEXES = ['FOLDERRSN', 'APN', 'ISSUEDATE']
+PERMIT_FILE = re.compile(r'^PD_(\d{4})_(FINAL|ISSUE)\.txt$', re.IGNORECASE)
+
+#the permit files in directory, in order of year and kind
+def permit_files(directory):
+    files = [name for name in os.listdir(directory) if PERMIT_FILE.match(name)]
+    return [os.path.join(directory, name) for name in sorted(files, key=lambda name: PERMIT_FILE.match(name).groups())]
+
+# loads every permit file in directory into destination
+# output is 'sqlite', 'parquet' (destination is then a directory, with permit.parquet in it) or 'both'
+# (the parquet file goes in dc.parquet_directory(destination)). Existing output is replaced once the load succeeds.
+# if serial is True, the files are parsed one at a time instead of in parallel processes
+def load(directory, destination, output='sqlite', serial=False):
+    if output not in ('sqlite', 'parquet', 'both'):
+        raise ValueError('unknown output %s' % output)
+    files = permit_files(directory)
+    if not files:
+        raise ValueError('no PD_<year>_FINAL.TXT or PD_<year>_ISSUE.TXT files in %s' % directory)
+    parquet = None
+    if output in ('parquet', 'both'):
+        parquet = destination if output == 'parquet' else dc.parquet_directory(destination)
+
+    con = writer = None
+    try:
+        if output in ('sqlite', 'both'):
+            con = dc.build_connection(destination + '.tmp')
+            con.execute('drop table if exists %s' % PERMIT_TABLE)
+            con.execute(permit_schema())
+        if parquet is not None:
+            import pyarrow.parquet as pq
+            os.makedirs(parquet + '.tmp', exist_ok=True)
+            writer = pq.ParquetWriter(os.path.join(parquet + '.tmp', PERMIT_TABLE + '.parquet'), arrow_schema(),
+                                      compression='zstd')
+
+        if serial:
+            total = write_permits(files, map(read_permit_file, files), con, writer)
+        else:
+            with ProcessPoolExecutor() as executor:
+                total = write_permits(files, executor.map(read_permit_file, files), con, writer)
+
+        if con is not None:
+            for col in PERMIT_INDEXES:
+                con.execute('create index %s on %s (%s)' % (dc.index_name(PERMIT_TABLE, col.lower()), PERMIT_TABLE, col))
+            con.execute('analyze')
+            con.commit()
+            dc.finish_build(con)
+        print('Loaded %d permits from %d files' % (total, len(files)))
+    finally:
+        if con is not None:
+            con.close()
+        if writer is not None:
+            writer.close()
+
+    if con is not None:
+        os.replace(destination + '.tmp', destination)
+    if parquet is not None:
+        if os.path.exists(parquet):
+            shutil.rmtree(parquet)
+        os.replace(parquet + '.tmp', parquet)
+
+# writes the (frame, repaired) result of read_permit_file() for each of files to the sqlite connection con
+# and the parquet writer, either of which can be None. Returns the number of permits written.
+def write_permits(files, results, con, writer):
+    #the results come back in the order of files, as each is done
+    total = 0
+    for path, (frame, repaired) in zip(files, results):
+        print('%s: %d permits, %d broken records put back together' % (os.path.basename(path), len(frame), repaired))
+        total += len(frame)
+        if con is not None:
+            dc.bulk_insert(con, PERMIT_TABLE, frame)
+        if writer is not None:
+            writer.write_table(arrow_table(frame))
+    return total
+
+# parses one permit file into a typed dataframe with the columns of PERMIT_COLUMNS and FILE_COLUMNS
+# returns the dataframe and the number of records that were broken over lines
+def read_permit_file(path):
+    with open(path, encoding='latin-1', newline='') as f:
+        header = [name.strip() for name in f.readline().rstrip('\r\n').split('\t')]
+        records = permit_records(f, header, os.path.basename(path))
+        rows = list(records)
+
+    unknown = [col for col in header if col not in PERMIT_COLUMNS]
+    if unknown:
+        print('Warning in read_permit_file(): %s has unknown columns, which are not loaded: %s'
+              % (os.path.basename(path), ', '.join(unknown)))
+    frame = typed_permits(pd.DataFrame(rows, columns=header, dtype=object), os.path.basename(path))
+    year, kind = PERMIT_FILE.match(os.path.basename(path)).groups()
+    frame['FILE'] = os.path.basename(path)
+    frame['YEAR'] = int(year)
+    frame['KIND'] = kind.upper()
+    return frame, records.repaired
+
+# the records in lines (the rest of a permit file after its header), as lists of as many fields as header
+# a line with too few fields is the start of a broken record, and the following lines are added to it until it is
+# complete: if the fields of both make up exactly a record, the newline replaced a tab, otherwise it split a field.
+# a record with too many fields has tabs in its free text field, and the extra fields are put back in it.
+class permit_records():
+    def __init__(self, lines, header, name=''):
+        self.lines = lines
+        self.header = header
+        self.name = name
+        self.repaired = 0
+
+    def __iter__(self):
+        n = len(self.header)
+        pending = None
+        #whether the record being put together was broken
+        broken = False
+        for line in self.lines:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            fields = line.split('\t')
+            if pending is not None:
+                if len(fields) >= n:
+                    #a whole record, so the one before it was cut short for good
+                    print('Warning in permit_records(): %s has an incomplete record, which is skipped: %s'
+                          % (self.name, '\t'.join(pending)[:80]))
+                    broken = False
+                elif len(pending) + len(fields) == n:
+                    fields = pending + fields
+                else:
+                    fields = pending[:-1] + [join_text(pending[-1], fields[0])] + fields[1:]
+                pending = None
+
+            if len(fields) < n:
+                pending = fields
+                broken = True
+                continue
+            if len(fields) > n:
+                broken = True
+                fields = self.merge_extra_fields(fields)
+                if fields is None:
+                    broken = False
+                    continue
+            self.repaired += broken
+            broken = False
+            yield fields
+        if pending is not None:
+            print('Warning in permit_records(): %s ends with an incomplete record, which is skipped: %s'
+                  % (self.name, '\t'.join(pending)[:80]))
+
+    #puts the extra fields of a record back in its free text field
+    def merge_extra_fields(self, fields):
+        if FREE_TEXT_COL not in self.header:
+            print('Warning in permit_records(): %s has a record with too many fields, which is skipped: %s'
+                  % (self.name, '\t'.join(fields)[:80]))
+            return None
+        i = self.header.index(FREE_TEXT_COL)
+        extra = len(fields) - len(self.header)
+        text = ''
+        for field in fields[i:i + extra + 1]:
+            text = join_text(text, field)
+        return fields[:i] + [text] + fields[i + extra + 1:]
+
+#two pieces of a field, joined with a space
+def join_text(first, second):
+    first, second = first.rstrip(), second.strip()
+    return first + ' ' + second if first and second else first + second
+
+#types the columns of a dataframe of permit file fields (strings), see PERMIT_COLUMNS
+#name is that of the file, for warnings
+def typed_permits(data, name=''):
+    frame = pd.DataFrame(index=data.index)
+    for col, col_type in PERMIT_COLUMNS.items():
+        if col not in data:
+            values = pd.Series(np.nan, index=data.index, dtype=object)
+        else:
+            #fields are padded with spaces in some years, and empty means missing
+            values = data[col].str.strip().replace('', np.nan)
+
+        if col_type == 'date':
+            #each date once, like dc.ymd(); the code of missing values, -1, picks the row of missing values at the end
+            codes, uniques = pd.factorize(values)
+            dates = dc.parse_dates(pd.Series(uniques, dtype=object))
+            frame[col] = dates['iso'].iloc[codes].to_numpy()
+        elif col_type in ('integer', 'real'):
+            numbers = pd.to_numeric(values, errors='coerce')
+            unread = values.notna() & numbers.isna()
+            if unread.any():
+                print('Warning in typed_permits(): %s has %d values of %s that are not numbers, such as %s'
+                      % (name, unread.sum(), col, values[unread].iloc[0]))
+            if col_type == 'integer':
+                fractional = numbers.notna() & (numbers != np.round(numbers))
+                if fractional.any():
+                    print('Warning in typed_permits(): %s has %d fractional values of %s, which are rounded'
+                          % (name, fractional.sum(), col))
+                numbers = numbers.round().astype('Int64')
+            frame[col] = numbers
+        elif col_type == 'flag':
+            frame[col] = values.str.upper().map({'Y':1, 'N':0}).astype('Int64')
+        else:
+            frame[col] = values.astype(object)
+    return frame
+
+#the create table command of the permit table
+def permit_schema():
+    sql_types = {'text':'text', 'date':'text', 'integer':'integer', 'real':'real', 'flag':'integer'}
+    columns = ['%s %s' % (col, sql_types[col_type]) for col, col_type in list(PERMIT_COLUMNS.items()) + list(FILE_COLUMNS.items())]
+    return 'create table %s (id integer primary key, %s)' % (PERMIT_TABLE, ', '.join(columns))
+
+#the arrow schema of the permit table, the same for every file
+def arrow_schema():
+    import pyarrow as pa
+    arrow_types = {'text':pa.string(), 'date':pa.date32(), 'integer':pa.int64(), 'real':pa.float64(), 'flag':pa.bool_()}
+    return pa.schema([(col, arrow_types[col_type]) for col, col_type in list(PERMIT_COLUMNS.items()) + list(FILE_COLUMNS.items())])
+
+def arrow_table(frame):
+    import pyarrow as pa
+    schema = arrow_schema()
+    arrays = []
+    for field in schema:
+        values = frame[field.name]
+        if pa.types.is_date32(field.type):
+            values = pd.to_datetime(values).to_numpy().astype('datetime64[D]')
+        elif pa.types.is_boolean(field.type):
+            values = values.astype('boolean')
+        arrays.append(pa.array(values, type=field.type, from_pandas=True))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+#the guard is needed because the parallel parsing starts new python processes, which import this file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load the San Jose permit files into a typed permit table.')
+    parser.add_argument('directory', help='directory of the PD_<year>_FINAL.TXT and PD_<year>_ISSUE.TXT files')
+    parser.add_argument('destination', help='sqlite database file to create')
+    parser.add_argument('--format', choices=['sqlite', 'parquet', 'both'], default='sqlite',
+                        help='output format; with parquet, destination is a directory with permit.parquet in it')
+    parser.add_argument('--serial', action='store_true', help='parse the files one at a time, instead of in parallel processes')
+    args = parser.parse_args()
+    load(args.directory, args.destination, output=args.format, serial=args.serial)
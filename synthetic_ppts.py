@@ -0,0 +1,264 @@
+'''
+synthetic_ppts
+This module generates synthetic PPTS exports, for testing and benchmarking database_creator without the real export.
+The columns follow the field catalogue (DataSF_PPTS_Fields.csv), and the values follow what the real export looks
+like, as far as database_creator cares: about 1 record in 2.5 shares its parcel (the_geom) with another, a few
+hundred planners, the 63 record types with their hierarchy and typos, and about 1 record in 8 listing children.
+
+Example bash script:
+python synthetic_ppts.py 100000 "synthetic/PPTS_Records_data.csv"
+'''
+
+import database_creator as dc
+import pandas as pd
+import numpy as np
+import argparse
+import os
+
+#the record type hierarchy of the real export: record_type_type/record_type_subtype/record_type_category
+RECORD_TYPES = ['Project/Project/PRJ', 'Applications/Environmental/ENV', 'Applications/Referral/MIS',
+    'Applications/Planning Entitlements/COA', 'Complaint/Code Enforcement/ENF', 'Applications/Planning Entitlements/CUA',
+    'Applications/Planning Entitlements/VAR', 'Applications/Discretionary Review/DRP', 'Applications/Project Review/PPA',
+    'Applications/Environmental/CATEX-EEC', 'Research/PIC Research/PIC', 'Applications/Referral/GPR',
+    'Applications/Discretionary Review/DRM', 'Applications/Planning Entitlements/PTA', 'Applications/Referral/LLA',
+    'Applications/Referral/SUB', 'Applications/Referral/CND', 'Applications/Referral/LBR', 'Applications/Appeal/APL',
+    'Applications/Citywide Planning/CWP', 'Applications/Citywide Planning/GPL', 'Applications/Commission Review/CRV',
+    'Applications/Commission Review/IMP', 'Applications/Environmental/Community Plan Determin-ECD',
+    'Applications/Environmental/Community Plan Exemption-ECE', 'Applications/Environmental/Community Plan Focused EIR-EIF',
+    'Applications/Environmental/EIR Addendum-EIA', 'Applications/Environmental/EIR Fee',
+    'Applications/Environmental/Environmental T and M-ETM', 'Applications/Environmental/Initial Study-EEA',
+    'Applications/Environmental/Neg Dec Addendum-ENA', 'Applications/Environmental/Transportation Abbrev-ETA',
+    'Applications/Environmental/Transportation Study-ETR', 'Applications/General/GEN', 'Applications/General/PHA',
+    'Applications/Historical/DES', 'Applications/Historical/FED', 'Applications/Historical/MLS',
+    'Applications/In-kind Agreements/IKA', 'Applications/Legislation/DVA', 'Applications/Legislation/GPA',
+    'Applications/Legislation/MAP', 'Applications/Legislation/PCA', 'Applications/Planning Entitlements/AHB',
+    'Applications/Planning Entitlements/CTZ', 'Applications/Planning Entitlements/DNX',
+    'Applications/Planning Entitlements/ENX', 'Applications/Planning Entitlements/OFA',
+    'Applications/Planning Entitlements/SHD', 'Applications/Planning Entitlements/TDM',
+    'Applications/Planning Entitlements/WLS', 'Applications/Project Review/PRV', 'Other/Other/GAS', 'Other/Other/Other',
+    'Project/Project/MCM', 'Project/Project/PRL', 'Research/Letters/GNC', 'Research/Letters/TDE', 'Research/Letters/TDT',
+    'Research/Letters/TDU', 'Research/Letters/ZAD', 'Research/Letters/ZAN', 'Research/Letters/ZAV']
+#names of the common record types. The rest are named after their subtype.
+RECORD_TYPE_NAMES = {'PRJ':'Project Profile', 'ENV':'Environmental', 'MIS':'Misc. Permits-REF', 'COA':'Certificate of Appropriateness',
+    'ENF':'Enforcement', 'CUA':'Conditional Use Authorization', 'VAR':'Variance', 'DRP':'Discretionary Review - Public Initiated',
+    'PPA':'Preliminary Project Assessment', 'GPR':'General Plan Referral', 'DRM':'Discretionary Review - Manditory'}
+#the typos of record_type seen in the real export: the name without the acronym, for a small share of the rows
+RECORD_TYPE_TYPOS = 0.02
+RECORD_STATUSES = ['Closed', 'Accepted', 'Closed - Withdrawn', 'Open', 'Withdrawn', 'Under Review', 'Application Accepted',
+                   'Complete', 'Submitted', 'Pending', 'Closed - Approved', 'Approved', 'On Hold', 'Incomplete',
+                   'Actions Pending', 'Pending Review', 'Denied', 'Disapproved', 'Closed - Complete']
+MCD_REFERRALS = ['Required', 'Not Required', 'Pending', 'Approved', 'Denied', 'Withdrawn', 'Unknown']
+ENVIRONMENTAL_REVIEW_TYPES = ['Categorical Exemption-Certificate', 'Categorical Exemption-Stamp', 'Community Plan Exemption',
+    'Environmental Impact Report', 'Focused EIR', 'Mitigated Negative Declaration', 'Negative Declaration', 'EIR Addendum',
+    'Neg Dec Addendum', 'Statutory Exemption', 'General Rule Exclusion', 'Not a Project', 'Initial Study', 'Class 1',
+    'Class 3', 'Class 31', 'Class 32', 'Note to File', 'Re-evaluation', 'Exempt', 'Other']
+PRJ_FEATURE_OTHERS = ['Pool', 'Garden', 'Roof deck', 'Elevator', 'Storage', 'Child care', 'Courtyard']
+STREETS = ['MISSION ST', 'MARKET ST', 'VALENCIA ST', 'GEARY BLVD', 'FOLSOM ST', 'HOWARD ST', 'IRVING ST', 'TARAVAL ST',
+           'DIVISADERO ST', 'FILLMORE ST', 'BRYANT ST', 'HARRISON ST', '3RD ST', '24TH ST', 'CLEMENT ST', 'NORIEGA ST']
+WORDS = ['construct', 'new', 'four-story', 'residential', 'building', 'with', 'dwelling', 'units', 'ground', 'floor',
+         'retail', 'demolish', 'existing', 'single-family', 'home', 'addition', 'rear', 'horizontal', 'vertical', 'change',
+         'of', 'use', 'from', 'office', 'to', 'accessory', 'unit', 'parking', 'garage', 'facade', 'alteration', 'and']
+
+#share of records with a value, for the columns whose values are generated independently of the rest
+DATE_CLOSED_SHARE = 0.55
+HEARING_SHARE = 0.02
+CHECKBOX_SHARE = 0.04
+#groups of land use, project feature and dwelling columns are filled in together
+GROUP_SHARE = 0.04
+#rows generated from one random stream. The file doesn't depend on how many rows are written at a time.
+BLOCK_ROWS = 10000
+
+#number of distinct parcels, planners and descriptions for n records
+def cardinalities(n):
+    return {'parcels':max(1, int(n/2.5)), 'planners':int(np.clip(n/500, 30, 400)), 'descriptions':int(min(n, 50000))}
+
+#writes a synthetic export of n records to destination, chunksize rows at a time
+#the same n and seed always give the same file, whatever the chunksize
+def write_csv(n, destination, seed=0, chunksize=100000):
+    directory = os.path.dirname(destination)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    state = generator_state(n, seed)
+    for start in range(0, n, chunksize):
+        chunk = generate_rows(state, start, min(start + chunksize, n))
+        chunk.to_csv(destination, index=False, mode='w' if start == 0 else 'a', header=(start == 0))
+
+#a synthetic export of n records, as a dataframe
+def generate(n, seed=0):
+    return generate_rows(generator_state(n, seed), 0, n)
+
+#everything about the export that has to be consistent between chunks: the category, year and parcel of every record,
+#and the parcels, planners and descriptions themselves
+def generator_state(n, seed):
+    rng = np.random.default_rng(seed)
+    sizes = cardinalities(n)
+    #record types and parcels are far from uniform: a few are very common
+    type_weights = 1 / np.arange(1, len(RECORD_TYPES) + 1)**1.2
+    parcel_weights = rng.pareto(1.5, sizes['parcels']) + 1
+
+    parcels = sizes['parcels']
+    corner = np.column_stack([-122.51 + 0.13*rng.random(parcels), 37.70 + 0.11*rng.random(parcels)])
+    width = 1e-4 + 3e-4*rng.random((parcels, 2))
+    planner_names = np.array([''.join(letters) for letters in rng.choice(list('ABCDEFGHIJKLMNOPRSTW'), (sizes['planners'], 7))])
+
+    return {'n':n, 'seed':seed,
+            'category':rng.choice(len(RECORD_TYPES), n, p=type_weights/type_weights.sum()).astype(np.uint8),
+            'year':rng.integers(2000, 2019, n).astype(np.int16),
+            'parcel':rng.choice(parcels, n, p=parcel_weights/parcel_weights.sum()).astype(np.int32),
+            'corner':corner, 'width':width,
+            'address':np.where(rng.random(parcels) < 0.7,
+                               pd.Series(rng.integers(1, 4000, parcels)).astype(str) + ' ' + rng.choice(STREETS, parcels), None),
+            'planner_id':planner_names,
+            'planner_known':rng.random(sizes['planners']) < 0.45,
+            'descriptions':np.array([' '.join(rng.choice(WORDS, rng.integers(3, 40))).capitalize() + '.'
+                                     for _ in range(sizes['descriptions'])], dtype=object)}
+
+#the record_id of the records at the row positions rows
+def record_ids(state, rows):
+    acronyms = np.array([acronym(record_type) for record_type in RECORD_TYPES], dtype=object)
+    return (pd.Series(state['year'][rows]).astype(str) + '-' + pd.Series(rows).astype(str).str.zfill(6)
+            + pd.Series(acronyms[state['category'][rows]], dtype=str)).to_numpy(dtype=object)
+
+#the 3 letter acronym of a record type, ie the part after the dash for the environmental ones
+def acronym(record_type):
+    category = record_type.split('/')[-1]
+    return category.split('-')[-1] if '-' in category else category
+
+#the rows from start up to stop of the export, cut from the blocks of BLOCK_ROWS rows they are in
+def generate_rows(state, start, stop):
+    first = start - start % BLOCK_ROWS
+    blocks = [generate_block(state, block, min(block + BLOCK_ROWS, state['n'])) for block in range(first, stop, BLOCK_ROWS)]
+    frame = blocks[0] if len(blocks) == 1 else pd.concat(blocks)
+    return frame.loc[start:stop - 1]
+
+#the rows from start up to stop of the export, all drawn from the random stream of start
+def generate_block(state, start, stop):
+    rng = np.random.default_rng([state['seed'], start])
+    rows = np.arange(start, stop)
+    n = len(rows)
+    data = {}
+
+    def some(values, share):
+        values = np.asarray(values, dtype=object)
+        return np.where(rng.random(n) < share, values, None)
+
+    def dates(years, share):
+        months, days = rng.integers(1, 13, n), rng.integers(1, 29, n)
+        text = (pd.Series(months).astype(str) + '/' + pd.Series(days).astype(str) + '/' + pd.Series(years).astype(str)
+                + ' 12:00:00 AM')
+        return some(text, share)
+
+    #record types, ids and relationships
+    category = state['category'][rows]
+    hierarchy = [record_type.split('/') for record_type in RECORD_TYPES]
+    acronyms = np.array([acronym(record_type) for record_type in RECORD_TYPES], dtype=object)
+    names = np.array(['%s (%s)' % (RECORD_TYPE_NAMES.get(acronym(t), h[1]), acronym(t)) if h[2] != 'Other' else 'Other'
+                      for t, h in zip(RECORD_TYPES, hierarchy)], dtype=object)
+    typos = np.array([name.split(' (')[0] for name in names], dtype=object)
+    data['record_id'] = record_ids(state, rows)
+    data['record_type_category'] = np.array([h[2] for h in hierarchy], dtype=object)[category]
+    data['record_type'] = np.where(rng.random(n) < RECORD_TYPE_TYPOS, typos[category], names[category])
+    data['record_type_type'] = np.array([h[0] for h in hierarchy], dtype=object)[category]
+    data['record_type_subtype'] = np.array([h[1] for h in hierarchy], dtype=object)[category]
+    data['record_type_group'] = 'Planning'
+    data['record_type_4level'] = ('Planning/' + pd.Series(np.array(RECORD_TYPES, dtype=object)[category])).to_numpy(dtype=object)
+    data['module'] = 'Planning'
+
+    #children are mostly records filed around the same time (the rest of a project's family), and a few aren't in the export
+    has_children = rng.random(n) < 0.12
+    counts = np.minimum(rng.geometric(0.5, n), 10) * has_children
+    parents = np.repeat(np.arange(n), counts)
+    child_rows = np.clip(rows[parents] + rng.integers(-50, 50, len(parents)), 0, state['n'] - 1)
+    children = pd.Series(record_ids(state, child_rows))
+    missing = rng.random(len(children)) < 0.03
+    children[missing] = children[missing] + 'X'
+    children = children.groupby(parents).agg(','.join)
+    data['children'] = pd.Series(children, index=np.arange(n)).to_numpy(dtype=object)
+    data['parent'] = None
+
+    #parcels and planners
+    parcel = state['parcel'][rows]
+    x, y = state['corner'][parcel].T
+    w, h = state['width'][parcel].T
+    geom = ('MULTIPOLYGON (((' + pd.Series(x).astype(str) + ' ' + pd.Series(y).astype(str) + ', '
+            + pd.Series(x + w).astype(str) + ' ' + pd.Series(y).astype(str) + ', '
+            + pd.Series(x + w).astype(str) + ' ' + pd.Series(y + h).astype(str) + ', '
+            + pd.Series(x).astype(str) + ' ' + pd.Series(y).astype(str) + ')))')
+    has_geom = rng.random(n) < 0.92
+    data['the_geom'] = np.where(has_geom, geom, None)
+    #in degrees, like the_geom
+    data['Shape_Length'] = np.where(has_geom, 2*(w + h), np.nan)
+    data['Shape_Area'] = np.where(has_geom, w*h, np.nan)
+    data['address'] = some(state['address'][parcel], 0.8)
+
+    planner = rng.integers(0, len(state['planner_id']), n)
+    has_planner = rng.random(n) < 0.74
+    known = has_planner & state['planner_known'][planner]
+    planner_id = state['planner_id'][planner]
+    data['planner_id'] = np.where(has_planner, planner_id, None)
+    data['planner_name'] = np.where(known, pd.Series(planner_id).str.title(), None)
+    data['planner_email'] = np.where(known, pd.Series(planner_id).str.lower() + '@sfgov.org', None)
+    data['planner_phone'] = np.where(known, '415-558-' + pd.Series(planner).astype(str).str.zfill(4), None)
+
+    #descriptive columns
+    data['record_status'] = rng.choice(np.array(RECORD_STATUSES, dtype=object), n, p=status_weights())
+    data['record_name'] = np.where(pd.isna(data['address']), None, data['address'])
+    data['description'] = some(state['descriptions'][rng.integers(0, len(state['descriptions']), n)], 0.9)
+    data['OBJECTID'] = rows + 1
+    data['templateid'] = rows*7 + 1000003
+    data['constructcost'] = np.where(rng.random(n) < 0.6, np.round(rng.lognormal(11, 2, n)), np.nan)
+    data['acalink'] = 'https://aca.accela.com/ccsf/Cap/CapDetail.aspx?Module=Planning&capID=' + data['record_id']
+    data['aalink'] = 'https://av.accela.com/portlets/cap/capsummary/CapTabSummary.do?capID=' + data['record_id']
+    data['RELATED_BUILDING_PERMIT'] = some(pd.Series(rng.integers(10**11, 10**12, n)).astype(str), 0.2)
+
+    years = state['year'][rows]
+    data['date_opened'] = dates(years, 0.99)
+    data['date_closed'] = dates(np.minimum(years + rng.geometric(0.5, n) - 1, 2018), DATE_CLOSED_SHARE)
+    for col in dc.HEARING_DATE_COLS:
+        data[col] = dates(years, HEARING_SHARE)
+
+    #project descriptions
+    for col in dc.CHECKBOX_COLS:
+        data[col] = some(np.full(n, 'CHECKED', dtype=object), CHECKBOX_SHARE)
+    data['DEMOLITION'] = rng.choice(np.array(['Yes', 'No', 'CHECKED', None], dtype=object), n, p=[0.01, 0.03, 0.01, 0.95])
+    data['MCD_REFERRAL'] = some(rng.choice(np.array(MCD_REFERRALS, dtype=object), n), 0.005)
+    data['ENVIRONMENTAL_REVIEW_TYPE'] = some(rng.choice(np.array(ENVIRONMENTAL_REVIEW_TYPES, dtype=object), n), 0.15)
+
+    #land use, project features and dwellings: existing and proposed numbers, and the net change
+    def group(spec, scale, empty=()):
+        for t in spec.types:
+            present = rng.random(n) < GROUP_SHARE
+            exist = np.where(rng.random(n) < 0.5, np.round(rng.lognormal(0, 1, n)*scale), 0)
+            prop = np.round(rng.lognormal(0, 1, n)*scale)
+            for suffix, values in (('_EXIST', exist), ('_PROP', prop), ('_NET', prop - exist)):
+                col = spec.prefix + t + suffix
+                data[col] = np.where(present & (col not in empty), values, np.nan)
+    group(dc.LAND_USE_MELT, 2000)
+    #the proposed stories and loading spaces are always empty in the export (see fix_prj_features)
+    group(dc.PRJ_FEATURE_MELT, 5, empty=('PRJ_FEATURE_STORIES_PROP', 'PRJ_FEATURE_LOADING_PROP'))
+    data['PRJ_FEATURE_OTHER'] = np.where(pd.notna(data['PRJ_FEATURE_OTHER_PROP']),
+                                         rng.choice(np.array(PRJ_FEATURE_OTHERS + [None], dtype=object), n), None)
+    group(dc.DWELLING_MELT, 5)
+    group(dc.melt(dc.ADU_MELT.prefix, dc.ADU_MELT.types, {}), 1)
+    for t in dc.ADU_MELT.types:
+        data['RESIDENTIAL_' + t + '_AREA'] = np.where(pd.notna(data['RESIDENTIAL_' + t + '_PROP']) & (rng.random(n) < 0.6),
+                                                      np.round(rng.uniform(200, 1200, n)), np.nan)
+
+    #in the order of the catalogue, with the columns it doesn't list at the end
+    columns = list(dict.fromkeys(list(pd.read_csv(dc.FIELD_SOURCE)['Field']) + dc.EXTRA_SOURCE_COLS))
+    frame = pd.DataFrame({col: data[col] for col in columns}, index=rows)
+    return frame
+
+#statuses are mostly closed or accepted
+def status_weights():
+    weights = 1 / np.arange(1, len(RECORD_STATUSES) + 1)**1.5
+    return weights / weights.sum()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic PPTS export.')
+    parser.add_argument('rows', type=int, help='number of records')
+    parser.add_argument('destination', help='csv file to write')
+    parser.add_argument('--seed', type=int, default=0, help='random seed; the same seed gives the same file')
+    parser.add_argument('--chunksize', type=int, default=100000, help='rows written at a time (the file is the same whatever it is)')
+    args = parser.parse_args()
+    write_csv(args.rows, args.destination, seed=args.seed, chunksize=args.chunksize)
@@ -0,0 +1,83 @@
+'''
+Unit tests for pipeline_merge, on small made up reports
+
+To run, execute "python -m test_pipeline_merge" from the command line
+'''
+
+from unittest import TestCase, main
+from contextlib import redirect_stdout
+import pandas as pd
+import io
+import os
+import shutil
+import tempfile
+import pipeline_merge as pm
+
+#a report in the 2017 Q3 layout, with the columns COLUMN_MAP reads
+def report(units, affordable, entitled='FALSE'):
+    return pd.DataFrame({'PROJECT_TYPE':['Resident', 'Resident', 'Mixres'],
+                         'BLKLOT':['3725093', '4644002A', '0001001'],
+                         'NAMEADDR':['1 MAIN ST', '2 MISSION ST', '3 HOWARD ST'],
+                         'Entitled':[entitled]*3,
+                         'BESTSTAT':['BP FILED', 'PL FILED', 'CONSTRUCTION'],
+                         'BESTDATE':['2017-06-01', '2017-07-15', '2017-08-30'],
+                         'UNITS':units, 'AFFORDABLE':affordable,
+                         'CASENO':['2016-000001PRJ', '2016-000002PRJ', '2016-000003PRJ'],
+                         'DESCRIPT':['new building', 'addition', 'demolition'],
+                         'DBIDESC':['erect 5 story', 'add 2 units', None],
+                         'Location 1':['1 MAIN ST\n(37.7565, -122.3889)', '(37.76, -122.41)', None]})
+
+class testMerge(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, quarter, frame):
+        frame.to_csv(os.path.join(self.directory, 'SF_Development_Pipeline_%s.tsv' % quarter), sep='\t', index=False)
+
+    def combined(self):
+        return pd.read_csv(os.path.join(self.directory, pm.COMBINED), sep='\t', index_col=0, dtype=str)
+
+    def test_same_rows_are_not_added_again(self):
+        #no missing values in the first quarter, one in the second: the numbers have to be written the same way
+        self.write('2017_Q1', report(['584', '12', '3'], ['10', '0', '1']))
+        self.write('2017_Q2', report(['584', '12', '3'], ['10', '0', None]))
+        self.assertEqual(pm.merge(self.directory), 4)
+        self.assertEqual(pm.merge(self.directory), 0)
+        self.write('2017_Q3', report(['584', '12', '3'], ['10', '0', None]))
+        self.assertEqual(pm.merge(self.directory), 0)
+        self.assertEqual(self.combined()['Units'].tolist(), ['584.0', '12.0', '3.0', '3.0'])
+
+    def test_latest_row_of_project_is_last(self):
+        self.write('2017_Q1', report(['10', '12', '3'], ['0', '0', '0']))
+        self.write('2017_Q2', report(['20', '12', '3'], ['0', '0', '0']))
+        self.write('2017_Q3', report(['10', '12', '3'], ['0', '0', '0']))
+        self.assertEqual(pm.merge(self.directory), 5)
+        combined = self.combined()
+        latest = combined[combined['Case Number'] == '2016-000001PRJ']
+        self.assertEqual(latest['Units'].tolist(), ['10.0', '20.0', '10.0'])
+
+    def test_renamed_columns(self):
+        renamed = report(['1', '2', '3'], ['0', '0', '0'], entitled='TRUE').rename(columns={'Entitled':'ENTITLED'})
+        renamed['AFFORDABLE_NET'] = '0'
+        renamed['BESTSTATUS'] = 'BP FILED'
+        self.write('2017_Q4', renamed)
+        with redirect_stdout(io.StringIO()) as out:
+            pm.merge(self.directory)
+        self.assertEqual(self.combined()['Entitled'].tolist(), ['True']*3)
+        #a column that maps to nothing is reported, unless it is known to be unused
+        self.assertIn('are left out: BESTSTATUS\n', out.getvalue())
+
+    def test_search(self):
+        self.write('2017_Q1', report(['1', '2', '3'], ['0', '0', '0']))
+        pm.merge(self.directory)
+        found = pm.search(self.directory, 'mission')
+        self.assertEqual(found['case_number'].tolist(), ['2016-000002PRJ'])
+        with self.assertRaises(ValueError):
+            pm.search(self.directory, '"')
+
+if __name__ == '__main__':
+    main()
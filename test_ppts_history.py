@@ -0,0 +1,69 @@
+'''
+Unit tests for ppts_history, on synthetic exports (see synthetic_ppts)
+
+To run, execute "python -m test_ppts_history" from the command line
+'''
+
+from unittest import TestCase, main
+import pandas as pd
+import sqlite3 as lite
+import os
+import shutil
+import tempfile
+import database_creator as dc
+import ppts_history as ph
+import synthetic_ppts
+
+class testHistory(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        first = synthetic_ppts.generate(2000, seed=1)
+        #the second export changes 50 records, drops 20 and adds 30, and lists the records in another order
+        second = first.copy()
+        second['record_status'] = second['record_status'].astype(object)
+        second.loc[second.index[:50], 'record_status'] = 'Changed'
+        second = pd.concat([second.iloc[20:], synthetic_ppts.generate(2030, seed=1).iloc[2000:]])
+        second = second.sample(frac=1, random_state=0)
+        cls.sources = [os.path.join(cls.directory, 'export_%d.csv' % i) for i in range(3)]
+        #the third export is the first one again
+        for source, frame in zip(cls.sources, [first, second, first]):
+            frame.to_csv(source, index=False)
+        cls.history = os.path.join(cls.directory, 'history.db')
+        cls.counts = [ph.ingest(cls.history, source, taken)
+                      for source, taken in zip(cls.sources, ['2017-12-31', '2018-06-30', '2018-12-31'])]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_counts(self):
+        self.assertEqual(self.counts[0], {'new':2000, 'changed':0, 'unchanged':0, 'removed':0})
+        self.assertEqual(self.counts[1], {'new':30, 'changed':30, 'unchanged':1950, 'removed':20})
+        self.assertEqual(self.counts[2], {'new':20, 'changed':30, 'unchanged':1950, 'removed':30})
+
+    def test_versions_are_stored_once(self):
+        with lite.connect(self.history) as con:
+            versions = con.execute('select count(*) from %s' % ph.VERSION_TABLE).fetchone()[0]
+        #the third snapshot only brings back versions of the first
+        self.assertEqual(versions, 2000 + 30 + 30)
+
+    def test_as_of_round_trip(self):
+        for source, taken in zip(self.sources, ['2018-01-01', '2018-06-30', '2019-01-01']):
+            expected = dc.read_source(source)
+            expected['source_hash'] = dc.source_hash(expected)
+            pd.testing.assert_frame_equal(ph.as_of(self.history, taken), expected, check_categorical=False)
+
+    def test_as_of_columns(self):
+        status = ph.as_of(self.history, '2018-07-01', columns=['record_status'])
+        self.assertEqual(list(status.columns), ['record_id', 'record_status'])
+        self.assertEqual((status['record_status'] == 'Changed').sum(), 30)
+        self.assertEqual(len(ph.as_of(self.history, '2017-01-01', columns=['record_status'])), 0)
+
+    def test_ingest_in_order(self):
+        with self.assertRaises(ValueError):
+            ph.ingest(self.history, self.sources[0], '2018-01-01')
+
+if __name__ == '__main__':
+    main()
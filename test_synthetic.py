@@ -0,0 +1,231 @@
+'''
+Unit tests for database_creator that don't need the real PPTS export: small hand made inputs, and synthetic exports
+from synthetic_ppts.generate()
+
+To run, execute "python -m test_synthetic" from the command line
+'''
+
+from unittest import TestCase, main
+from contextlib import redirect_stdout
+import pandas as pd
+import numpy as np
+import sqlite3 as lite
+import io
+import os
+import shutil
+import tempfile
+import database_creator as dc
+import synthetic_ppts
+
+class testParseGeometries(TestCase):
+
+    def test_shapes(self):
+        wkt = pd.Series(['POINT (1 2)', 'POLYGON ((0 0, 2 0, 2 2, 0 2, 0 0))', None, 'POINT (1 2)',
+                         'POLYGON ((0 0, 4 0, 4 4, 0 4, 0 0), (1 1, 1 2, 2 2, 2 1, 1 1))',
+                         'MULTIPOLYGON (((0 0, 1 0, 1 1, 0 1, 0 0)), ((2 2, 3 2, 3 3, 2 3, 2 2)))'])
+        bounds = dc.parse_geometries(wkt)
+        self.assertEqual(bounds.loc[0].tolist(), [1, 2, 1, 1, 2, 2])
+        self.assertEqual(bounds.loc[1].tolist(), [1, 1, 0, 2, 0, 2])
+        self.assertTrue(bounds.loc[2].isna().all())
+        self.assertEqual(bounds.loc[3].tolist(), bounds.loc[0].tolist())
+        #the hole takes its area away from the centroid: (4*4*2 - 1*1*1.5) / 15
+        self.assertAlmostEqual(bounds.loc[4, dc.LOCATION_CENTROID_X], 30.5/15)
+        self.assertEqual(bounds.loc[5].tolist(), [1.5, 1.5, 0, 3, 0, 3])
+
+    def test_bad_geometries_only_blank_themselves(self):
+        wkt = pd.Series(['POINT (1 2)', 'POLYGON ((0 0, x 0, 1 1, 0 0))', 'LINESTRING (0 0, 1)', 'LINESTRING (0 0, 2 2)'])
+        bounds = dc.parse_geometries(wkt)
+        self.assertEqual(bounds.loc[0].tolist(), [1, 2, 1, 1, 2, 2])
+        self.assertTrue(bounds.loc[[1, 2]].isna().all().all())
+        self.assertEqual(bounds.loc[3].tolist(), [1, 1, 0, 2, 0, 2])
+
+class testDimension(TestCase):
+
+    def test_ids(self):
+        data = synthetic_ppts.generate(500, seed=2)
+        dim = dc.location_dimension()
+        ids = dim.add(data.iloc[:300])
+        more = dim.add(data.iloc[300:])
+        table = dim.table()
+        #ids are 0..n-1, one per distinct geometry (records without one share an id), in order of first appearance
+        codes, uniques = pd.factorize(data['the_geom'].fillna('missing'))
+        self.assertEqual(table[dc.LOCATION_PK].tolist(), list(range(len(uniques))))
+        self.assertEqual(pd.concat([ids, more]).astype(int).tolist(), codes.tolist())
+        self.assertEqual(table[dc.LOCATION_GEOM].fillna('missing').tolist(), list(uniques))
+
+    def test_seed(self):
+        data = pd.DataFrame({'key':['b', None, 'c', 'a'], 'value':[1, 2, 3, 4]})
+        dim = dc.dimension('key', 'name', 'id', {'value':'value'})
+        dim.seed(['a', 'b'])
+        ids = dim.add(data)
+        #keys that already have ids keep them, new ones come after, and missing keys get no id
+        self.assertEqual(ids.tolist()[:1] + ids.tolist()[2:], [1, 2, 0])
+        self.assertTrue(np.isnan(ids[1]))
+        table = dim.table()
+        self.assertEqual(table['name'].tolist(), ['a', 'b', 'c'])
+        self.assertEqual(table['value'].tolist(), [4, 1, 3])
+
+class testParseDates(TestCase):
+
+    def test_formats(self):
+        strings = pd.Series(['7/4/2017', '07/04/2017 03:15:00 PM', '2017-07-04', '2017-07-04T00:00:00.000', '04-JUL-17',
+                             '4-jul-1995', '1-JAN-69', 'soon', None], dtype=object)
+        with redirect_stdout(io.StringIO()) as out:
+            dates = dc.parse_dates(strings)
+        self.assertEqual(dates['iso'][:5].tolist(), ['2017-07-04']*5)
+        self.assertEqual(dates.loc[5:6, 'iso'].tolist(), ['1995-07-04', '1969-01-01'])
+        self.assertEqual(dates.loc[0, 'day_number'], 17351)
+        self.assertEqual(dates.loc[6, 'day_number'], -365)
+        self.assertEqual(dates.loc[0, ['year', 'month', 'day']].tolist(), [2017, 7, 4])
+        #what can't be read is reported and left missing, like missing values and the extra row at the end
+        self.assertIn('could not read 1 dates, such as soon', out.getvalue())
+        self.assertEqual(len(dates), len(strings) + 1)
+        self.assertTrue(dates.loc[7:].isna().all().all())
+
+    def test_ymd(self):
+        data = dc.ymd(synthetic_ppts.generate(300, seed=5))
+        expected = synthetic_ppts.generate(300, seed=5)
+        for col in dc.DATE_COLS:
+            dates = pd.to_datetime(expected[col], format='%m/%d/%Y %I:%M:%S %p')
+            iso = dates.dt.strftime('%Y-%m-%d').astype(object).where(dates.notna())
+            pd.testing.assert_series_equal(data[col].astype(object), iso, check_names=False)
+        opened = pd.to_datetime(expected['date_opened'], format='%m/%d/%Y %I:%M:%S %p')
+        pd.testing.assert_series_equal(data['year_opened'], opened.dt.year.astype(float), check_names=False)
+        pd.testing.assert_series_equal(data['day_opened'], opened.dt.day.astype(float), check_names=False)
+        pd.testing.assert_series_equal(data['day_number_opened'], (opened - pd.Timestamp('1970-01-01')).dt.days.astype(float),
+                                       check_names=False)
+
+class testUnpivot(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data = dc.ymd(synthetic_ppts.generate(2000, seed=6))
+
+    def test_adu_counted_once(self):
+        dwelling, adu_area = dc.dwelling_table(self.data)
+        for adu_type in dc.ADU_MELT.types:
+            columns = ['RESIDENTIAL_%s_%s' % (adu_type, suffix) for suffix in ['EXIST', 'PROP', 'NET', 'AREA']]
+            rows = dwelling[dwelling[dc.DWELLING_TYPE] == adu_type]
+            #one row for each record with any value for the type, whether or not it has an area
+            self.assertEqual(sorted(rows[dc.DWELLING_FK]), list(np.flatnonzero(self.data[columns].notna().any(axis=1))))
+            self.assertEqual(rows[dc.DWELLING_PROP].sum(), self.data[columns[1]].sum())
+            #and an area for those that have one, pointing to that row
+            areas = adu_area.merge(rows, left_on=dc.ADU_PK, right_index=True)
+            has_area = self.data[columns[3]].notna()
+            self.assertEqual(sorted(areas[dc.DWELLING_FK]), list(np.flatnonzero(has_area)))
+            self.assertEqual(areas.sort_values(dc.DWELLING_FK)[dc.ADU_AREA].tolist(), self.data.loc[has_area, columns[3]].tolist())
+        self.assertEqual(len(adu_area), adu_area[dc.ADU_PK].nunique())
+
+    def test_hearing_dates(self):
+        hearing_date = dc.hearing_date_table(self.data)
+        for column in dc.HEARING_DATE_COLS:
+            rows = hearing_date[hearing_date[dc.HEARING_TYPE] == column]
+            dates = self.data[column].dropna()
+            self.assertEqual(rows[dc.HEARING_FK].tolist(), dates.index.tolist())
+            self.assertEqual(rows[dc.HEARING_DATE].tolist(), dates.tolist())
+        self.assertTrue(hearing_date[dc.HEARING_DATE].str.match(r'^\d{4}-\d{2}-\d{2}$').all())
+
+class testSearchQuery(TestCase):
+
+    def test_query(self):
+        self.assertEqual(dc.search_query('density bonus'), '("density" OR "density"*) AND ("bonus" OR "bonus"*)')
+        #punctuation is not query syntax
+        self.assertEqual(dc.search_query('"24TH" ST*'), dc.search_query('24TH ST'))
+        with self.assertRaises(ValueError):
+            dc.search_query(' "-* ')
+
+#the content of a database made by create(), table by table, with the ids that depend on how it was built (the size
+#of its chunks, or the updates it went through) replaced by what they point to, and the rows sorted
+def content(destination):
+    with lite.connect(destination) as con:
+        read = lambda table: pd.read_sql('select * from %s' % table, con)
+        record = read('record')
+        record_ids = record.set_index(dc.RECORD_PK)[dc.RECORD_ID]
+        tables = {'record':record.merge(read('location').add_prefix('location.'), how='left',
+                                        left_on=dc.RECORD_FK_LOCATION, right_on='location.' + dc.LOCATION_PK)
+                                 .merge(read('planner').add_prefix('planner.'), how='left',
+                                        left_on=dc.RECORD_FK_PLANNER, right_on='planner.' + dc.PLANNER_PK)
+                                 .drop(columns=[dc.RECORD_FK_LOCATION, dc.RECORD_FK_PLANNER, 'location.' + dc.LOCATION_PK,
+                                                'planner.' + dc.PLANNER_PK])}
+        for table in ['prj_desc', 'land_use', 'prj_feature', 'dwelling', 'hearing_date']:
+            tables[table] = read(table).assign(record=lambda t: t['record'].map(record_ids))
+        tables['prj_desc_detail'] = read('prj_desc_detail').merge(tables['prj_desc'], left_on=dc.PRJ_DESC_DETAIL_PK,
+                                                                  right_on=dc.PRJ_DESC_PK).drop(columns=dc.PRJ_DESC_DETAIL_PK)
+        tables['adu_area'] = read('adu_area').merge(tables['dwelling'], left_on=dc.ADU_PK,
+                                                    right_on=dc.DWELLING_PK).drop(columns=dc.ADU_PK)
+        tables['record_rel'] = read('record_rel').assign(parent=lambda t: t[dc.RECORD_REL_PARENT].map(record_ids),
+                                                         child=lambda t: t[dc.RECORD_REL_CHILD].map(record_ids))
+        #record types and summaries don't point anywhere, but types can outlive their records
+        #(records point to the acronym of their type, which is in the name column)
+        record_type = read('record_type')
+        tables['record_type'] = record_type[record_type[dc.RECORD_TYPE].isin(record[dc.RECORD_FK_TYPE])]
+        for table in ['summary_units', 'summary_affordable', 'summary_permits']:
+            tables[table] = read(table)
+    return {table:sorted_rows(frame.drop(columns=['id'], errors='ignore')) for table, frame in tables.items()}
+
+def sorted_rows(frame):
+    return frame.sort_values(list(frame.columns)).reset_index(drop=True)
+
+class testBuilds(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.source = os.path.join(cls.directory, 'export.csv')
+        synthetic_ppts.generate(3000, seed=3).to_csv(cls.source, index=False)
+        cls.database = cls.build('database.db', cls.source)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    @classmethod
+    def build(cls, name, source, **kwargs):
+        destination = os.path.join(cls.directory, name)
+        with redirect_stdout(io.StringIO()):
+            dc.create(source, destination, **kwargs)
+        return destination
+
+    #ignore lists the columns of the record table to leave out of the comparison
+    def assertSameContent(self, first, second, ignore=[]):
+        first, second = content(first), content(second)
+        first['record'], second['record'] = [sorted_rows(frame['record'].drop(columns=ignore)) for frame in (first, second)]
+        for table in first:
+            with self.subTest(table=table):
+                pd.testing.assert_frame_equal(first[table], second[table], check_dtype=False)
+
+    def test_streaming(self):
+        self.assertSameContent(self.database, self.build('streaming.db', self.source, chunksize=1000))
+
+    def test_search(self):
+        with lite.connect(self.database) as con:
+            found = dc.search_records(con, 'mission st', limit=3000)
+            addresses = pd.read_sql('select r.%s from record r join location l on l.%s = r.%s where l.%s like ?'
+                                    % (dc.RECORD_ID, dc.LOCATION_PK, dc.RECORD_FK_LOCATION, dc.LOCATION_ADDRESS),
+                                    con, params=('%MISSION ST%',))
+            #every record on the street is found (along with those that mention it)
+            self.assertTrue(len(addresses) > 0)
+            self.assertTrue(set(addresses[dc.RECORD_ID]) <= set(found[dc.RECORD_ID]))
+            prefixes = dc.search_records(con, 'missio "s', limit=len(found))
+            self.assertEqual(set(prefixes[dc.RECORD_ID]), set(found[dc.RECORD_ID]))
+
+    def test_update(self):
+        #the second export changes 50 records, drops 20 and adds 30, and lists the records in another order
+        second = pd.read_csv(self.source, dtype=object)
+        second.loc[second.index[:50], 'record_status'] = 'Changed'
+        second.loc[second.index[25:50], 'RESIDENTIAL_STUDIO_PROP'] = '7'
+        added = synthetic_ppts.generate(3030, seed=3).iloc[3000:].astype(object)
+        second = pd.concat([second.iloc[20:], added]).sample(frac=1, random_state=0)
+        source = os.path.join(self.directory, 'second.csv')
+        second.to_csv(source, index=False)
+        
+        updated = os.path.join(self.directory, 'updated.db')
+        shutil.copy(self.database, updated)
+        with redirect_stdout(io.StringIO()) as out:
+            dc.update(updated, source)
+        self.assertIn('30 new, 30 changed, 20 deleted records', out.getvalue())
+        #the address of a location is that of the first record seen with it, which depends on the order of the records
+        self.assertSameContent(updated, self.build('second.db', source), ignore=['location.address'])
+
+if __name__ == '__main__':
+    main()